@@ -1,134 +1,929 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, g, render_template, request, jsonify
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import requests
 import time
 import math
 import random
+from collections import Counter, OrderedDict, deque
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+import json
+import copy
+import multiprocessing
+import uuid
+from multiprocessing import shared_memory
+import numpy as np
+from local_router import LocalRouter, ensure_hierarchy, haversine_m
+import metrics
 
 app = Flask(__name__)
 
-# --- Lõi thuật toán ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-def get_coords_from_address(address):
-    """Sử dụng Nominatim API để chuyển đổi địa chỉ thành tọa độ."""
-    url = "https://nominatim.openstreetmap.org/search"
+# --- Cấu hình ---
+
+NOMINATIM_URL = os.environ.get('NOMINATIM_URL', 'https://nominatim.openstreetmap.org/search')
+GEOCODE_CACHE_PATH = os.environ.get('GEOCODE_CACHE_PATH', os.path.join(BASE_DIR, 'geocode_cache.sqlite3'))
+GEOCODE_CACHE_TTL_SEC = int(os.environ.get('GEOCODE_CACHE_TTL_SEC', 30 * 24 * 3600))
+GEOCODE_CACHE_MAX_ENTRIES = int(os.environ.get('GEOCODE_CACHE_MAX_ENTRIES', 10000))
+GEOCODE_RATE_LIMIT = float(os.environ.get('GEOCODE_RATE_LIMIT', 1.0))  # request/giây, theo chính sách của Nominatim
+GEOCODE_WORKERS = int(os.environ.get('GEOCODE_WORKERS', 4))
+
+ROUTING_BACKEND = os.environ.get('ROUTING_BACKEND', 'osrm')  # osrm | haversine | local
+OSRM_URL = os.environ.get('OSRM_URL', 'http://router.project-osrm.org')
+OSRM_TABLE_MAX_SIZE = int(os.environ.get('OSRM_TABLE_MAX_SIZE', 100))  # số tọa độ tối đa mỗi request /table
+OSRM_WORKERS = int(os.environ.get('OSRM_WORKERS', 4))
+MATRIX_CACHE_MAX_POINTS = int(os.environ.get('MATRIX_CACHE_MAX_POINTS', 2000))  # 2 ma trận float32: ~32 MB mỗi tiến trình
+ROAD_FACTOR = float(os.environ.get('ROAD_FACTOR', 1.3))  # quãng đường thực tế / đường chim bay (backend haversine)
+ROAD_SPEED_KMH = float(os.environ.get('ROAD_SPEED_KMH', 25))
+LOCAL_GRAPH_PATH = os.environ.get('LOCAL_GRAPH_PATH', os.path.join(BASE_DIR, 'data', 'sample_map.osm'))
+LOCAL_CH_PATH = os.environ.get('LOCAL_CH_PATH')  # mặc định cạnh file đồ thị, đuôi .ch
+
+SOLVER_NEIGHBORS = int(os.environ.get('SOLVER_NEIGHBORS', 16))  # số ứng viên gần nhất của mỗi điểm
+SA_MAX_MOVES_PER_TEMP = int(os.environ.get('SA_MAX_MOVES_PER_TEMP', 100))
+SA_TEMP_SAMPLES, SA_INITIAL_ACCEPTANCE, SA_COOLING_RATIO = 200, 0.05, 1000  # xem SolverCore.anneal
+SOLVER_EPS = 1e-7
+SOLVER_SCAN_MAX_LOCATIONS = int(os.environ.get('SOLVER_SCAN_MAX_LOCATIONS', 50))  # đến cỡ này 2-Opt quét mọi cặp như phiên bản gốc
+BLOCKED_EDGE_COST = 1e12  # chi phí thay cho cạnh không đi được (inf) bên trong lõi tối ưu
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', os.cpu_count() or 2))
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', 32))  # số công việc tối đa đang chờ hoặc đang chạy
+JOB_RESULT_TTL_SEC = int(os.environ.get('JOB_RESULT_TTL_SEC', 3600))
+JOB_PROGRESS_INTERVAL_SEC = 0.25
+JOB_SSE_KEEPALIVE_SEC = 15
+IN_JOB_WORKER = False  # True trong các tiến trình worker của pool công việc
+PLAN_MODES = ('distance', 'schedule', 'portfolio', 'vrp')
+
+SOLVER_WORKERS = int(os.environ.get('SOLVER_WORKERS', os.cpu_count() or 1))
+PARALLEL_SOLVE_MIN_LOCATIONS = int(os.environ.get('PARALLEL_SOLVE_MIN_LOCATIONS', 50))  # dưới ngưỡng này chạy tuần tự nhanh hơn
+PORTFOLIO_DEFAULT_BUDGET_SEC, PORTFOLIO_MAX_BUDGET_SEC = 10, 120
+PORTFOLIO_JOIN_GRACE_SEC = 2
+# Các biến thể tìm kiếm cục bộ (ngoài SA) mà các worker của chế độ portfolio luân phiên sử dụng.
+PORTFOLIO_VARIANTS = {'ils-2opt': ('2opt', 'oropt'), 'ils-3opt': ('2opt', '3opt')}
+
+TW_PENALTY_INIT, TW_PENALTY_MAX = 10.0, 1e6  # chi phí cho mỗi giây đến trễ trong lúc tìm kiếm TSPTW
+TW_SA_MAX_MOVES_PER_TEMP = int(os.environ.get('TW_SA_MAX_MOVES_PER_TEMP', 50))
+TW_SA_MAX_SPAN = 30  # độ dài tối đa của đoạn bị thay đổi trong một bước SA của TSPTW
+# Nhiệt độ ban đầu của SA TSPTW được chọn sao cho khoảng TW_SA_INITIAL_ACCEPTANCE số bước ngẫu nhiên (ước lượng
+# trên TW_SA_TEMP_SAMPLES bước thử) được chấp nhận; SA dừng khi nhiệt độ đã giảm TW_SA_COOLING_RATIO lần.
+TW_SA_TEMP_SAMPLES, TW_SA_INITIAL_ACCEPTANCE, TW_SA_COOLING_RATIO = 200, 0.02, 1000
+TW_EPS = 1e-6
+OPEN_TIME = 1e12  # "không giới hạn" cho khung giờ của kho ở cuối lộ trình
+
+VRP_MAX_VEHICLES = int(os.environ.get('VRP_MAX_VEHICLES', 100))
+
+# Các kế hoạch gần đây (ma trận + lộ trình) được giữ lại để /reroute sửa lộ trình mà không phải lấy lại ma trận.
+PLAN_STORE_MAX_PLANS = int(os.environ.get('PLAN_STORE_MAX_PLANS', 16))
+PLAN_TTL_SEC = int(os.environ.get('PLAN_TTL_SEC', JOB_RESULT_TTL_SEC))
+REROUTE_FULL_REPAIR_SEC = 1.0  # thời gian tối đa cho lần sửa toàn bộ phần lộ trình chưa đi (khi sửa cục bộ không đủ)
+
+TRACE_LOG = os.environ.get('TRACE_LOG', '')  # nơi ghi trace JSON của từng request/công việc: đường dẫn file, '-' là stderr, rỗng (mặc định) là tắt
+# Bật profiler lấy mẫu: lần giải nào lâu hơn số giây này sẽ được ghi flame graph (dạng folded) vào PROFILE_DIR.
+PROFILE_SLOW_SOLVE_SEC = float(os.environ['PROFILE_SLOW_SOLVE_SEC']) if os.environ.get('PROFILE_SLOW_SOLVE_SEC') else None
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(BASE_DIR, 'profiles'))
+PROFILE_INTERVAL_SEC = float(os.environ.get('PROFILE_INTERVAL_SEC', 0.005))
+
+# Một session dùng chung cho mọi request HTTP để tái sử dụng kết nối (keep-alive).
+http_session = requests.Session()
+http_session.headers.update({'User-Agent': 'TSP-Solver-App/1.0'})
+http_session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+http_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+# --- Đo lường ---
+
+metrics.registry.histogram('mapai_http_request_seconds', "Thời gian xử lý request HTTP theo endpoint")
+metrics.registry.histogram('mapai_stage_seconds', "Thời gian từng giai đoạn (geocode, matrix, solve, render, reroute)")
+metrics.registry.histogram('mapai_routing_request_seconds', "Thời gian mỗi lần lấy một khối ma trận từ backend định tuyến")
+metrics.registry.histogram('mapai_job_seconds', "Thời gian từ lúc nhận tới lúc kết thúc một công việc nền")
+metrics.registry.counter('mapai_geocode_lookups_total', "Số địa chỉ được tra cứu, theo kết quả tra cache (hit/miss)")
+metrics.registry.counter('mapai_geocode_errors_total', "Số lần gọi Nominatim bị lỗi")
+metrics.registry.counter('mapai_routing_retries_total', "Số lần gọi lại backend định tuyến sau lỗi")
+metrics.registry.counter('mapai_matrix_cells_total', "Số ô ma trận khoảng cách theo nguồn (cache hoặc backend)")
+metrics.registry.counter('mapai_solver_iterations_total', "Số vòng lặp của các thuật toán tối ưu")
+metrics.registry.counter('mapai_solver_improvements_total', "Số lần lời giải được cải thiện")
+metrics.registry.counter('mapai_sa_moves_total', "Số bước thử của Simulated Annealing theo kết quả (accepted/rejected)")
+metrics.registry.counter('mapai_jobs_total', "Số công việc nền theo trạng thái kết thúc")
+metrics.registry.counter('mapai_profiles_saved_total', "Số flame graph đã ghi cho các lần giải chậm")
+
+# --- Geocoding & bộ nhớ đệm ---
+
+class RateLimiter:
+    """Giới hạn số request mỗi giây, dùng chung giữa các luồng."""
+    def __init__(self, rate_per_sec):
+        self.interval = 1.0 / rate_per_sec if rate_per_sec > 0 else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now: time.sleep(slot - now)
+
+class GeocodeCache:
+    """Bộ nhớ đệm geocoding lưu trên đĩa (SQLite), có TTL và loại bỏ theo LRU."""
+    def __init__(self, path, ttl_sec, max_entries):
+        self.path, self.ttl_sec, self.max_entries = path, ttl_sec, max_entries
+        self._lock = threading.Lock()
+        self._conn, self._pid = None, None
+
+    def _connection(self):
+        # Mở lại kết nối nếu đang ở tiến trình con (kết nối SQLite không được chia sẻ qua fork).
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS geocode (key TEXT PRIMARY KEY, display_name TEXT NOT NULL, lat REAL NOT NULL, lon REAL NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_geocode_last_used ON geocode (last_used)")
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def get_many(self, keys):
+        """Trả về {key: tọa độ} cho các khóa còn hạn, đồng thời cập nhật thời điểm dùng gần nhất."""
+        now, found = time.time(), {}
+        with self._lock:
+            conn = self._connection()
+            for key in keys:
+                row = conn.execute("SELECT display_name, lat, lon FROM geocode WHERE key = ? AND created_at >= ?", (key, now - self.ttl_sec)).fetchone()
+                if row: found[key] = {"display_name": row[0], "lat": row[1], "lon": row[2]}
+            if found:
+                conn.executemany("UPDATE geocode SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+                conn.commit()
+        return found
+
+    def put_many(self, items):
+        """Lưu {key: tọa độ}, xóa bản ghi hết hạn và loại bỏ các bản ghi ít dùng nhất khi vượt giới hạn."""
+        if not items: return
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.executemany("INSERT OR REPLACE INTO geocode (key, display_name, lat, lon, created_at, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                             [(key, c['display_name'], c['lat'], c['lon'], now, now) for key, c in items.items()])
+            conn.execute("DELETE FROM geocode WHERE created_at < ?", (now - self.ttl_sec,))
+            overflow = conn.execute("SELECT COUNT(*) FROM geocode").fetchone()[0] - self.max_entries
+            if overflow > 0:
+                conn.execute("DELETE FROM geocode WHERE key IN (SELECT key FROM geocode ORDER BY last_used ASC LIMIT ?)", (overflow,))
+            conn.commit()
+
+geocode_cache = GeocodeCache(GEOCODE_CACHE_PATH, GEOCODE_CACHE_TTL_SEC, GEOCODE_CACHE_MAX_ENTRIES)
+geocode_rate_limiter = RateLimiter(GEOCODE_RATE_LIMIT)
+geocode_stats = {'lookups': 0, 'hits': 0, 'misses': 0, 'total_latency_ms': 0.0}
+geocode_stats_lock = threading.Lock()
+
+def normalize_address(address):
+    """Chuẩn hóa địa chỉ thành khóa cache (Unicode NFC, chữ thường, chuẩn hóa khoảng trắng và dấu phẩy)."""
+    text = unicodedata.normalize('NFC', address).casefold()
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\s*,\s*', ', ', text)
+    return text.strip(' ,.;')
+
+def fetch_coords_from_nominatim(address):
+    """Gọi Nominatim cho một địa chỉ (tôn trọng giới hạn tốc độ chung)."""
     params = {'q': address, 'format': 'json', 'limit': 1}
-    headers = {'User-Agent': 'TSP-Solver-App/1.0'}
+    geocode_rate_limiter.wait()
     try:
-        response = requests.get(url, params=params, headers=headers, timeout=10)
+        response = http_session.get(NOMINATIM_URL, params=params, timeout=10)
         response.raise_for_status()
         data = response.json()
         if data:
             return {"display_name": data[0]['display_name'], "lat": float(data[0]['lat']), "lon": float(data[0]['lon'])}
     except requests.exceptions.RequestException as e:
         print(f"Lỗi Nominatim API cho '{address}': {e}")
+        metrics.registry.inc('mapai_geocode_errors_total')
     return None
 
-def get_route_info(coords_list):
-    """Sử dụng OSRM API để lấy ma trận khoảng cách và thời gian."""
-    locations_str = ";".join([f"{coord['lon']},{coord['lat']}" for coord in coords_list])
-    url = f"http://router.project-osrm.org/table/v1/driving/{locations_str}"
-    params = {'annotations': 'distance,duration'}
+def geocode_addresses(addresses, progress=None):
+    """Chuyển một danh sách địa chỉ thành tọa độ: tra cache trước, phần còn thiếu gọi Nominatim song song."""
+    started = time.perf_counter()
+    keys = [normalize_address(addr) for addr in addresses]
+    coords = geocode_cache.get_many(set(keys))
+    missing = {}
+    for key, addr in zip(keys, addresses):
+        if key not in coords: missing.setdefault(key, addr)
+    num_misses = sum(1 for key in keys if key in missing)
+    metrics.registry.inc('mapai_geocode_lookups_total', len(keys) - num_misses, result='hit')
+    metrics.registry.inc('mapai_geocode_lookups_total', num_misses, result='miss')
+    if progress: progress('geocode', done=len(keys) - num_misses, total=len(keys))
+    if missing:
+        done, fetched, key_counts = len(keys) - num_misses, {}, Counter(keys)
+        with ThreadPoolExecutor(max_workers=max(1, min(GEOCODE_WORKERS, len(missing)))) as pool:
+            for key, coord in zip(missing, pool.map(fetch_coords_from_nominatim, missing.values())):
+                fetched[key] = coord
+                done += key_counts[key]
+                if progress: progress('geocode', done=done, total=len(keys))
+        geocode_cache.put_many({key: c for key, c in fetched.items() if c})
+        coords.update(fetched)
+    with geocode_stats_lock:
+        geocode_stats['lookups'] += len(keys)
+        geocode_stats['hits'] += len(keys) - num_misses
+        geocode_stats['misses'] += num_misses
+        geocode_stats['total_latency_ms'] += (time.perf_counter() - started) * 1000
+    # Trả về bản sao vì các tầng trên có thể gắn thêm dữ liệu (ví dụ 'schedule') vào từng điểm.
+    return [dict(coords[key]) if coords.get(key) else None for key in keys]
+
+def get_geocode_stats():
+    """Thống kê tỷ lệ trúng cache và độ trễ tra cứu trung bình."""
+    with geocode_stats_lock:
+        stats = dict(geocode_stats)
+    stats['hit_ratio'] = stats['hits'] / stats['lookups'] if stats['lookups'] else 0.0
+    stats['avg_latency_ms'] = stats['total_latency_ms'] / stats['lookups'] if stats['lookups'] else 0.0
+    return stats
+
+# --- Lõi thuật toán ---
+
+def get_coords_from_address(address):
+    """Sử dụng Nominatim API (qua bộ nhớ đệm) để chuyển đổi địa chỉ thành tọa độ."""
+    return geocode_addresses([address])[0]
+
+def coord_key(coord):
+    """Khóa của một điểm trong cache ma trận (làm tròn tới ~0.1 m)."""
+    return (round(float(coord['lon']), 6), round(float(coord['lat']), 6))
+
+def split_table_tiles(rows, cols, max_size):
+    """Chia khối (rows x cols) thành các ô con sao cho mỗi request /table không vượt quá max_size tọa độ."""
+    if len(rows) + len(cols) <= max_size: return [(rows, cols)]
+    row_chunk = min(len(rows), max(1, max_size // 2) if len(cols) > max_size // 2 else max_size - len(cols))
+    col_chunk = max(1, max_size - row_chunk)
+    return [(rows[r:r + row_chunk], cols[c:c + col_chunk]) for r in range(0, len(rows), row_chunk) for c in range(0, len(cols), col_chunk)]
+
+def fetch_osrm_table(coords_list, rows, cols):
+    """Gọi OSRM /table cho một ô con (sources = rows, destinations = cols), trả về hai mảng NumPy."""
+    points = list(dict.fromkeys(list(rows) + list(cols)))
+    position = {p: i for i, p in enumerate(points)}
+    locations_str = ";".join([f"{coords_list[p]['lon']},{coords_list[p]['lat']}" for p in points])
+    url = f"{OSRM_URL}/table/v1/driving/{locations_str}"
+    params = {'annotations': 'distance,duration', 'sources': ";".join(str(position[p]) for p in rows), 'destinations': ";".join(str(position[p]) for p in cols)}
     for attempt in range(3):
+        if attempt: metrics.registry.inc('mapai_routing_retries_total', backend='osrm')
         try:
-            response = requests.get(url, params=params, timeout=15)
+            response = http_session.get(url, params=params, timeout=15)
             response.raise_for_status()
             data = response.json()
             if data['code'] == 'Ok':
-                return data['distances'], data['durations']
+                # OSRM trả về null cho cặp điểm không có đường đi.
+                distances = np.array(data['distances'], dtype=float)
+                durations = np.array(data['durations'], dtype=float)
+                return np.where(np.isnan(distances), np.inf, distances), np.where(np.isnan(durations), np.inf, durations)
         except requests.exceptions.RequestException as e:
             print(f"Lỗi OSRM API (lần thử {attempt + 1}): {e}")
             if attempt < 2: time.sleep(2)
     return None, None
 
+# --- Backend định tuyến ---
+
+class OsrmBackend:
+    """Gọi OSRM /table qua HTTP, chia thành các ô vừa giới hạn của server và gọi song song."""
+    name = 'osrm'
+    max_table_size, workers = OSRM_TABLE_MAX_SIZE, OSRM_WORKERS
+
+    def table(self, coords_list, rows, cols):
+        return fetch_osrm_table(coords_list, rows, cols)
+
+class HaversineBackend:
+    """Ước lượng nhanh không cần mạng: đường chim bay nhân hệ số đường bộ, thời gian theo tốc độ trung bình."""
+    name = 'haversine'
+    max_table_size, workers = math.inf, 1
+
+    def table(self, coords_list, rows, cols):
+        lats, lons = (np.array([float(c[key]) for c in coords_list]) for key in ('lat', 'lon'))
+        rows, cols = np.asarray(rows, dtype=np.intp), np.asarray(cols, dtype=np.intp)
+        distances = haversine_m(lats[rows, None], lons[rows, None], lats[None, cols], lons[None, cols]) * ROAD_FACTOR
+        return distances, distances / (ROAD_SPEED_KMH / 3.6)
+
+class LocalGraphBackend:
+    """Bộ định tuyến cục bộ trên đồ thị đường bộ trích từ OSM (local_router); CH được xây một lần rồi mmap khi khởi động."""
+    name = 'local'
+    max_table_size, workers = math.inf, 1  # cả khối được tính trong một lần (bucket CH), song song hóa bên trong
+
+    def __init__(self, graph_path, ch_path=None):
+        self.router = LocalRouter(ensure_hierarchy(graph_path, ch_path))
+
+    def table(self, coords_list, rows, cols):
+        pool = get_solver_pool() if use_parallel_solvers(len(rows) + len(cols)) else None
+        return self.router.table([coords_list[p] for p in rows], [coords_list[p] for p in cols], executor=pool, chunks=SOLVER_WORKERS)
+
+ROUTING_BACKENDS = {'osrm': OsrmBackend, 'haversine': HaversineBackend, 'local': lambda: LocalGraphBackend(LOCAL_GRAPH_PATH, LOCAL_CH_PATH)}
+routing_backend = None
+routing_backend_lock = threading.Lock()
+
+def get_routing_backend():
+    """Backend định tuyến chọn bởi ROUTING_BACKEND (khởi tạo khi cần)."""
+    global routing_backend
+    with routing_backend_lock:
+        if routing_backend is None:
+            if ROUTING_BACKEND not in ROUTING_BACKENDS: raise ValueError(f"ROUTING_BACKEND không hợp lệ: {ROUTING_BACKEND} (chọn {', '.join(ROUTING_BACKENDS)})")
+            routing_backend = ROUTING_BACKENDS[ROUTING_BACKEND]()
+    return routing_backend
+
+class MatrixCache:
+    """Lưu khoảng cách/thời gian giữa các cặp tọa độ trong hai mảng NumPy; ô chưa biết mang giá trị NaN.
+
+    Mảng lưu dạng float32 (sai số cỡ milimét với quãng đường vài chục km) và không bao giờ lớn hơn max_points x max_points.
+    """
+    def __init__(self, max_points):
+        self.max_points = max_points
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.index, self.generation = {}, getattr(self, 'generation', 0) + 1
+        self.distances, self.durations = np.full((0, 0), np.nan, dtype=np.float32), np.full((0, 0), np.nan, dtype=np.float32)
+
+    def _grow(self, size):
+        capacity = len(self.distances)
+        if size <= capacity: return
+        # Nhân đôi để ít phải chép lại, nhưng không vượt max_points (trừ khi một request đã có nhiều điểm hơn thế).
+        new_capacity = min(max(size, capacity * 2, 16), max(size, self.max_points))
+        for name in ('distances', 'durations'):
+            grown = np.full((new_capacity, new_capacity), np.nan, dtype=np.float32)
+            grown[:capacity, :capacity] = getattr(self, name)
+            setattr(self, name, grown)
+
+    def lookup(self, keys):
+        """Trả về (generation, chỉ số trong cache, ma trận khoảng cách con, ma trận thời gian con)."""
+        with self._lock:
+            if len(self.index) + sum(1 for k in keys if k not in self.index) > self.max_points: self._reset()
+            idx = np.array([self.index.setdefault(k, len(self.index)) for k in keys], dtype=np.intp)
+            self._grow(len(self.index))
+            block = np.ix_(idx, idx)
+            return self.generation, idx, self.distances[block].astype(float), self.durations[block].astype(float)
+
+    def store(self, generation, idx, distances, durations):
+        with self._lock:
+            if generation != self.generation: return  # cache đã bị làm mới trong lúc đang gọi backend định tuyến
+            block = np.ix_(idx, idx)
+            self.distances[block], self.durations[block] = distances, durations
+
+matrix_cache = MatrixCache(MATRIX_CACHE_MAX_POINTS)
+
+def fetch_matrix_block(backend, coords_list, rows, cols):
+    """Lấy một khối ma trận từ backend (kể cả các lần thử lại) và ghi lại thời gian."""
+    started = time.perf_counter()
+    dist_block, dur_block = backend.table(coords_list, rows, cols)
+    metrics.registry.observe('mapai_routing_request_seconds', time.perf_counter() - started, backend=backend.name, outcome='ok' if dist_block is not None else 'error')
+    return dist_block, dur_block
+
+def get_route_info(coords_list, progress=None):
+    """Lấy ma trận khoảng cách và thời gian (mảng NumPy): dùng lại ô đã có trong cache, chỉ hỏi backend định tuyến các hàng/cột còn thiếu."""
+    keys = [coord_key(c) for c in coords_list]
+    first_seen = {}
+    for i, k in enumerate(keys): first_seen.setdefault(k, i)
+    unique_keys = list(first_seen)
+    unique_coords = [coords_list[i] for i in first_seen.values()]
+    backend = get_routing_backend()
+    generation, idx, distances, durations = matrix_cache.lookup(unique_keys)
+    unknown = np.isnan(distances) | np.isnan(durations)
+    # Điểm mới là điểm chưa từng được hỏi (đường chéo còn NaN); thêm cả điểm cũ còn thiếu ô với nhau.
+    missing = np.diag(unknown).copy()
+    known_points = np.flatnonzero(~missing)
+    missing[known_points[unknown[np.ix_(known_points, known_points)].any(axis=1)]] = True
+    if missing.any():
+        new_points, known_points = np.flatnonzero(missing), np.flatnonzero(~missing)
+        all_points = np.arange(len(unique_keys))
+        # Chỉ cần hàng của các điểm mới (tới mọi điểm) và cột của chúng (từ các điểm cũ).
+        tiles = split_table_tiles(new_points, all_points, backend.max_table_size)
+        if known_points.size: tiles += split_table_tiles(known_points, new_points, backend.max_table_size)
+        if progress: progress('matrix', done=0, total=len(tiles))
+        with ThreadPoolExecutor(max_workers=max(1, min(backend.workers, len(tiles)))) as pool:
+            futures = {pool.submit(fetch_matrix_block, backend, unique_coords, *tile): tile for tile in tiles}
+            for done, future in enumerate(as_completed(futures), 1):
+                (rows, cols), (dist_block, dur_block) = futures[future], future.result()
+                if dist_block is None: return None, None
+                distances[np.ix_(rows, cols)], durations[np.ix_(rows, cols)] = dist_block, dur_block
+                if progress: progress('matrix', done=done, total=len(tiles))
+        matrix_cache.store(generation, idx, distances, durations)
+        fetched = sum(len(rows) * len(cols) for rows, cols in tiles)
+    else:
+        fetched = 0
+        if progress: progress('matrix', done=1, total=1)
+    metrics.registry.inc('mapai_matrix_cells_total', fetched, source='backend')
+    metrics.registry.inc('mapai_matrix_cells_total', len(unique_keys) ** 2 - fetched, source='cache')
+    position = {k: i for i, k in enumerate(unique_keys)}
+    inverse = np.array([position[k] for k in keys], dtype=np.intp)
+    if len(inverse) == len(unique_keys): return distances, durations
+    return distances[np.ix_(inverse, inverse)], durations[np.ix_(inverse, inverse)]
+
 def calculate_total_distance(path_indices, dist_matrix):
     """Tính tổng quãng đường cho một lộ trình."""
-    total_dist = 0
-    for i in range(len(path_indices) - 1):
-        total_dist += dist_matrix[path_indices[i]][path_indices[i+1]]
-    return total_dist
+    path = np.asarray(path_indices)
+    return float(np.asarray(dist_matrix, dtype=float)[path[:-1], path[1:]].sum())
+
+class SolverCore:
+    """Nạp ma trận một lần vào mảng NumPy và cải thiện lộ trình tại chỗ bằng đánh giá delta O(1).
+
+    Lộ trình luôn có dạng [0, ..., 0]. Mỗi điểm có danh sách ứng viên (các điểm gần nhất) và một
+    "don't-look bit": chỉ những điểm nằm trong hàng đợi mới được xét lại sau mỗi lần cải thiện.
+    """
+    def __init__(self, dist_matrix, num_neighbors=SOLVER_NEIGHBORS):
+        self.matrix = np.asarray(dist_matrix, dtype=float)
+        self.n = len(self.matrix)
+        # Cạnh không đi được (inf) được thay bằng chi phí phạt hữu hạn để phép trừ delta không sinh NaN.
+        self.dist = np.where(np.isfinite(self.matrix), self.matrix, BLOCKED_EDGE_COST)
+        self._d = self.dist.item
+        k = min(num_neighbors, self.n - 1)
+        if k <= 0:
+            self.neighbors = [[] for _ in range(self.n)]
+        else:
+            closeness = self.dist + self.dist.T
+            np.fill_diagonal(closeness, np.inf)
+            nearest = np.argpartition(closeness, k - 1, axis=1)[:, :k]
+            order = np.take_along_axis(closeness, nearest, axis=1).argsort(axis=1, kind='stable')
+            self.neighbors = np.take_along_axis(nearest, order, axis=1).tolist()
+
+    def cost(self, path):
+        path = np.asarray(path)
+        return float(self.dist[path[:-1], path[1:]].sum())
+
+    def _prefix_sums(self, path):
+        """Tổng tích lũy chiều đi (F) và chiều ngược (R) để tính chi phí đảo đoạn trong O(1) với ma trận bất đối xứng."""
+        arr = np.asarray(path)
+        forward = np.concatenate(([0.0], np.cumsum(self.dist[arr[:-1], arr[1:]])))
+        backward = np.concatenate(([0.0], np.cumsum(self.dist[arr[1:], arr[:-1]])))
+        return forward.tolist(), backward.tolist()
+
+    # --- Các bước di chuyển (trả về (delta, move) tốt nhất quanh điểm a) ---
+
+    def _best_2opt(self, a, p, pos, sums, first=1):
+        """Đảo đoạn p[i..j]: hai cạnh mới p[i-1]->p[j] và p[i]->p[j+1]."""
+        d, n = self._d, len(p) - 1
+        forward, backward = sums
+        best_delta, best_move = -SOLVER_EPS, None
+        for c in self.neighbors[a]:
+            pa, pc = pos[a], pos[c]
+            pa_end, pc_end = (n if a == 0 else pa), (n if c == 0 else pc)
+            candidates = []
+            if pc > pa + 1: candidates.append((pa + 1, pc))              # a = p[i-1], c = p[j]
+            if pa > pc + 1: candidates.append((pc + 1, pa))              # c = p[i-1], a = p[j]
+            if a != 0 and pc_end - 1 > pa: candidates.append((pa, pc_end - 1))  # a = p[i], c = p[j+1]
+            if c != 0 and pa_end - 1 > pc: candidates.append((pc, pa_end - 1))  # c = p[i], a = p[j+1]
+            for i, j in candidates:
+                if i < first: continue
+                delta = (d(p[i - 1], p[j]) + d(p[i], p[j + 1]) - d(p[i - 1], p[i]) - d(p[j], p[j + 1])
+                         + (backward[j] - backward[i]) - (forward[j] - forward[i]))
+                if delta < best_delta: best_delta, best_move = delta, ('2opt', i, j)
+        return best_delta, best_move
+
+    def _best_or_opt(self, a, p, pos, first=1):
+        """Chuyển đoạn 1-3 điểm chứa a (giữ nguyên chiều) tới sau một điểm ứng viên."""
+        d, n = self._d, len(p) - 1
+        best_delta, best_move = -SOLVER_EPS, None
+        if a == 0: return best_delta, best_move
+        pa = pos[a]
+        for length in (1, 2, 3):
+            for i in {pa, pa - length + 1}:
+                last = i + length - 1
+                if i < first or last > n - 1: continue
+                prev, head, tail, nxt = p[i - 1], p[i], p[last], p[last + 1]
+                removed = d(prev, nxt) - d(prev, head) - d(tail, nxt)
+                targets = set(self.neighbors[head])
+                targets.update(p[pos[c] - 1] if c != 0 else p[n - 1] for c in self.neighbors[tail])
+                for c in targets:
+                    q = pos[c]
+                    if i - 1 <= q <= last or q < first - 1: continue
+                    c_next = p[q + 1]
+                    delta = removed + d(c, head) + d(tail, c_next) - d(c, c_next)
+                    if delta < best_delta: best_delta, best_move = delta, ('oropt', i, last + 1, q)
+        return best_delta, best_move
+
+    def _best_3opt(self, a, p, pos, first=1):
+        """Đổi chỗ hai đoạn liền kề p[i:j] và p[j:k] (3-Opt không đảo chiều): A->D, E->B, C->F."""
+        d, n = self._d, len(p) - 1
+        best_delta, best_move = -SOLVER_EPS, None
+        pa = pos[a]
+        if pa > n - 2 or pa + 1 < first: return best_delta, best_move
+        i = pa + 1
+        A, B = a, p[i]
+        for D in self.neighbors[A]:
+            j = pos[D]
+            if D == 0 or j <= i: continue
+            C = p[j - 1]
+            gain_ad = d(A, D) - d(A, B) - d(C, D)
+            for E in self.neighbors[B]:
+                if E == 0: continue
+                k = pos[E] + 1
+                if k <= j: continue
+                F = p[k]
+                delta = gain_ad + d(E, B) + d(C, F) - d(E, F)
+                if delta < best_delta: best_delta, best_move = delta, ('3opt', i, j, k)
+        return best_delta, best_move
+
+    def _apply(self, move, p):
+        """Áp dụng bước di chuyển tại chỗ, trả về đoạn vị trí [lo, hi] bị thay đổi."""
+        kind = move[0]
+        if kind == '2opt':
+            _, i, j = move
+            p[i:j + 1] = p[i:j + 1][::-1]
+            return i, j
+        if kind == 'oropt':
+            _, i, end, q = move
+            segment = p[i:end]
+            if q < i:
+                p[q + 1 + len(segment):end] = p[q + 1:i]
+                p[q + 1:q + 1 + len(segment)] = segment
+                return q + 1, end - 1
+            p[i:q + 1 - len(segment)] = p[end:q + 1]
+            p[q + 1 - len(segment):q + 1] = segment
+            return i, q
+        _, i, j, k = move
+        p[i:k] = p[j:k] + p[i:j]
+        return i, k - 1
+
+    def scan_2opt(self, path, progress=None):
+        """2-Opt cải thiện đầu tiên, quét mọi cặp (i, j) theo đúng thứ tự của phiên bản trước đây nên cho cùng kết quả
+        trên ma trận đối xứng; dùng cho bài nhỏ (SOLVER_SCAN_MAX_LOCATIONS), mỗi bước vẫn được đánh giá bằng delta O(1).
+
+        Với ma trận bất đối xứng, delta tính thêm chi phí đổi chiều của đoạn bị đảo.
+        """
+        d, p, size = self._d, path, len(path)
+        symmetric = np.array_equal(self.dist, self.dist.T)
+        sums, current_cost = None if symmetric else self._prefix_sums(p), self.cost(p) if progress else 0.0
+        improved, iterations, improvements = True, 0, 0
+        while improved:
+            improved = False
+            iterations += 1
+            for i in range(1, size - 2):
+                for j in range(i + 2, size):
+                    # Đảo đoạn p[i..j-1]: hai cạnh mới p[i-1]->p[j-1] và p[i]->p[j].
+                    new, old = d(p[i - 1], p[j - 1]) + d(p[i], p[j]), d(p[i - 1], p[i]) + d(p[j - 1], p[j])
+                    if symmetric:
+                        if not new < old: continue
+                        delta = new - old
+                    else:
+                        forward, backward = sums
+                        delta = new - old + (backward[j - 1] - backward[i]) - (forward[j - 1] - forward[i])
+                        if not delta < -SOLVER_EPS: continue
+                    p[i:j] = p[i:j][::-1]
+                    improved = True
+                    improvements += 1
+                    if not symmetric: sums = self._prefix_sums(p)
+                    if progress:
+                        current_cost += delta
+                        progress(current_cost)
+        metrics.registry.inc('mapai_solver_iterations_total', iterations, solver='scan_2opt')
+        metrics.registry.inc('mapai_solver_improvements_total', improvements, solver='scan_2opt')
+        return p
+
+    def local_search(self, path, moves=('2opt', 'oropt'), active=None, progress=None, deadline=None, first=1):
+        """Tìm kiếm cục bộ tại chỗ trên path (cải thiện tốt nhất quanh mỗi điểm trong hàng đợi).
+
+        Các vị trí trước first được giữ nguyên (ví dụ đoạn tài xế đã đi qua khi sửa lộ trình).
+        """
+        p, n = path, len(path) - 1
+        if n < 3: return p
+        pos = [0] * self.n
+        for idx in range(n): pos[p[idx]] = idx
+        sums, current_cost = None, self.cost(p) if progress else 0.0
+        queue = deque(p[:-1] if active is None else active)
+        queued = [False] * self.n
+        for node in queue: queued[node] = True
+        iterations = improvements = 0
+        # Với ma trận bất đối xứng, một bước 2-Opt đổi chiều cả đoạn nên chi phí của các bước quanh những điểm không nằm
+        # trong hàng đợi cũng thay đổi: khi hàng đợi cạn thì xét lại mọi điểm, tới khi một lượt không còn cải thiện nào.
+        sweep = '2opt' in moves and not np.array_equal(self.dist, self.dist.T)
+        swept_at = None
+        while queue or (sweep and improvements != swept_at):
+            if deadline and time.time() >= deadline: break
+            if not queue:
+                swept_at = improvements
+                queue.extend(p[:-1])
+                for node in queue: queued[node] = True
+            a = queue.popleft()
+            queued[a] = False
+            iterations += 1
+            best_delta, best_move = -SOLVER_EPS, None
+            for kind in moves:
+                if kind == '2opt':
+                    if sums is None: sums = self._prefix_sums(p)
+                    delta, move = self._best_2opt(a, p, pos, sums, first)
+                elif kind == 'oropt':
+                    delta, move = self._best_or_opt(a, p, pos, first)
+                else:
+                    delta, move = self._best_3opt(a, p, pos, first)
+                if delta < best_delta: best_delta, best_move = delta, move
+            if best_move is None: continue
+            improvements += 1
+            lo, hi = self._apply(best_move, p)
+            for idx in range(lo, hi + 1): pos[p[idx]] = idx
+            sums = None
+            for node in (p[lo - 1], p[lo], p[hi], p[hi + 1], a):
+                if not queued[node]:
+                    queued[node] = True
+                    queue.append(node)
+            if progress:
+                current_cost += best_delta
+                progress(current_cost)
+        metrics.registry.inc('mapai_solver_iterations_total', iterations, solver='local_search')
+        metrics.registry.inc('mapai_solver_improvements_total', improvements, solver='local_search')
+        return p
+
+    def _random_move(self, p, pos, rng):
+        """Một bước SA ngẫu nhiên quanh danh sách ứng viên: đặt p[i] ngay sau/trước một điểm gần nó, bằng cách đổi chỗ
+        ('swap', i, j) hoặc chèn lại ('relocate', i, j: chèn p[i] vào sau p[j]). Trả về (delta, bước) hoặc None."""
+        d, n = self._d, len(p) - 1
+        i = rng.randrange(1, n)
+        x = p[i]
+        c = rng.choice(self.neighbors[x])
+        if rng.random() < 0.5:
+            j = pos[c] + 1 if c != 0 else rng.randrange(1, n)
+            if j == i or j >= n: return None
+            if i > j: i, j = j, i
+            x, y = p[i], p[j]
+            if j == i + 1:
+                a, b = p[i - 1], p[j + 1]
+                delta = d(a, y) + d(y, x) + d(x, b) - d(a, x) - d(x, y) - d(y, b)
+            else:
+                a1, b1, a2, b2 = p[i - 1], p[i + 1], p[j - 1], p[j + 1]
+                delta = (d(a1, y) + d(y, b1) + d(a2, x) + d(x, b2)) - (d(a1, x) + d(x, b1) + d(a2, y) + d(y, b2))
+            return delta, ('swap', i, j)
+        j = (pos[c] if rng.random() < 0.5 else pos[c] - 1) if c != 0 else rng.choice((0, n - 1))
+        if j in (i, i - 1) or j < 0: return None
+        a, b, target, target_next = p[i - 1], p[i + 1], p[j], p[j + 1]
+        delta = d(a, b) - d(a, x) - d(x, b) + d(target, x) + d(x, target_next) - d(target, target_next)
+        return delta, ('relocate', i, j)
+
+    def anneal(self, path, rng=random, temp=None, stopping_temp=None, alpha=0.995, moves_per_temp=None, progress=None, deadline=None):
+        """Simulated Annealing tại chỗ với bước đổi chỗ (swap) và chèn lại (relocate) quanh danh sách ứng viên, chi phí tính theo delta.
+
+        Mặc định nhiệt độ ban đầu được chọn theo chính bài toán (initial_temperature trên SA_TEMP_SAMPLES bước thử
+        từ lộ trình ban đầu) và SA dừng khi nhiệt độ đã giảm SA_COOLING_RATIO lần.
+        """
+        p, n = path, len(path) - 1
+        if n < 3: return p
+        pos = [0] * self.n
+        for idx in range(n): pos[p[idx]] = idx
+        moves_per_temp = moves_per_temp or max(1, min(n, SA_MAX_MOVES_PER_TEMP))
+        if temp is None:
+            samples = (self._random_move(p, pos, rng) for _ in range(SA_TEMP_SAMPLES))
+            # Chỉ xét các bước làm xấu đi: từ lộ trình ngẫu nhiên, khoảng một nửa số bước thử đã là cải thiện.
+            temp = initial_temperature([sample[0] for sample in samples if sample and sample[0] > 0], SA_INITIAL_ACCEPTANCE)
+        if stopping_temp is None: stopping_temp = temp / SA_COOLING_RATIO
+        current_cost = self.cost(p)
+        best_solution, best_cost = p[:], current_cost
+        temperatures = tried = accepted = improvements = 0
+        while temp > stopping_temp:
+            if deadline and time.time() >= deadline: break
+            temperatures += 1
+            for _ in range(moves_per_temp):
+                sample = self._random_move(p, pos, rng)
+                if sample is None: continue
+                delta, (kind, i, j) = sample
+                tried += 1
+                if delta < 0 or rng.uniform(0, 1) < math.exp(-delta / temp):
+                    accepted += 1
+                    if kind == 'swap':
+                        p[i], p[j] = p[j], p[i]
+                        pos[p[i]], pos[p[j]] = i, j
+                    else:
+                        x = p.pop(i)
+                        p.insert(j + 1 if j < i else j, x)
+                        for idx in range(min(i, j + 1), max(i, j) + 1): pos[p[idx]] = idx
+                    current_cost += delta
+                    if current_cost < best_cost - SOLVER_EPS:
+                        best_solution, best_cost = p[:], current_cost
+                        improvements += 1
+            temp *= alpha
+            if progress: progress(best_cost)
+        p[:] = best_solution
+        record_annealing('sa', temperatures, tried, accepted, improvements)
+        return p
+
+def record_annealing(solver, temperatures, tried, accepted, improvements):
+    """Ghi số liệu của một lần chạy SA (tỷ lệ chấp nhận = accepted / (accepted + rejected))."""
+    metrics.registry.inc('mapai_solver_iterations_total', temperatures, solver=solver)
+    metrics.registry.inc('mapai_solver_improvements_total', improvements, solver=solver)
+    metrics.registry.inc('mapai_sa_moves_total', accepted, solver=solver, outcome='accepted')
+    metrics.registry.inc('mapai_sa_moves_total', tried - accepted, solver=solver, outcome='rejected')
+
+def initial_temperature(deltas, acceptance):
+    """Nhiệt độ T để tỷ lệ chấp nhận Metropolis trung bình của các bước thử (mức tăng chi phí deltas, 0 nếu
+    không làm xấu đi) bằng acceptance; tìm bằng chia đôi theo log T vì tỷ lệ này tăng dần theo T."""
+    worse = np.asarray([delta for delta in deltas if delta > 0], dtype=float)
+    if len(worse) == 0: return 1.0
+    rate = lambda temp: (len(deltas) - len(worse) + np.exp(-worse / temp).sum()) / len(deltas)
+    low, high = math.log(worse.min()) - 10, math.log(worse.max()) + 10
+    if rate(math.exp(low)) >= acceptance: return math.exp(low)
+    for _ in range(60):
+        middle = (low + high) / 2
+        if rate(math.exp(middle)) < acceptance: low = middle
+        else: high = middle
+    return math.exp(high)
+
+def as_solver_core(dist_matrix):
+    """Dùng lại SolverCore nếu đã có, ngược lại nạp ma trận vào một core mới."""
+    return dist_matrix if isinstance(dist_matrix, SolverCore) else SolverCore(dist_matrix)
 
 def run_nearest_neighbor(dist_matrix):
     """Chạy thuật toán Nearest Neighbor."""
-    num_locations = len(dist_matrix)
+    matrix = dist_matrix.matrix if isinstance(dist_matrix, SolverCore) else np.asarray(dist_matrix, dtype=float)
+    num_locations = len(matrix)
     start_node, current_node = 0, 0
-    unvisited = list(range(1, num_locations))
+    visited = np.zeros(num_locations, dtype=bool)
+    visited[start_node] = True
     path_indices = [start_node]
-    while unvisited:
-        reachable_nodes = {node: dist_matrix[current_node][node] for node in unvisited if dist_matrix[current_node][node] != float('inf')}
-        if not reachable_nodes: raise ValueError("Đồ thị không liên thông, không thể tìm thấy đường đi.")
-        nearest_node = min(reachable_nodes, key=reachable_nodes.get)
+    for _ in range(num_locations - 1):
+        distances = np.where(visited, np.inf, matrix[current_node])
+        nearest_node = int(np.argmin(distances))
+        if distances[nearest_node] == float('inf'): raise ValueError("Đồ thị không liên thông, không thể tìm thấy đường đi.")
         current_node = nearest_node
+        visited[current_node] = True
         path_indices.append(current_node)
-        unvisited.remove(nearest_node)
     path_indices.append(start_node)
     return path_indices
 
-def apply_2_opt(path_indices, dist_matrix):
-    """Áp dụng thuật toán 2-Opt để cải thiện lộ trình."""
-    best_path = path_indices[:]
-    improved = True
-    while improved:
-        improved = False
-        for i in range(1, len(best_path) - 2):
-            for j in range(i + 1, len(best_path)):
-                if j == i + 1: continue
-                current_dist = dist_matrix[best_path[i-1]][best_path[i]] + dist_matrix[best_path[j-1]][best_path[j]]
-                new_dist = dist_matrix[best_path[i-1]][best_path[j-1]] + dist_matrix[best_path[i]][best_path[j]]
-                if new_dist < current_dist:
-                    best_path[i:j] = best_path[j-1:i-1:-1]
-                    improved = True
-    return best_path
+def apply_2_opt(path_indices, dist_matrix, progress=None):
+    """Áp dụng thuật toán 2-Opt để cải thiện lộ trình (bài nhỏ: quét toàn bộ, bài lớn: danh sách ứng viên + don't-look bits)."""
+    core = as_solver_core(dist_matrix)
+    if core.n <= SOLVER_SCAN_MAX_LOCATIONS: return core.scan_2opt(list(path_indices), progress=progress)
+    return core.local_search(list(path_indices), moves=('2opt',), progress=progress)
 
-def run_sa_solver(dist_matrix):
+def run_sa_solver(dist_matrix, progress=None):
     """Chạy thuật toán Simulated Annealing."""
-    num_locations = len(dist_matrix)
+    core = as_solver_core(dist_matrix)
+    num_locations = core.n
     # SỬA LỖI: Xử lý trường hợp có ít hơn 2 điểm giao hàng
     if num_locations < 3:
-        return run_nearest_neighbor(dist_matrix)
-
-    current_solution = list(range(1, num_locations))
-    random.shuffle(current_solution)
-    current_solution = [0] + current_solution + [0]
-    current_cost = calculate_total_distance(current_solution, dist_matrix)
-    best_solution, best_cost = current_solution[:], current_cost
-    temp, stopping_temp, alpha = 10000, 1, 0.995
-    while temp > stopping_temp:
-        i, j = random.sample(range(1, num_locations), 2)
-        neighbor_solution = current_solution[:]
-        neighbor_solution[i], neighbor_solution[j] = neighbor_solution[j], neighbor_solution[i]
-        neighbor_cost = calculate_total_distance(neighbor_solution, dist_matrix)
-        cost_diff = neighbor_cost - current_cost
-        if cost_diff < 0 or random.uniform(0, 1) < math.exp(-cost_diff / temp):
-            current_solution, current_cost = neighbor_solution[:], neighbor_cost
-            if current_cost < best_cost:
-                best_solution, best_cost = current_solution[:], current_cost
-        temp *= alpha
-    return best_solution
+        return run_nearest_neighbor(core)
+
+    # Bắt đầu từ lộ trình Nearest Neighbor: với vài nghìn điểm, số bước SA có hạn không đủ để sửa một lộ trình ngẫu nhiên.
+    return core.anneal(run_nearest_neighbor(core), progress=progress)
+
+def run_2_opt_solver(dist_matrix, progress=None):
+    """Chạy Nearest Neighbor rồi cải thiện bằng 2-Opt."""
+    core = as_solver_core(dist_matrix)
+    return apply_2_opt(run_nearest_neighbor(core), core, progress=progress)
 
-def run_3_opt_solver(dist_matrix):
+def run_3_opt_solver(dist_matrix, progress=None):
     """Chạy thuật toán 3-Opt."""
-    initial_path = run_nearest_neighbor(dist_matrix)
+    core = as_solver_core(dist_matrix)
+    initial_path = run_nearest_neighbor(core)
     if len(initial_path) < 6: # 3-Opt cần ít nhất 6 điểm để có ý nghĩa
         return initial_path
+    return core.local_search(initial_path, moves=('2opt', '3opt'), progress=progress)
 
-    best_path = initial_path
-    improved = True
-    while improved:
-        improved = False
-        for i in range(1, len(best_path) - 4):
-            for j in range(i + 2, len(best_path) - 2):
-                for k in range(j + 2, len(best_path)):
-                    if k == len(best_path) -1: continue
-                    A, B, C, D, E, F = best_path[i-1], best_path[i], best_path[j-1], best_path[j], best_path[k-1], best_path[k]
-                    d0 = dist_matrix[A][B] + dist_matrix[C][D] + dist_matrix[E][F]
-                    d1 = dist_matrix[A][D] + dist_matrix[E][B] + dist_matrix[C][F]
-                    if d1 < d0:
-                        new_path = best_path[:i] + best_path[j:k] + list(reversed(best_path[i:j])) + best_path[k:]
-                        best_path, improved = new_path, True
-                        break
-                if improved: break
-            if improved: break
-    return best_path
+# --- Chạy song song ---
+
+DISTANCE_ALGORITHMS = {"NN + 2-Opt": run_2_opt_solver, "NN + 3-Opt": run_3_opt_solver, "Simulated Annealing": run_sa_solver}
+
+class SharedMatrix:
+    """Đặt ma trận vào bộ nhớ dùng chung để các tiến trình worker đọc mà không phải pickle qua pipe."""
+    def __init__(self, matrix):
+        matrix = np.ascontiguousarray(matrix, dtype=float)
+        self._shm = shared_memory.SharedMemory(create=True, size=max(1, matrix.nbytes))
+        np.ndarray(matrix.shape, dtype=float, buffer=self._shm.buf)[...] = matrix
+        self.spec = (self._shm.name, matrix.shape)
+
+    def __enter__(self):
+        return self.spec
+
+    def __exit__(self, *exc_info):
+        self._shm.close()
+        self._shm.unlink()
+
+def load_shared_matrix(spec):
+    """Đọc (bản sao riêng của) ma trận từ bộ nhớ dùng chung trong tiến trình worker."""
+    name, shape = spec
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return np.ndarray(shape, dtype=float, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+
+solver_pool = None
+solver_pool_lock = threading.Lock()
+
+def get_solver_pool():
+    """Pool tiến trình dùng chung cho các thuật toán chạy song song (khởi tạo khi cần)."""
+    global solver_pool
+    with solver_pool_lock:
+        if solver_pool is None: solver_pool = ProcessPoolExecutor(max_workers=SOLVER_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return solver_pool
+
+def run_with_metrics(function, *args):
+    """Chạy function trong tiến trình của solver pool, trả kèm số liệu đo được để tiến trình gọi gộp lại (collect_result)."""
+    return function(*args), metrics.registry.drain()
+
+def collect_result(future):
+    result, delta = future.result()
+    metrics.registry.merge(delta)
+    return result
+
+def use_parallel_solvers(num_locations):
+    # Worker của pool công việc đã là một tiến trình riêng: chạy tuần tự để không chiếm thêm lõi CPU.
+    return SOLVER_WORKERS > 1 and not IN_JOB_WORKER and num_locations >= PARALLEL_SOLVE_MIN_LOCATIONS
+
+def run_timed_algorithm(name, dist_matrix, progress=None):
+    """Chạy một thuật toán của chế độ quãng đường, trả về (lộ trình, thời gian xử lý ms)."""
+    start_time = time.time()
+    path_indices = DISTANCE_ALGORITHMS[name](dist_matrix, progress=progress)
+    return path_indices, (time.time() - start_time) * 1000
+
+def run_timed_algorithm_shared(name, matrix_spec):
+    """Như run_timed_algorithm nhưng đọc ma trận từ bộ nhớ dùng chung (chạy trong solver pool)."""
+    return run_timed_algorithm(name, SolverCore(load_shared_matrix(matrix_spec)))
+
+def run_distance_algorithms(dist_matrix, progress=None):
+    """Chạy cả ba thuật toán (song song trên nhiều lõi nếu có thể); trả về {tên: (lộ trình, thời gian ms)}."""
+    progress = progress or (lambda stage, **info: None)
+    names, timed = list(DISTANCE_ALGORITHMS), {}
+    if use_parallel_solvers(len(dist_matrix)):
+        with SharedMatrix(dist_matrix) as matrix_spec:
+            futures = {get_solver_pool().submit(run_with_metrics, run_timed_algorithm_shared, name, matrix_spec): name for name in names}
+            for done, future in enumerate(as_completed(futures), 1):
+                name = futures[future]
+                timed[name] = collect_result(future)
+                progress('solve', done=done, total=len(names), algorithm=name, best_cost=calculate_total_distance(timed[name][0], dist_matrix))
+        return timed
+    core = SolverCore(dist_matrix)
+    for index, name in enumerate(names):
+        report = lambda best_cost, name=name, index=index: progress('solve', done=index, total=len(names), algorithm=name, best_cost=best_cost)
+        timed[name] = run_timed_algorithm(name, core, progress=report)
+        progress('solve', done=index + 1, total=len(names), algorithm=name, best_cost=calculate_total_distance(timed[name][0], dist_matrix))
+    return timed
+
+def double_bridge(path, rng):
+    """Phép nhiễu double-bridge: cắt lộ trình thành A-B-C-D rồi nối lại A-C-B-D; trả về các điểm ở chỗ nối."""
+    inner = path[1:-1]
+    a, b, c = sorted(rng.sample(range(1, len(inner)), 3))
+    path[1:-1] = inner[:a] + inner[b:c] + inner[a:b] + inner[c:]
+    return [inner[a - 1], inner[a], inner[b - 1], inner[b], inner[c - 1]] + ([inner[c]] if c < len(inner) else [])
+
+def portfolio_round(core, variant, rng, best_tour, deadline, progress=None):
+    """Một lượt của portfolio: SA từ lộ trình ngẫu nhiên hoặc tìm kiếm cục bộ lặp (double-bridge) từ lời giải tốt nhất chung."""
+    if variant == 'sa':
+        tour = [0] + rng.sample(range(1, core.n), core.n - 1) + [0]
+        core.anneal(tour, rng=rng, progress=progress, deadline=deadline)
+        core.local_search(tour, progress=progress, deadline=deadline)
+    else:
+        tour = list(best_tour)
+        kicked = double_bridge(tour, rng)
+        core.local_search(tour, moves=PORTFOLIO_VARIANTS[variant], active=kicked, progress=progress, deadline=deadline)
+    return tour
+
+def portfolio_worker(matrix_spec, seed, variant, deadline, best_cost, best_tour, lock):
+    """Một worker của chế độ portfolio: lặp lại portfolio_round (seed riêng), dùng chung lời giải tốt nhất qua bộ nhớ dùng chung."""
+    core = SolverCore(load_shared_matrix(matrix_spec))
+    rng = random.Random(seed)
+    while time.time() < deadline:
+        with lock:
+            incumbent = list(best_tour)
+        tour = portfolio_round(core, variant, rng, incumbent, deadline)
+        cost = core.cost(tour)
+        with lock:
+            if cost < best_cost.value - SOLVER_EPS:
+                best_cost.value = cost
+                best_tour[:] = tour
+
+def portfolio_workers(num_locations):
+    """Số tiến trình của chế độ portfolio: 1 (chạy ngay trong tiến trình gọi) khi không nên chạy song song."""
+    return SOLVER_WORKERS if use_parallel_solvers(num_locations) else 1
+
+def run_portfolio_solver(dist_matrix, time_budget_sec, workers=None, progress=None):
+    """Chế độ portfolio: SA với nhiều seed và các biến thể tìm kiếm cục bộ chạy trên mọi lõi, dùng chung
+    lời giải tốt nhất; trả về lời giải tốt nhất tìm được khi hết thời gian.
+
+    Trong worker của pool công việc (hoặc khi chỉ có một lõi) các biến thể được chạy lần lượt ngay trong tiến trình gọi.
+    """
+    deadline = time.time() + time_budget_sec
+    core = as_solver_core(dist_matrix)
+    incumbent = run_2_opt_solver(core)
+    if core.n < 8: return incumbent
+    workers = workers or portfolio_workers(core.n)
+    variants = ['sa'] + [name for name in PORTFOLIO_VARIANTS]
+
+    def report(best_cost):
+        if progress: progress('solve', done=round(time_budget_sec - max(0.0, deadline - time.time()), 1), total=time_budget_sec, algorithm='Portfolio', best_cost=best_cost)
+
+    if workers <= 1:
+        rng, best_cost, rounds = random.Random(), core.cost(incumbent), 0
+        while time.time() < deadline:
+            variant, rounds = variants[rounds % len(variants)], rounds + 1
+            tour = portfolio_round(core, variant, rng, incumbent, deadline, progress=lambda cost: report(min(cost, best_cost)))
+            cost = core.cost(tour)
+            if cost < best_cost - SOLVER_EPS: incumbent, best_cost = tour, cost
+            report(best_cost)
+        return incumbent
+    context = multiprocessing.get_context('spawn')
+    best_cost, lock = context.Value('d', core.cost(incumbent), lock=False), context.Lock()
+    best_tour = context.Array('i', incumbent, lock=False)
+    with SharedMatrix(core.matrix) as matrix_spec:
+        processes = [context.Process(target=portfolio_worker, args=(matrix_spec, random.randrange(2**32), variants[k % len(variants)], deadline, best_cost, best_tour, lock), daemon=True)
+                     for k in range(workers)]
+        try:
+            for process in processes: process.start()
+            while time.time() < deadline and any(process.is_alive() for process in processes):
+                with lock: cost = best_cost.value
+                report(cost)
+                time.sleep(min(0.25, max(0.0, deadline - time.time())))
+            for process in processes: process.join(timeout=PORTFOLIO_JOIN_GRACE_SEC)
+        finally:
+            for process in processes:
+                if process.is_alive(): process.terminate()
+        with lock:
+            return list(best_tour)
 
 def time_str_to_seconds(time_str):
     """Chuyển đổi 'HH:MM' thành giây."""
@@ -149,123 +944,988 @@ def calculate_tsptw_cost(path_indices, duration_matrix, time_windows, start_time
         current_time = departure_time
     return current_time - start_time_sec, schedule
 
-def run_sa_solver_for_tsptw(dist_matrix, duration_matrix, time_windows, start_time_sec):
-    """Giải TSPTW bằng Simulated Annealing."""
+class TimeWindowEvaluator:
+    """Đánh giá lộ trình TSPTW bằng dữ liệu đoạn ghép được trong O(1).
+
+    Mỗi đoạn con được tóm tắt bởi (tổng thời gian, time warp, giờ bắt đầu sớm nhất, giờ bắt đầu muộn nhất):
+    time warp là tổng số giây đến trễ so với khung giờ (0 nghĩa là hợp lệ). Evaluator giữ tóm tắt của mọi
+    tiền tố và hậu tố của lộ trình hiện tại, nên một bước swap/relocate/2-opt chỉ cần ghép tiền tố, phần
+    giữa bị thay đổi (không dài quá TW_SA_MAX_SPAN điểm) và hậu tố.
+    """
+    def __init__(self, duration_matrix, time_windows, start_time_sec):
+        durations = np.asarray(duration_matrix, dtype=float)
+        self.duration = np.where(np.isfinite(durations), durations, BLOCKED_EDGE_COST)
+        self._t = self.duration.item
+        # Kho xuất phát đúng giờ start_time_sec; điểm giao hàng i có khung giờ time_windows[i-1].
+        self.earliest = [start_time_sec] + [w['earliest'] for w in time_windows]
+        self.latest = [start_time_sec] + [w['latest'] for w in time_windows]
+        self.route, self.prefix, self.suffix = None, None, None
+        self.prefix_end = self.suffix_start = 0
+
+    @staticmethod
+    def _concat(first, second, travel):
+        duration1, warp1, earliest1, latest1 = first
+        duration2, warp2, earliest2, latest2 = second
+        delta = duration1 - warp1 + travel
+        wait = max(earliest2 - delta - latest1, 0)
+        warp = max(earliest1 + delta - latest2, 0)
+        return (duration1 + duration2 + travel + wait, warp1 + warp2 + warp, max(earliest2 - delta, earliest1) - wait, min(latest2 - delta, latest1) + warp)
+
+    def _node(self, node, is_end=False):
+        # Kho ở cuối lộ trình không có khung giờ.
+        return (0, 0, 0, OPEN_TIME) if is_end else (0, 0, self.earliest[node], self.latest[node])
+
+    def load(self, route):
+        """Nạp lộ trình [0, ..., 0] và tính lại tóm tắt tiền tố/hậu tố; trả về (tổng thời gian, time warp)."""
+        last = len(route) - 1
+        self.route, self.prefix, self.suffix = route, [None] * len(route), [None] * len(route)
+        self.prefix[0], self.suffix[last] = self._node(route[0]), self._node(route[last], is_end=True)
+        # Chỉ prefix[:prefix_end+1] và suffix[suffix_start:] là đúng với lộ trình hiện tại; phần còn lại tính khi cần.
+        self.prefix_end, self.suffix_start = 0, last
+        self._extend(last, last)
+        return self.prefix[last][0], self.prefix[last][1]
+
+    def apply(self, left, nodes, right):
+        """Thay route[left+1:right] bằng nodes (cùng độ dài), thường là bước vừa được evaluate và chấp nhận.
+
+        prefix[:left+1] và suffix[right:] không đổi; các tóm tắt còn lại chỉ được tính lại khi evaluate cần
+        đến, nên các bước liên tiếp ở gần nhau không phải dựng lại cả lộ trình như load.
+        """
+        self.route[left + 1:right] = nodes
+        self.prefix_end, self.suffix_start = min(self.prefix_end, left), max(self.suffix_start, right)
+
+    def _extend(self, left, right):
+        # Tính tiếp prefix đến vị trí left và suffix từ vị trí right.
+        t, concat, route, prefix, suffix = self._t, self._concat, self.route, self.prefix, self.suffix
+        last = len(route) - 1
+        for k in range(self.prefix_end + 1, left + 1):
+            prefix[k] = concat(prefix[k - 1], self._node(route[k], is_end=(k == last)), t(route[k - 1], route[k]))
+        for k in range(self.suffix_start - 1, right - 1, -1):
+            suffix[k] = concat(self._node(route[k]), suffix[k + 1], t(route[k], route[k + 1]))
+        self.prefix_end, self.suffix_start = max(self.prefix_end, left), min(self.suffix_start, right)
+
+    def evaluate(self, left, nodes, right, penalty=0.0, bound=float('inf')):
+        """(Tổng thời gian, time warp) của lộ trình route[:left+1] + nodes + route[right:].
+
+        Thời gian và time warp chỉ tăng khi ghép thêm điểm, nên nếu chi phí phạt (duration + penalty*warp)
+        của phần đã ghép vượt bound thì dừng sớm và trả về None.
+        """
+        self._extend(left, right)
+        t, route, earliest, latest = self._t, self.route, self.earliest, self.latest
+        duration, warp, start_min, start_max = self.prefix[left]
+        previous = route[left]
+        for node in nodes:
+            # Ghép thêm một điểm (thời gian 0, khung giờ [earliest, latest]) vào cuối đoạn.
+            delta = duration - warp + t(previous, node)
+            node_earliest, node_latest = earliest[node], latest[node]
+            wait = max(node_earliest - delta - start_max, 0)
+            late = max(start_min + delta - node_latest, 0)
+            duration, warp = delta + warp + wait, warp + late
+            start_min, start_max = max(node_earliest - delta, start_min) - wait, min(node_latest - delta, start_max) + late
+            if duration + penalty * warp > bound: return None
+            previous = node
+        duration, warp, _, _ = self._concat((duration, warp, start_min, start_max), self.suffix[right], t(previous, route[right]))
+        return duration, warp
+
+    def move_nodes(self, kind, i, j):
+        """Mô tả bước di chuyển (i < j) dưới dạng (left, nodes, right) để truyền cho evaluate/apply."""
+        r = self.route
+        if kind == 'swap': return i - 1, [r[j]] + r[i + 1:j] + [r[i]], j + 1
+        if kind == 'relocate': return i - 1, r[i + 1:j + 1] + [r[i]], j + 1   # đưa r[i] ra sau r[j]
+        if kind == 'relocate_back': return i - 1, [r[j]] + r[i:j], j + 1    # đưa r[j] lên trước r[i]
+        return i - 1, r[i:j + 1][::-1], j + 1                                  # 2-opt: đảo đoạn r[i..j]
+
+    def insertion_route(self):
+        """Dựng lộ trình ban đầu bằng phép chèn ưu tiên tính hợp lệ: xét điểm theo hạn chót tăng dần và chèn
+        vào vị trí ít vi phạm khung giờ nhất, sau đó là ít tăng tổng thời gian nhất."""
+        customers = sorted(range(1, len(self.latest)), key=lambda node: (self.latest[node], self.earliest[node]))
+        route = [0, 0]
+        for node in customers:
+            self.load(route)
+            best_position, best_key = 1, None
+            for position in range(1, len(route)):
+                duration, warp = self.evaluate(position - 1, [node], position)
+                if best_key is None or (warp, duration) < best_key: best_position, best_key = position, (warp, duration)
+            route.insert(best_position, node)
+        return route
+
+def run_sa_solver_for_tsptw(dist_matrix, duration_matrix, time_windows, start_time_sec, progress=None):
+    """Giải TSPTW bằng Simulated Annealing.
+
+    Lời giải ban đầu được dựng bằng phép chèn ưu tiên tính hợp lệ. Trong quá trình tìm kiếm, lộ trình
+    vi phạm khung giờ vẫn được chấp nhận nhưng bị phạt theo time warp (hệ số phạt tự điều chỉnh);
+    chỉ lộ trình hợp lệ mới được ghi nhận là kết quả. Lịch trình chi tiết chỉ được tạo cho lộ trình cuối.
+    """
     num_locations = len(dist_matrix)
     if num_locations < 3:
         path = [0, 1, 0]
         cost, schedule = calculate_tsptw_cost(path, duration_matrix, time_windows, start_time_sec)
         return path, calculate_total_distance(path, dist_matrix), cost, schedule
 
-    current_solution = [0] + random.sample(range(1, num_locations), num_locations - 1) + [0]
-    current_cost, _ = calculate_tsptw_cost(current_solution, duration_matrix, time_windows, start_time_sec)
-    best_solution, best_cost, best_schedule = current_solution[:], current_cost, []
-    temp, stopping_temp, alpha = 10000, 1, 0.995
+    evaluator = TimeWindowEvaluator(duration_matrix, time_windows, start_time_sec)
+    current_solution = evaluator.insertion_route()
+    current_duration, current_warp = evaluator.load(current_solution)
+    best_solution, best_cost = (current_solution[:], current_duration) if current_warp <= TW_EPS else (None, float('inf'))
+    penalty, last, span = TW_PENALTY_INIT, num_locations - 1, TW_SA_MAX_SPAN
+    kinds = ('swap', 'relocate', 'relocate_back', '2opt')
+
+    def random_move():
+        i = random.randint(1, last)
+        j = random.randint(max(1, i - span), min(last, i + span))
+        return (min(i, j), max(i, j)) if i != j else None
+
+    moves_per_temp = max(1, min(num_locations, TW_SA_MAX_MOVES_PER_TEMP))
+    # Nhiệt độ theo thang chi phí của chính bài toán (giây, cộng phạt trễ giờ) thay vì một hằng số cố định.
+    current_cost, deltas = current_duration + penalty * current_warp, []
+    for _ in range(TW_SA_TEMP_SAMPLES):
+        move = random_move()
+        if move is None: continue
+        duration, warp = evaluator.evaluate(*evaluator.move_nodes(random.choice(kinds), *move), penalty)
+        deltas.append(max(0.0, duration + penalty * warp - current_cost))
+    temp = initial_temperature(deltas, TW_SA_INITIAL_ACCEPTANCE)
+    stopping_temp, alpha = temp / TW_SA_COOLING_RATIO, 0.995
+    temperatures = tried = accepted = improvements = 0
     while temp > stopping_temp:
-        i, j = random.sample(range(1, num_locations), 2)
-        neighbor_solution = current_solution[:]
-        neighbor_solution[i], neighbor_solution[j] = neighbor_solution[j], neighbor_solution[i]
-        neighbor_cost, schedule = calculate_tsptw_cost(neighbor_solution, duration_matrix, time_windows, start_time_sec)
-        if neighbor_cost < float('inf'):
-            cost_diff = neighbor_cost - current_cost
-            if cost_diff < 0 or random.uniform(0, 1) < math.exp(-cost_diff / temp):
-                current_solution, current_cost = neighbor_solution[:], neighbor_cost
-                if current_cost < best_cost:
-                    best_solution, best_cost, best_schedule = current_solution[:], current_cost, schedule
+        temperatures += 1
+        current_cost = current_duration + penalty * current_warp
+        for _ in range(moves_per_temp):
+            move = random_move()
+            if move is None: continue
+            tried += 1
+            left, nodes, right = evaluator.move_nodes(random.choice(kinds), *move)
+            # Ngưỡng chấp nhận của Metropolis được rút trước để evaluate có thể dừng sớm.
+            bound = current_cost - temp * math.log(1.0 - random.random())
+            result = evaluator.evaluate(left, nodes, right, penalty, bound)
+            if result is not None and result[0] + penalty * result[1] <= bound:
+                accepted += 1
+                evaluator.apply(left, nodes, right)
+                current_duration, current_warp = result
+                current_cost = current_duration + penalty * current_warp
+                if current_warp <= TW_EPS and current_duration < best_cost:
+                    best_solution, best_cost = current_solution[:], current_duration
+                    improvements += 1
+        # Tăng hệ số phạt khi lời giải hiện tại vi phạm khung giờ, giảm dần khi đã hợp lệ.
+        penalty = min(TW_PENALTY_MAX, penalty * 1.1) if current_warp > TW_EPS else max(TW_PENALTY_INIT, penalty * 0.95)
         temp *= alpha
-    if best_cost == float('inf'):
+        if progress: progress(best_cost)
+    record_annealing('tsptw_sa', temperatures, tried, accepted, improvements)
+    if best_solution is None:
         raise ValueError("Không tìm thấy lộ trình nào hợp lệ với các ràng buộc thời gian đã cho.")
+    best_cost, best_schedule = calculate_tsptw_cost(best_solution, duration_matrix, time_windows, start_time_sec)
     final_distance = calculate_total_distance(best_solution, dist_matrix)
     return best_solution, final_distance, best_cost, best_schedule
 
+def repair_tsptw_route(evaluator, route, first, active, deadline=None):
+    """Sửa lộ trình TSPTW tại chỗ quanh các điểm trong active: tìm kiếm cục bộ giảm time warp trước, tổng thời gian
+    sau (chi phí duration + TW_PENALTY_MAX * warp), chỉ thay đổi các vị trí từ first trở đi.
+    Trả về (tổng thời gian, time warp) của lộ trình sau khi sửa."""
+    duration, warp = evaluator.load(route)
+    last, span, penalty = len(route) - 2, TW_SA_MAX_SPAN, TW_PENALTY_MAX
+    kinds = ('swap', 'relocate', 'relocate_back', '2opt')
+
+    def candidate_moves(node):
+        # Các bước làm thay đổi cạnh kề node: node là đầu/cuối đoạn, hoặc đứng ngay trước/sau đoạn.
+        pairs = set()
+        for k in ((0, len(route) - 1) if node == 0 else (route.index(node),)):
+            pairs.update((i, j) for i in (k, k + 1) if i >= first for j in range(i + 1, min(last, i + span) + 1))
+            pairs.update((i, j) for j in (k, k - 1) if j <= last for i in range(max(first, j - span), j))
+        return [(kind, i, j) for i, j in sorted(pairs) for kind in kinds]
+
+    queue, queued = deque(active), set(active)
+    iterations = improvements = 0
+    while queue:
+        if deadline and time.time() >= deadline: break
+        node = queue.popleft()
+        queued.discard(node)
+        iterations += 1
+        cost = duration + penalty * warp
+        # Sai số tương đối: cạnh bị chặn làm chi phí lên tới hàng BLOCKED_EDGE_COST * TW_PENALTY_MAX.
+        bound = cost - TW_EPS * max(1.0, cost)
+        for kind, i, j in candidate_moves(node):
+            left, nodes, right = evaluator.move_nodes(kind, i, j)
+            result = evaluator.evaluate(left, nodes, right, penalty, bound)
+            if result is not None and result[0] + penalty * result[1] < bound:
+                evaluator.apply(left, nodes, right)
+                duration, warp = result
+                improvements += 1
+                for changed in (node, route[left], route[left + 1], route[right - 1], route[right]):
+                    if changed not in queued:
+                        queued.add(changed)
+                        queue.append(changed)
+                break
+    metrics.registry.inc('mapai_solver_iterations_total', iterations, solver='tsptw_repair')
+    metrics.registry.inc('mapai_solver_improvements_total', improvements, solver='tsptw_repair')
+    return duration, warp
+
+# --- Nhiều xe (CVRP/VRPTW) ---
+
+def route_load(route, demands):
+    """Tổng nhu cầu của các điểm trên một tuyến [0, ..., 0]."""
+    return sum(demands[node] for node in route[1:-1])
+
+def savings_routes(dist, demands, capacity, evaluator=None):
+    """Dựng các tuyến bằng thuật toán tiết kiệm Clarke-Wright.
+
+    Ban đầu mỗi điểm là một tuyến riêng; sau đó lần lượt nối cuối tuyến chứa i với đầu tuyến chứa j theo thứ
+    tự tiết kiệm d(i,0) + d(0,j) - d(i,j) giảm dần, nếu tuyến ghép không vượt tải trọng (và khung giờ).
+    """
+    n = len(dist)
+    routes = {node: [0, node, 0] for node in range(1, n)}
+    loads = {node: demands[node] for node in range(1, n)}
+    route_of = list(range(n))
+    customers = np.arange(1, n)
+    savings = dist[customers, :1] + dist[:1, customers] - dist[np.ix_(customers, customers)]
+    np.fill_diagonal(savings, -np.inf)
+    order = np.argsort(savings, axis=None, kind='stable')[::-1]
+    flat_savings = savings.ravel()
+    for index in order.tolist():
+        if flat_savings[index] <= 0: break
+        i, j = int(customers[index // (n - 1)]), int(customers[index % (n - 1)])
+        a, b = route_of[i], route_of[j]
+        if a == b or routes[a][-2] != i or routes[b][1] != j or loads[a] + loads[b] > capacity: continue
+        if evaluator is not None:
+            evaluator.load(routes[a])
+            if evaluator.evaluate(len(routes[a]) - 2, routes[b][1:-1], len(routes[a]) - 1)[1] > TW_EPS: continue
+        routes[a] = routes[a][:-1] + routes[b][1:]
+        loads[a] += loads.pop(b)
+        for node in routes.pop(b)[1:-1]: route_of[node] = a
+    return list(routes.values())
+
+def sweep_routes(coords, dist, demands, capacity, evaluator=None):
+    """Dựng các tuyến bằng thuật toán quét: xét các điểm theo góc quanh kho (bắt đầu sau khoảng trống góc lớn
+    nhất), chèn vào tuyến hiện tại ở vị trí rẻ nhất còn hợp lệ; khi không chèn được thì mở tuyến mới."""
+    depot_lat, depot_lon = coords[0]
+    angles = {node: math.atan2(lat - depot_lat, lon - depot_lon) for node, (lat, lon) in enumerate(coords) if node}
+    order = sorted(angles, key=angles.get)
+    gaps = [(angles[order[k]] - angles[order[k - 1]]) % (2 * math.pi) for k in range(len(order))]
+    start = max(range(len(order)), key=gaps.__getitem__)
+    order = order[start:] + order[:start]
+    d = dist.item
+    routes, route, load = [], [0, 0], 0
+    for node in order:
+        best_position, best_delta = None, float('inf')
+        if load + demands[node] <= capacity:
+            if evaluator is not None: evaluator.load(route)
+            for position in range(1, len(route)):
+                x, y = route[position - 1], route[position]
+                delta = d(x, node) + d(node, y) - d(x, y)
+                if delta < best_delta and (evaluator is None or evaluator.evaluate(position - 1, [node], position)[1] <= TW_EPS):
+                    best_position, best_delta = position, delta
+        if best_position is None:
+            routes.append(route)
+            route, load, best_position = [0, 0], 0, 1
+        route.insert(best_position, node)
+        load += demands[node]
+    routes.append(route)
+    return routes
+
+def improve_between_routes(routes, core, demands, capacity, evaluator=None):
+    """Cải thiện giữa các tuyến (sửa routes tại chỗ) bằng relocate (chuyển một điểm sang tuyến khác, cạnh một
+    điểm gần nó) và exchange (đổi chỗ hai điểm gần nhau thuộc hai tuyến), giữ ràng buộc tải trọng và khung giờ.
+    Các điểm gần nhau lấy từ danh sách ứng viên của SolverCore."""
+    d, loads = core._d, [route_load(route, demands) for route in routes]
+    evaluators, position = [None] * len(routes), {}
+
+    def reload(r):
+        for k, node in enumerate(routes[r][1:-1], 1): position[node] = (r, k)
+        if evaluator is not None:
+            evaluators[r] = copy.copy(evaluator)
+            evaluators[r].load(routes[r])
+
+    def fits(r, left, nodes, right):
+        return evaluators[r] is None or evaluators[r].evaluate(left, nodes, right)[1] <= TW_EPS
+
+    for r in range(len(routes)): reload(r)
+    improved = True
+    while improved:
+        improved = False
+        for u in range(1, core.n):
+            a, p = position[u]
+            route_a = routes[a]
+            prev_u, next_u = route_a[p - 1], route_a[p + 1]
+            removal_gain = d(prev_u, u) + d(u, next_u) - d(prev_u, next_u)
+            best_delta, best_move = -SOLVER_EPS, None
+            for v in core.neighbors[u]:
+                if v == 0 or position[v][0] == a: continue
+                b, q = position[v]
+                route_b = routes[b]
+                if loads[b] + demands[u] <= capacity:
+                    for left in (q - 1, q):
+                        x, y = route_b[left], route_b[left + 1]
+                        delta = d(x, u) + d(u, y) - d(x, y) - removal_gain
+                        if delta < best_delta and fits(b, left, [u], left + 1) and fits(a, p - 1, [], p + 1):
+                            best_delta, best_move = delta, ('relocate', b, left + 1, v)
+                if loads[a] - demands[u] + demands[v] <= capacity and loads[b] - demands[v] + demands[u] <= capacity:
+                    prev_v, next_v = route_b[q - 1], route_b[q + 1]
+                    delta = (d(prev_u, v) + d(v, next_u) - d(prev_u, u) - d(u, next_u)
+                             + d(prev_v, u) + d(u, next_v) - d(prev_v, v) - d(v, next_v))
+                    if delta < best_delta and fits(a, p - 1, [v], p + 1) and fits(b, q - 1, [u], q + 1):
+                        best_delta, best_move = delta, ('exchange', b, q, v)
+            if best_move is None: continue
+            kind, b, q, v = best_move
+            if kind == 'relocate':
+                route_a.pop(p)
+                routes[b].insert(q, u)
+                loads[a], loads[b] = loads[a] - demands[u], loads[b] + demands[u]
+            else:
+                route_a[p], routes[b][q] = v, u
+                loads[a], loads[b] = loads[a] - demands[u] + demands[v], loads[b] - demands[v] + demands[u]
+            reload(a)
+            reload(b)
+            improved = True
+    routes[:] = [route for route in routes if len(route) > 2]
+    return routes
+
+def improve_vehicle_route(nodes, sub_dist, sub_duration=None, sub_windows=None, start_time_sec=None):
+    """Cải thiện một tuyến độc lập trên ma trận con (chỉ số 0 là kho, k là nodes[k]); trả về (tuyến, lịch trình).
+
+    Không có khung giờ: 2-Opt + Or-Opt của SolverCore. Có khung giờ: SA của TSPTW, giữ tuyến cũ nếu SA không
+    tìm được lịch trình hợp lệ ngắn hơn.
+    """
+    local = list(range(len(nodes))) + [0]
+    if sub_windows is None:
+        if len(nodes) > 3: local = SolverCore(sub_dist).local_search(local)
+        return [nodes[k] for k in local], None
+    duration, schedule = calculate_tsptw_cost(local, sub_duration, sub_windows, start_time_sec)
+    if len(nodes) > 2:
+        try:
+            path, _, sa_duration, sa_schedule = run_sa_solver_for_tsptw(sub_dist, sub_duration, sub_windows, start_time_sec)
+            if sa_duration <= duration: local, schedule = path, sa_schedule
+        except ValueError:
+            pass
+    return [nodes[k] for k in local], schedule
+
+def run_vrp_solver(dist_matrix, demands, capacity, num_vehicles, coords, duration_matrix=None, time_windows=None, start_time_sec=None, progress=None):
+    """Lập tuyến cho nhiều xe có tải trọng (CVRP), có thể kèm khung giờ (VRPTW).
+
+    Dựng lời giải bằng Clarke-Wright và thuật toán quét (lấy lời giải ngắn hơn trong số các lời giải đủ xe),
+    cải thiện giữa các tuyến bằng relocate/exchange, rồi cải thiện từng tuyến độc lập (song song trên nhiều
+    lõi nếu có thể). Trả về (các tuyến, lịch trình của từng tuyến hoặc None, tên thuật toán dựng).
+    """
+    progress = progress or (lambda stage, **info: None)
+    core = SolverCore(dist_matrix)
+    if max(demands) > capacity: raise ValueError("Nhu cầu của một điểm giao hàng vượt quá tải trọng của xe.")
+    evaluator = None
+    if time_windows is not None:
+        evaluator = TimeWindowEvaluator(duration_matrix, time_windows, start_time_sec)
+        for node in range(1, core.n):
+            evaluator.load([0, node, 0])
+            if evaluator.evaluate(0, [node], 2)[1] > TW_EPS: raise ValueError("Không thể đến một điểm giao hàng trong khung giờ của nó, kể cả khi đi thẳng từ kho.")
+    candidates = {'Clarke-Wright': savings_routes(core.dist, demands, capacity, evaluator), 'Sweep': sweep_routes(coords, core.dist, demands, capacity, evaluator)}
+    fitting = {name: routes for name, routes in candidates.items() if len(routes) <= num_vehicles}
+    if not fitting:
+        constraints = "tải trọng" if evaluator is None else "tải trọng và khung giờ"
+        raise ValueError(f"Cần ít nhất {min(len(routes) for routes in candidates.values())} xe để phục vụ mọi điểm với {constraints} đã cho.")
+    construction = min(fitting, key=lambda name: sum(core.cost(route) for route in fitting[name]))
+    routes = improve_between_routes(fitting[construction], core, demands, capacity, evaluator)
+    progress('solve', done=0, total=len(routes), algorithm=construction, best_cost=sum(calculate_total_distance(route, dist_matrix) for route in routes))
+
+    matrix = np.asarray(dist_matrix, dtype=float)
+    durations = None if time_windows is None else np.asarray(duration_matrix, dtype=float)
+    subproblems = []
+    for route in routes:
+        nodes = route[:-1]
+        sub = np.ix_(nodes, nodes)
+        subproblems.append((nodes, matrix[sub]) if time_windows is None else (nodes, matrix[sub], durations[sub], [time_windows[node - 1] for node in nodes[1:]], start_time_sec))
+    improved = [None] * len(routes)
+    if len(routes) > 1 and use_parallel_solvers(core.n):
+        futures = {get_solver_pool().submit(run_with_metrics, improve_vehicle_route, *args): k for k, args in enumerate(subproblems)}
+        for done, future in enumerate(as_completed(futures), 1):
+            improved[futures[future]] = collect_result(future)
+            progress('solve', done=done, total=len(routes), algorithm=f"Xe {futures[future] + 1}")
+    else:
+        for k, args in enumerate(subproblems):
+            improved[k] = improve_vehicle_route(*args)
+            progress('solve', done=k + 1, total=len(routes), algorithm=f"Xe {k + 1}")
+    return [route for route, _ in improved], [schedule for _, schedule in improved], construction
+
+# --- Lập lộ trình ---
+
+def parse_plan_form(form):
+    """Đọc dữ liệu form thành một yêu cầu lập lộ trình (dict thuần, có thể gửi sang tiến trình khác)."""
+    mode = form.get('mode', 'distance')
+    delivery_points_input = []
+    point_indices = sorted(list(set([key.split('_')[-1] for key in form if key.startswith('point_address_')])))
+    use_time_windows = mode == 'schedule' or (mode == 'vrp' and form.get('use_time_windows') == 'on')
+    for index in point_indices:
+        address = form.get(f'point_address_{index}')
+        if address:
+            point_data = {'address': address}
+            if use_time_windows:
+                point_data.update({'earliest': parse_time_of_day(form.get(f'point_earliest_{index}', '00:00')), 'latest': parse_time_of_day(form.get(f'point_latest_{index}', '23:59'))})
+            if mode == 'vrp': point_data['demand'] = parse_demand(form.get(f'point_demand_{index}', 1))
+            delivery_points_input.append(point_data)
+    plan = {'mode': mode, 'warehouse_address': form['warehouse_address'], 'start_time': parse_time_of_day(form.get('start_time', '08:00')), 'points': delivery_points_input}
+    if mode == 'portfolio': plan['time_budget'] = parse_time_budget(form.get('time_budget', PORTFOLIO_DEFAULT_BUDGET_SEC))
+    if mode == 'vrp':
+        plan.update(parse_fleet(form.get('num_vehicles'), form.get('vehicle_capacity')))
+        plan['use_time_windows'] = use_time_windows
+    return plan
+
+def parse_plan_json(data):
+    """Kiểm tra một yêu cầu lập lộ trình gửi dạng JSON (cùng cấu trúc với parse_plan_form) trước khi đưa vào hàng đợi.
+
+    Trả về bản đã chuẩn hóa (chỉ gồm các khóa mà plan_route dùng); dữ liệu sai báo ValueError.
+    """
+    if not isinstance(data, dict): raise ValueError("Dữ liệu không hợp lệ")
+    mode = data.get('mode', 'distance')
+    if mode not in PLAN_MODES: raise ValueError(f"Chế độ không hợp lệ: {mode} (chọn {', '.join(PLAN_MODES)})")
+    warehouse_address, points = data.get('warehouse_address'), data.get('points')
+    if not isinstance(warehouse_address, str) or not warehouse_address.strip(): raise ValueError("Vui lòng nhập địa chỉ kho hàng.")
+    if not isinstance(points, list) or not points: raise ValueError("Vui lòng nhập ít nhất một điểm giao hàng.")
+    use_time_windows = mode == 'schedule' or (mode == 'vrp' and data.get('use_time_windows') is True)
+    delivery_points_input = []
+    for point in points:
+        if not isinstance(point, dict) or not isinstance(point.get('address'), str) or not point['address'].strip(): raise ValueError("Điểm giao hàng phải có địa chỉ.")
+        point_data = {'address': point['address']}
+        if use_time_windows:
+            point_data.update({'earliest': parse_time_of_day(point.get('earliest', '00:00')), 'latest': parse_time_of_day(point.get('latest', '23:59'))})
+        if mode == 'vrp': point_data['demand'] = parse_demand(point.get('demand', 1))
+        delivery_points_input.append(point_data)
+    plan = {'mode': mode, 'warehouse_address': warehouse_address, 'start_time': parse_time_of_day(data.get('start_time', '08:00')), 'points': delivery_points_input}
+    if mode == 'portfolio': plan['time_budget'] = parse_time_budget(data.get('time_budget', PORTFOLIO_DEFAULT_BUDGET_SEC))
+    if mode == 'vrp':
+        plan.update(parse_fleet(data.get('num_vehicles'), data.get('vehicle_capacity')))
+        plan['use_time_windows'] = use_time_windows
+    return plan
+
+def parse_time_of_day(value):
+    """Kiểm tra giờ dạng 'HH:MM' (cho phép thêm ':SS' như ô nhập giờ của trình duyệt)."""
+    match = re.fullmatch(r'(\d{1,2}):(\d{2})(?::\d{2})?', value) if isinstance(value, str) else None
+    if match is None or int(match.group(1)) > 23 or int(match.group(2)) > 59: raise ValueError(f"Giờ không hợp lệ: {value}")
+    return value
+
+def parse_time_budget(value):
+    """Kiểm tra thời gian tối ưu (giây) của chế độ portfolio."""
+    try:
+        budget = float(value)
+    except (TypeError, ValueError):
+        raise ValueError("Thời gian tối ưu không hợp lệ.")
+    if not 1 <= budget <= PORTFOLIO_MAX_BUDGET_SEC: raise ValueError(f"Thời gian tối ưu phải từ 1 đến {PORTFOLIO_MAX_BUDGET_SEC} giây.")
+    return budget
+
+def parse_fleet(num_vehicles, vehicle_capacity):
+    """Kiểm tra số xe và tải trọng mỗi xe của chế độ nhiều xe."""
+    try:
+        num_vehicles, vehicle_capacity = int(num_vehicles), float(vehicle_capacity)
+    except (TypeError, ValueError):
+        raise ValueError("Số xe hoặc tải trọng xe không hợp lệ.")
+    if not 1 <= num_vehicles <= VRP_MAX_VEHICLES: raise ValueError(f"Số xe phải từ 1 đến {VRP_MAX_VEHICLES}.")
+    if not vehicle_capacity > 0: raise ValueError("Tải trọng xe phải lớn hơn 0.")
+    return {'num_vehicles': num_vehicles, 'vehicle_capacity': vehicle_capacity}
+
+def parse_demand(value):
+    """Kiểm tra nhu cầu (khối lượng hàng) của một điểm giao hàng."""
+    try:
+        demand = float(value)
+    except (TypeError, ValueError):
+        raise ValueError("Nhu cầu của điểm giao hàng không hợp lệ.")
+    if not demand >= 0: raise ValueError("Nhu cầu của điểm giao hàng không được âm.")
+    return demand
+
+def plan_route(plan, progress=None):
+    """Geocode, lấy ma trận và chạy các thuật toán; trả về dữ liệu để hiển thị lên template.
+
+    Kết quả có thêm 'plan_state' (ma trận và lộ trình tốt nhất) để register_plan lưu lại cho /reroute.
+
+    progress(stage, **info) được gọi ở từng giai đoạn: 'geocode' và 'matrix' (done/total),
+    'solve' (thuật toán đang chạy và chi phí tốt nhất hiện tại).
+    """
+    progress = progress or (lambda stage, **info: None)
+    mode, warehouse_address, delivery_points_input = plan['mode'], plan['warehouse_address'], plan['points']
+    all_addresses_text = [warehouse_address] + [point['address'] for point in delivery_points_input]
+    time_windows = []
+    if mode == 'schedule' or (mode == 'vrp' and plan.get('use_time_windows')):
+        time_windows = [{'earliest': time_str_to_seconds(p['earliest']), 'latest': time_str_to_seconds(p['latest'])} for p in delivery_points_input]
+
+    with metrics.timed('geocode'):
+        all_addresses_data = geocode_addresses(all_addresses_text, progress=progress)
+    if any(c is None for c in all_addresses_data): raise ValueError(f"Không thể tìm tọa độ cho địa chỉ: {all_addresses_text[all_addresses_data.index(None)]}")
+    with metrics.timed('matrix'):
+        dist_matrix, duration_matrix = get_route_info(all_addresses_data, progress=progress)
+    if dist_matrix is None: raise ConnectionError(f"Không thể lấy dữ liệu từ backend định tuyến ({get_routing_backend().name}).")
+    with metrics.timed('solve', mode=mode), metrics.profile_if_slow(f'solve-{mode}', PROFILE_SLOW_SOLVE_SEC, PROFILE_DIR, PROFILE_INTERVAL_SEC):
+        return solve_plan(plan, all_addresses_data, dist_matrix, duration_matrix, time_windows, progress)
+
+def solve_plan(plan, all_addresses_data, dist_matrix, duration_matrix, time_windows, progress):
+    """Chạy thuật toán theo chế độ của plan trên ma trận đã có; trả về dữ liệu cho template (xem plan_route)."""
+    mode, warehouse_address, delivery_points_input = plan['mode'], plan['warehouse_address'], plan['points']
+    form_data = {'kho_hang': warehouse_address, 'cac_diem_giao': delivery_points_input, 'mode': mode}
+
+    if mode == 'schedule':
+        start_time_str = plan['start_time']
+        form_data['start_time'] = start_time_str
+        solver_progress = lambda best_cost: progress('solve', done=0, total=1, algorithm='Simulated Annealing (TSPTW)', best_cost=best_cost)
+        path_indices, distance, duration, schedule = run_sa_solver_for_tsptw(dist_matrix, duration_matrix, time_windows, time_str_to_seconds(start_time_str), progress=solver_progress)
+        progress('solve', done=1, total=1, algorithm='Simulated Annealing (TSPTW)', best_cost=duration)
+        final_path = [all_addresses_data[i] for i in path_indices]
+        for i, step in enumerate(schedule):
+            if i < len(final_path) - 1: final_path[i+1]['schedule'] = step
+        plan_state = {'addresses': all_addresses_data, 'dist_matrix': dist_matrix, 'duration_matrix': duration_matrix, 'route': path_indices,
+                      'time_windows': time_windows, 'start_time_sec': time_str_to_seconds(start_time_str)}
+        return {'result_tsptw': final_path, 'distance_km': distance/1000.0, 'duration_sec': duration, 'form_data': form_data, 'all_addresses_data': all_addresses_data, 'plan_state': plan_state}
+
+    if mode == 'vrp':
+        form_data.update(start_time=plan['start_time'], num_vehicles=plan['num_vehicles'], vehicle_capacity=plan['vehicle_capacity'], use_time_windows=bool(time_windows))
+        demands = [0] + [parse_demand(point.get('demand', 1)) for point in delivery_points_input]
+        coords = [(point['lat'], point['lon']) for point in all_addresses_data]
+        start_time = time.time()
+        if time_windows:
+            routes, schedules, construction = run_vrp_solver(dist_matrix, demands, plan['vehicle_capacity'], plan['num_vehicles'], coords, duration_matrix, time_windows, time_str_to_seconds(plan['start_time']), progress=progress)
+        else:
+            routes, schedules, construction = run_vrp_solver(dist_matrix, demands, plan['vehicle_capacity'], plan['num_vehicles'], coords, progress=progress)
+        exec_time_ms = (time.time() - start_time) * 1000
+        results = []
+        for k, (route, schedule) in enumerate(zip(routes, schedules), 1):
+            path = [dict(all_addresses_data[i]) for i in route]
+            for i, step in enumerate(schedule or []): path[i + 1]['schedule'] = step
+            results.append({"name": f"Xe {k}", "path": path, "distance_km": calculate_total_distance(route, dist_matrix) / 1000.0, "load": route_load(route, demands)})
+        vrp_summary = {'construction': construction, 'vehicles_used': len(routes), 'num_vehicles': plan['num_vehicles'], 'vehicle_capacity': plan['vehicle_capacity'],
+                       'distance_km': sum(result['distance_km'] for result in results), 'exec_time_ms': exec_time_ms}
+        return {'results': results, 'vrp_summary': vrp_summary, 'form_data': form_data, 'all_addresses_data': all_addresses_data}
+
+    if mode == 'portfolio':
+        time_budget = plan['time_budget']
+        form_data['time_budget'] = time_budget
+        start_time = time.time()
+        path_indices = run_portfolio_solver(dist_matrix, time_budget, progress=progress)
+        results = [{"name": f"Portfolio ({portfolio_workers(len(dist_matrix))} lõi, {time_budget:g} giây)", "path": [all_addresses_data[i] for i in path_indices],
+                    "distance_km": calculate_total_distance(path_indices, dist_matrix) / 1000.0, "exec_time_ms": (time.time() - start_time) * 1000}]
+        plan_state = {'addresses': all_addresses_data, 'dist_matrix': dist_matrix, 'duration_matrix': duration_matrix, 'route': path_indices}
+        return {'results': results, 'form_data': form_data, 'all_addresses_data': all_addresses_data, 'plan_state': plan_state}
+
+    timed = run_distance_algorithms(dist_matrix, progress=progress)
+    results = [{"name": name, "path": [all_addresses_data[i] for i in path_indices], "distance_km": calculate_total_distance(path_indices, dist_matrix) / 1000.0, "exec_time_ms": exec_time_ms}
+               for name, (path_indices, exec_time_ms) in timed.items()]
+    results.sort(key=lambda x: x['distance_km'])
+    best_path = min((path_indices for path_indices, _ in timed.values()), key=lambda path_indices: calculate_total_distance(path_indices, dist_matrix))
+    plan_state = {'addresses': all_addresses_data, 'dist_matrix': dist_matrix, 'duration_matrix': duration_matrix, 'route': best_path}
+    return {'results': results, 'form_data': form_data, 'all_addresses_data': all_addresses_data, 'plan_state': plan_state}
+
+# --- Sửa lộ trình khi có sự cố ---
+
+class RoutePlan:
+    """Một lộ trình đã lập, giữ lại để /reroute sửa nhanh khi có sự cố.
+
+    Ma trận gốc không bao giờ bị sửa: các cạnh bị chặn và thời gian trễ nằm trong lớp phủ overlay
+    {(từ, đến): (bị chặn, số giây trễ)} và chỉ được ghi vào bản chi phí riêng của SolverCore/TimeWindowEvaluator
+    (dựng một lần cho mỗi kế hoạch). position là vị trí (trong route) của điểm tài xế vừa đi qua.
+    """
+    def __init__(self, addresses, dist_matrix, duration_matrix, route, time_windows=None, start_time_sec=None):
+        self.addresses = addresses
+        self.distances, self.durations = np.asarray(dist_matrix, dtype=float), np.asarray(duration_matrix, dtype=float)
+        self.route, self.position = list(route), 0
+        self.time_windows, self.start_time_sec = time_windows, start_time_sec
+        self.overlay = {}
+        self.lock = threading.Lock()
+        self._core, self._evaluator = None, None
+
+    @property
+    def core(self):
+        if self._core is None:
+            self._core = SolverCore(self.distances)
+            for edge in self.overlay: self._apply_overlay(*edge)
+        return self._core
+
+    @property
+    def evaluator(self):
+        if self._evaluator is None:
+            self._evaluator = TimeWindowEvaluator(self.durations, self.time_windows, self.start_time_sec)
+            for edge in self.overlay: self._apply_overlay(*edge)
+        return self._evaluator
+
+    def _apply_overlay(self, i, j):
+        blocked, delay_sec = self.overlay[(i, j)]
+        if self._core is not None: self._core.dist[i, j] = BLOCKED_EDGE_COST if blocked else self._core.matrix[i, j]
+        if self._evaluator is not None: self._evaluator.duration[i, j] = BLOCKED_EDGE_COST if blocked else self.durations[i, j] + delay_sec
+
+    def travel_time(self, i, j):
+        blocked, delay_sec = self.overlay.get((i, j), (False, 0))
+        return float('inf') if blocked else self.durations[i, j] + delay_sec
+
+    def add_incident(self, i, j, delay_sec=None, current_position=None):
+        """Ghi nhận sự cố trên cạnh i -> j (chặn hẳn nếu không có delay_sec) rồi sửa phần lộ trình chưa đi.
+
+        Nếu không cho biết vị trí tài xế, coi như tài xế đang ở điểm i khi cạnh i -> j là chặng kế tiếp của họ.
+        """
+        previous_entry, previous_position = self.overlay.get((i, j)), self.position
+        blocked, delay = previous_entry or (False, 0)
+        self.overlay[(i, j)] = (blocked or delay_sec is None, delay + (delay_sec or 0))
+        self._apply_overlay(i, j)
+        if current_position is not None:
+            self.position = min(max(self.position, int(current_position)), len(self.route) - 2)
+        else:
+            upcoming = next((k for k in range(self.position, len(self.route) - 1) if self.route[k] == i and self.route[k + 1] == j), None)
+            if upcoming is not None: self.position = upcoming
+        try:
+            self.repair([i, j])
+        except ValueError:
+            # Không sửa được: bỏ sự cố vừa thêm để kế hoạch (lộ trình, chi phí, vị trí) giữ nguyên như trước.
+            self.overlay[(i, j)] = previous_entry or (False, 0)
+            self._apply_overlay(i, j)
+            if previous_entry is None: del self.overlay[(i, j)]
+            self.position = previous_position
+            raise
+
+    def repair(self, active):
+        """Sửa đoạn lộ trình từ vị trí tài xế trở đi, bắt đầu từ các điểm trong active."""
+        route, first = self.route[:], self.position + 1
+        # Thêm các điểm của những cạnh có sự cố (từ trước) mà phần lộ trình chưa đi vẫn còn dùng.
+        remaining = route[self.position:]
+        active = [node for node in active if node in remaining]
+        active += [node for edge in zip(remaining, remaining[1:]) if edge in self.overlay for node in edge]
+        if self.time_windows is None:
+            self.core.local_search(route, active=active, first=first)
+            if self.core.cost(route[self.position:]) >= BLOCKED_EDGE_COST: raise ValueError("Không thể tìm thấy lộ trình hợp lệ khi tránh đoạn đường đã chọn.")
+        else:
+            _, warp = repair_tsptw_route(self.evaluator, route, first, active)
+            # Sửa cục bộ chưa đủ: xét lại toàn bộ phần lộ trình chưa đi.
+            if warp > TW_EPS: _, warp = repair_tsptw_route(self.evaluator, route, first, route[first:-1], deadline=time.time() + REROUTE_FULL_REPAIR_SEC)
+            if warp > TW_EPS: raise ValueError("Không thể tìm thấy lộ trình thay thế thỏa mãn các khung giờ.")
+        self.route = route
+
+    def summary(self):
+        """Dữ liệu trả về cho giao diện: lộ trình hiện tại, quãng đường, thời gian (và lịch trình nếu có khung giờ)."""
+        path = [dict(self.addresses[i]) for i in self.route]
+        total_duration = sum(self.travel_time(a, b) for a, b in zip(self.route, self.route[1:]))
+        if self.time_windows is not None:
+            total_duration, schedule = calculate_tsptw_cost(self.route, self.evaluator.duration, self.time_windows, self.start_time_sec)
+            for i, step in enumerate(schedule): path[i + 1]['schedule'] = step
+        return {'name': 'Tuyến đường thay thế', 'path': path, 'position': self.position, 'distance_km': calculate_total_distance(self.route, self.distances) / 1000.0,
+                'total_duration_text': time.strftime("%H giờ %M phút", time.gmtime(total_duration))}
+
+class PlanStore:
+    """Giữ các kế hoạch gần đây trong bộ nhớ (LRU, có hạn dùng) để /reroute tham chiếu bằng plan_id."""
+    def __init__(self, max_plans, ttl_sec):
+        self.max_plans, self.ttl_sec = max_plans, ttl_sec
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, plan):
+        plan_id = uuid.uuid4().hex
+        with self._lock:
+            self._plans[plan_id] = (plan, time.time())
+            while len(self._plans) > self.max_plans: self._plans.popitem(last=False)
+        return plan_id
+
+    def get(self, plan_id):
+        with self._lock:
+            entry = self._plans.get(plan_id)
+            if entry is None: return None
+            if time.time() - entry[1] > self.ttl_sec:
+                del self._plans[plan_id]
+                return None
+            self._plans[plan_id] = (entry[0], time.time())
+            self._plans.move_to_end(plan_id)
+            return entry[0]
+
+plan_store = PlanStore(PLAN_STORE_MAX_PLANS, PLAN_TTL_SEC)
+
+def register_plan(context):
+    """Chuyển 'plan_state' (ma trận và lộ trình tốt nhất) của kết quả lập lộ trình vào plan_store, thay bằng plan_id."""
+    state = context.pop('plan_state', None)
+    if state is not None: context['plan_id'] = plan_store.add(RoutePlan(**state))
+    return context
+
+# --- Công việc chạy nền ---
+
+JOB_STAGE_PERCENT = {'geocode': (0, 30), 'matrix': (30, 50), 'solve': (50, 99)}
+JOB_TERMINAL_STATUSES = ('done', 'failed', 'cancelled')
+
+class JobCancelled(Exception):
+    """Công việc đã bị người dùng hủy."""
+
+class JobProgress:
+    """Hàm báo tiến độ chạy trong tiến trình worker: gửi sự kiện (có giới hạn tần suất) và kiểm tra yêu cầu hủy."""
+    def __init__(self, job_id, events, cancelled, min_interval=JOB_PROGRESS_INTERVAL_SEC):
+        self.job_id, self.events, self.cancelled, self.min_interval = job_id, events, cancelled, min_interval
+        self._last_sent, self._last_stage = 0.0, None
+
+    def __call__(self, stage, done=0, total=0, **info):
+        now = time.monotonic()
+        finished_stage = total and done >= total
+        if stage == self._last_stage and not finished_stage and now - self._last_sent < self.min_interval: return
+        if self.cancelled.get(self.job_id): raise JobCancelled()
+        low, high = JOB_STAGE_PERCENT.get(stage, (0, 0))
+        percent = low + (high - low) * done / total if total else low
+        self.events.put((self.job_id, dict(info, stage=stage, done=done, total=total, percent=round(percent, 1))))
+        self._last_sent, self._last_stage = now, stage
+
+def init_job_worker():
+    """Khởi tạo tiến trình worker của pool công việc."""
+    global IN_JOB_WORKER
+    IN_JOB_WORKER = True
+
+def run_job(job_id, plan, events, cancelled):
+    """Chạy một công việc lập lộ trình trong tiến trình worker.
+
+    Khi kết thúc (kể cả lỗi), số liệu đo được và trace của công việc được gửi về tiến trình chính qua
+    hàng đợi sự kiện với job id là None.
+    """
+    progress = JobProgress(job_id, events, cancelled)
+    trace, status = metrics.Trace('job', job_id=job_id, mode=plan.get('mode')), 'failed'
+    try:
+        with metrics.tracing(trace):
+            if cancelled.get(job_id): raise JobCancelled()
+            result = plan_route(plan, progress=progress)
+        status = 'done'
+        return result
+    except JobCancelled:
+        status = 'cancelled'
+        raise
+    finally:
+        events.put((None, {'metrics': metrics.registry.drain(), 'trace': trace.to_dict(status=status)}))
+
+class JobManager:
+    """Hàng đợi công việc có giới hạn, chạy trên pool tiến trình để các thuật toán nặng CPU không tranh GIL.
+
+    Tiến độ từ worker đi qua một hàng đợi dùng chung; một luồng nền cập nhật trạng thái công việc và
+    đánh thức các luồng đang stream Server-Sent Events.
+    """
+    def __init__(self, workers, max_pending):
+        context = multiprocessing.get_context('spawn')
+        self._mp_manager = context.Manager()
+        self._events, self._cancelled = self._mp_manager.Queue(), self._mp_manager.dict()
+        self._pool = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_job_worker)
+        self.max_pending = max_pending
+        self.jobs = {}
+        self.condition = threading.Condition()
+        threading.Thread(target=self._listen, daemon=True).start()
+
+    def _listen(self):
+        while True:
+            try:
+                job_id, event = self._events.get()
+            except (EOFError, OSError):
+                return
+            if job_id is None:
+                metrics.registry.merge(event['metrics'])
+                metrics.log_trace(event['trace'], TRACE_LOG)
+                continue
+            with self.condition:
+                job = self.jobs.get(job_id)
+                if job and job['status'] not in JOB_TERMINAL_STATUSES:
+                    job['status'], job['progress'] = 'running', event
+                    job['seq'] += 1
+                    self.condition.notify_all()
+
+    def _prune(self):
+        expired = [job_id for job_id, job in self.jobs.items() if job['status'] in JOB_TERMINAL_STATUSES and time.time() - job['finished_at'] > JOB_RESULT_TTL_SEC]
+        for job_id in expired:
+            del self.jobs[job_id]
+            self._cancelled.pop(job_id, None)
+
+    def submit(self, plan):
+        """Đưa công việc vào hàng đợi; trả về job id, hoặc None nếu hàng đợi đã đầy."""
+        with self.condition:
+            self._prune()
+            if sum(1 for job in self.jobs.values() if job['status'] not in JOB_TERMINAL_STATUSES) >= self.max_pending: return None
+            job_id = uuid.uuid4().hex
+            self.jobs[job_id] = {'id': job_id, 'status': 'queued', 'progress': None, 'seq': 0, 'result': None, 'error': None,
+                                 'created_at': time.time(), 'finished_at': None, 'future': None}
+        future = self._pool.submit(run_job, job_id, plan, self._events, self._cancelled)
+        with self.condition:
+            self.jobs[job_id]['future'] = future
+        future.add_done_callback(lambda f: self._finish(job_id, f))
+        return job_id
+
+    def _finish(self, job_id, future):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if not job: return
+            if future.cancelled():
+                job['status'] = 'cancelled'
+            else:
+                error = future.exception()
+                if error is None:
+                    job['status'], job['result'] = 'done', register_plan(future.result())
+                elif isinstance(error, JobCancelled):
+                    job['status'] = 'cancelled'
+                elif isinstance(error, (ValueError, ConnectionError)):
+                    job['status'], job['error'] = 'failed', str(error)
+                else:
+                    print(f"Lỗi không xác định trong công việc {job_id}: {error!r}")
+                    job['status'], job['error'] = 'failed', 'Lỗi phía server khi tính toán lộ trình'
+            job['finished_at'] = time.time()
+            job['seq'] += 1
+            metrics.registry.inc('mapai_jobs_total', status=job['status'])
+            metrics.registry.observe('mapai_job_seconds', job['finished_at'] - job['created_at'], status=job['status'])
+            self.condition.notify_all()
+
+    def cancel(self, job_id):
+        """Hủy công việc: bỏ khỏi hàng đợi nếu chưa chạy, ngược lại báo worker dừng ở lần báo tiến độ kế tiếp."""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if not job: return False
+            if job['status'] in JOB_TERMINAL_STATUSES: return True
+            self._cancelled[job_id] = True
+            future = job['future']
+        if future is not None: future.cancel()
+        return True
+
+    def snapshot(self, job_id, include_result=False):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if not job: return None
+            data = {key: job[key] for key in ('id', 'status', 'progress', 'error')}
+            if include_result: data['result'] = job['result']
+            return data
+
+job_manager = None
+job_manager_lock = threading.Lock()
+
+def get_job_manager():
+    """Khởi tạo JobManager khi cần (tránh tạo pool tiến trình lúc import, kể cả trong tiến trình con)."""
+    global job_manager
+    with job_manager_lock:
+        if job_manager is None: job_manager = JobManager(JOB_WORKERS, JOB_QUEUE_SIZE)
+    return job_manager
+
 # --- Routes ---
 
+DEFAULT_FORM_DATA = {
+    'kho_hang': 'Bưu điện Trung tâm Sài Gòn', 'start_time': '08:00',
+    'cac_diem_giao': [
+        {'address': 'Sân bay Tân Sơn Nhất', 'earliest': '09:00', 'latest': '11:00'},
+        {'address': 'Chợ Bến Thành', 'earliest': '10:00', 'latest': '12:00'},
+        {'address': 'Dinh Độc Lập', 'earliest': '13:00', 'latest': '15:00'}
+    ], 'mode': 'distance'
+}
+
+def render_plan(context):
+    """Hiển thị kết quả lập lộ trình (có đo thời gian render template)."""
+    with metrics.timed('render'):
+        return render_template('index.html', **context)
+
+@app.before_request
+def start_request_trace():
+    g.trace = metrics.Trace('http', method=request.method, path=request.path)
+    g.trace_token = metrics.current_trace.set(g.trace)
+
+@app.after_request
+def finish_request_trace(response):
+    """Ghi histogram độ trễ theo endpoint và một dòng trace JSON cho request (trừ chính /metrics)."""
+    trace = g.get('trace')
+    if trace is None: return response
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.registry.observe('mapai_http_request_seconds', trace.elapsed(), endpoint=endpoint, method=request.method, status=str(response.status_code))
+    response.headers['X-Trace-Id'] = trace.trace_id
+    if endpoint != '/metrics': metrics.log_trace(trace.to_dict(endpoint=endpoint, status=response.status_code), TRACE_LOG)
+    return response
+
+@app.teardown_request
+def reset_request_trace(error=None):
+    token = g.pop('trace_token', None)
+    if token is not None: metrics.current_trace.reset(token)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/', methods=['GET', 'POST'])
 def home():
-    default_data = {
-        'kho_hang': 'Bưu điện Trung tâm Sài Gòn', 'start_time': '08:00',
-        'cac_diem_giao': [
-            {'address': 'Sân bay Tân Sơn Nhất', 'earliest': '09:00', 'latest': '11:00'},
-            {'address': 'Chợ Bến Thành', 'earliest': '10:00', 'latest': '12:00'},
-            {'address': 'Dinh Độc Lập', 'earliest': '13:00', 'latest': '15:00'}
-        ], 'mode': 'distance'
-    }
+    default_data = DEFAULT_FORM_DATA
     if request.method == 'POST':
         try:
-            mode = request.form.get('mode', 'distance')
-            warehouse_address = request.form['warehouse_address']
-            all_addresses_text, delivery_points_input, time_windows = [warehouse_address], [], []
-            point_indices = sorted(list(set([key.split('_')[-1] for key in request.form if key.startswith('point_address_')])))
-            for index in point_indices:
-                address = request.form.get(f'point_address_{index}')
-                if address:
-                    all_addresses_text.append(address)
-                    point_data = {'address': address}
-                    if mode == 'schedule':
-                        earliest, latest = request.form.get(f'point_earliest_{index}', '00:00'), request.form.get(f'point_latest_{index}', '23:59')
-                        point_data.update({'earliest': earliest, 'latest': latest})
-                        time_windows.append({'earliest': time_str_to_seconds(earliest), 'latest': time_str_to_seconds(latest)})
-                    delivery_points_input.append(point_data)
-            if not delivery_points_input: return render_template('index.html', error="Vui lòng nhập ít nhất một điểm giao hàng.", form_data=default_data)
-
-            all_addresses_data = [get_coords_from_address(addr) for addr in all_addresses_text]
-            if any(c is None for c in all_addresses_data): raise ValueError(f"Không thể tìm tọa độ cho địa chỉ: {all_addresses_text[all_addresses_data.index(None)]}")
-            dist_matrix, duration_matrix = get_route_info(all_addresses_data)
-            if not dist_matrix: raise ConnectionError("Không thể lấy dữ liệu từ OSRM API.")
-            
-            form_data = {'kho_hang': warehouse_address, 'cac_diem_giao': delivery_points_input, 'mode': mode}
-            
-            if mode == 'schedule':
-                start_time_str = request.form['start_time']
-                form_data['start_time'] = start_time_str
-                path_indices, distance, duration, schedule = run_sa_solver_for_tsptw(dist_matrix, duration_matrix, time_windows, time_str_to_seconds(start_time_str))
-                final_path = [all_addresses_data[i] for i in path_indices]
-                for i, step in enumerate(schedule):
-                    if i < len(final_path) - 1: final_path[i+1]['schedule'] = step
-                return render_template('index.html', result_tsptw=final_path, distance_km=distance/1000.0, duration_sec=duration, form_data=form_data, all_addresses_data=all_addresses_data)
-            else:
-                results = []
-                initial_path_nn = run_nearest_neighbor(dist_matrix)
-                start_time_2opt = time.time()
-                path_indices_2opt = apply_2_opt(initial_path_nn, dist_matrix)
-                results.append({"name": "NN + 2-Opt", "path": [all_addresses_data[i] for i in path_indices_2opt], "distance_km": calculate_total_distance(path_indices_2opt, dist_matrix) / 1000.0, "exec_time_ms": (time.time() - start_time_2opt) * 1000})
-                
-                start_time_3opt = time.time()
-                path_indices_3opt = run_3_opt_solver(dist_matrix)
-                results.append({"name": "NN + 3-Opt", "path": [all_addresses_data[i] for i in path_indices_3opt], "distance_km": calculate_total_distance(path_indices_3opt, dist_matrix) / 1000.0, "exec_time_ms": (time.time() - start_time_3opt) * 1000})
-                
-                start_time_sa = time.time()
-                path_indices_sa = run_sa_solver(dist_matrix)
-                results.append({"name": "Simulated Annealing", "path": [all_addresses_data[i] for i in path_indices_sa], "distance_km": calculate_total_distance(path_indices_sa, dist_matrix) / 1000.0, "exec_time_ms": (time.time() - start_time_sa) * 1000})
-                
-                results.sort(key=lambda x: x['distance_km'])
-                return render_template('index.html', results=results, form_data=form_data, all_addresses_data=all_addresses_data)
+            plan = parse_plan_form(request.form)
+            if not plan['points']: return render_template('index.html', error="Vui lòng nhập ít nhất một điểm giao hàng.", form_data=default_data)
+            return render_plan(register_plan(plan_route(plan)))
         except (ValueError, ConnectionError) as e:
             return render_template('index.html', error=str(e), form_data=default_data)
     return render_template('index.html', form_data=default_data)
 
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    try:
+        if request.is_json:
+            plan = parse_plan_json(request.get_json(silent=True))
+        else:
+            if 'warehouse_address' not in request.form: return jsonify({'error': 'Dữ liệu không hợp lệ'}), 400
+            plan = parse_plan_form(request.form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not plan.get('warehouse_address') or not plan.get('points'): return jsonify({'error': 'Vui lòng nhập ít nhất một điểm giao hàng.'}), 400
+    job_id = get_job_manager().submit(plan)
+    if job_id is None: return jsonify({'error': 'Hệ thống đang quá tải, vui lòng thử lại sau.'}), 503
+    return jsonify({'job_id': job_id, 'status_url': f'/jobs/{job_id}', 'events_url': f'/jobs/{job_id}/events'}), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    snapshot = get_job_manager().snapshot(job_id, include_result=True)
+    if snapshot is None: return jsonify({'error': 'Không tìm thấy công việc.'}), 404
+    return jsonify(snapshot)
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    if not get_job_manager().cancel(job_id): return jsonify({'error': 'Không tìm thấy công việc.'}), 404
+    return jsonify(get_job_manager().snapshot(job_id))
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    manager = get_job_manager()
+    if manager.snapshot(job_id) is None: return jsonify({'error': 'Không tìm thấy công việc.'}), 404
+
+    def stream():
+        seq = -1
+        while True:
+            with manager.condition:
+                job = manager.jobs.get(job_id)
+                if job is None: return
+                if job['seq'] == seq and job['status'] not in JOB_TERMINAL_STATUSES:
+                    manager.condition.wait(timeout=JOB_SSE_KEEPALIVE_SEC)
+                changed, seq = job['seq'] != seq, job['seq']
+                status, progress, error = job['status'], job['progress'], job['error']
+            if status in JOB_TERMINAL_STATUSES:
+                yield f"event: {status}\ndata: {json.dumps({'status': status, 'error': error})}\n\n"
+                return
+            yield f"event: progress\ndata: {json.dumps({'status': status, 'progress': progress})}\n\n" if changed else ": keep-alive\n\n"
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/jobs/<job_id>/view')
+def job_view(job_id):
+    snapshot = get_job_manager().snapshot(job_id, include_result=True)
+    if snapshot is None: return render_template('index.html', error="Không tìm thấy công việc (có thể đã hết hạn).", form_data=DEFAULT_FORM_DATA), 404
+    if snapshot['status'] == 'done': return render_plan(snapshot['result'])
+    error = snapshot['error'] or ("Công việc đã bị hủy." if snapshot['status'] == 'cancelled' else "Công việc chưa hoàn tất.")
+    return render_template('index.html', error=error, form_data=DEFAULT_FORM_DATA)
+
 @app.route('/reroute', methods=['POST'])
 def reroute():
+    """Sửa lộ trình của một kế hoạch (plan_id) khi có sự cố trên một chặng.
+
+    avoid_segment gồm điểm đầu/cuối của chặng (from_index/to_index, hoặc from/to theo display_name) và delay_sec
+    (tùy chọn: chỉ chậm thêm chứ không chặn hẳn). current_position (tùy chọn) là vị trí của tài xế trong lộ trình.
+    Yêu cầu cũ không có plan_id (gửi kèm all_addresses_data) sẽ tạo một kế hoạch mới.
+    """
     try:
-        data = request.get_json()
-        all_addresses_data, avoid_segment = data.get('all_addresses_data'), data.get('avoid_segment')
-        if not all_addresses_data or not avoid_segment: return jsonify({'error': 'Dữ liệu không hợp lệ'}), 400
-        dist_matrix, duration_matrix = get_route_info(all_addresses_data)
-        if not dist_matrix: raise ConnectionError("Không thể lấy dữ liệu từ OSRM API.")
-        from_idx = next((i for i, item in enumerate(all_addresses_data) if item["display_name"] == avoid_segment['from']), -1)
-        to_idx = next((i for i, item in enumerate(all_addresses_data) if item["display_name"] == avoid_segment['to']), -1)
-        if from_idx == -1 or to_idx == -1: return jsonify({'error': 'Không tìm thấy địa chỉ cần tránh.'}), 400
-        
-        modified_dist_matrix = [row[:] for row in dist_matrix]
-        modified_dist_matrix[from_idx][to_idx] = float('inf')
-        
-        initial_path_indices = run_nearest_neighbor(modified_dist_matrix)
-        final_path_indices = apply_2_opt(initial_path_indices, modified_dist_matrix)
-        final_distance = calculate_total_distance(final_path_indices, modified_dist_matrix)
-        if final_distance == float('inf'): raise ValueError("Không thể tìm thấy lộ trình hợp lệ khi tránh đoạn đường đã chọn.")
-        
-        total_duration = sum(duration_matrix[final_path_indices[i]][final_path_indices[i+1]] for i in range(len(final_path_indices) - 1))
-        response_data = {'name': 'Tuyến đường thay thế', 'path': [all_addresses_data[i] for i in final_path_indices], 'distance_km': final_distance / 1000.0, 'total_duration_text': time.strftime("%H giờ %M phút", time.gmtime(total_duration))}
+        data = request.get_json(silent=True) or {}
+        avoid_segment, plan_id = data.get('avoid_segment'), data.get('plan_id')
+        if not avoid_segment: return jsonify({'error': 'Dữ liệu không hợp lệ'}), 400
+        plan = plan_store.get(plan_id) if plan_id else None
+        if plan is None:
+            all_addresses_data = data.get('all_addresses_data')
+            if not all_addresses_data: return jsonify({'error': 'Kế hoạch không tồn tại hoặc đã hết hạn, vui lòng tối ưu lại.'}), 404
+            with metrics.timed('matrix'):
+                dist_matrix, duration_matrix = get_route_info(all_addresses_data)
+            if dist_matrix is None: raise ConnectionError(f"Không thể lấy dữ liệu từ backend định tuyến ({get_routing_backend().name}).")
+            plan = RoutePlan(all_addresses_data, dist_matrix, duration_matrix, apply_2_opt(run_nearest_neighbor(dist_matrix), dist_matrix))
+            plan_id = plan_store.add(plan)
+        from_idx, to_idx = avoid_segment.get('from_index'), avoid_segment.get('to_index')
+        if from_idx is None or to_idx is None:
+            from_idx = next((i for i, item in enumerate(plan.addresses) if item["display_name"] == avoid_segment.get('from')), -1)
+            to_idx = next((i for i, item in enumerate(plan.addresses) if item["display_name"] == avoid_segment.get('to')), -1)
+        if not all(isinstance(idx, int) and not isinstance(idx, bool) and 0 <= idx < len(plan.addresses) for idx in (from_idx, to_idx)): return jsonify({'error': 'Không tìm thấy địa chỉ cần tránh.'}), 400
+        delay_sec, current_position = avoid_segment.get('delay_sec'), data.get('current_position')
+        if delay_sec is not None and not (isinstance(delay_sec, (int, float)) and not isinstance(delay_sec, bool) and delay_sec >= 0): return jsonify({'error': 'Thời gian trễ không hợp lệ.'}), 400
+        # Chế độ khoảng cách sửa lộ trình theo quãng đường nên thời gian trễ không ảnh hưởng gì: chỉ hỗ trợ chặn hẳn.
+        if delay_sec is not None and plan.time_windows is None: return jsonify({'error': 'Lộ trình không có khung giờ chỉ hỗ trợ chặn hẳn chặng đường (không dùng delay_sec).'}), 400
+        if current_position is not None and not (isinstance(current_position, int) and not isinstance(current_position, bool)): return jsonify({'error': 'Vị trí hiện tại không hợp lệ.'}), 400
+
+        with plan.lock, metrics.timed('reroute', mode='schedule' if plan.time_windows else 'distance'):
+            plan.add_incident(from_idx, to_idx, delay_sec=delay_sec, current_position=current_position)
+            response_data = plan.summary()
+        response_data['plan_id'] = plan_id
         return jsonify(response_data)
     except (ValueError, ConnectionError) as e:
         return jsonify({'error': str(e)}), 500
@@ -274,4 +1934,5 @@ def reroute():
         return jsonify({'error': 'Lỗi phía server khi tính toán lại tuyến đường'}), 500
 
 if __name__ == '__main__':
+    get_routing_backend()  # báo lỗi cấu hình và xây CH (backend local) ngay khi khởi động thay vì ở request đầu tiên
     app.run(debug=True)
@@ -0,0 +1,332 @@
+"""Bộ benchmark ngoại tuyến cho các thuật toán giải trong app.py (không gọi Nominatim/OSRM).
+
+Ví dụ:
+    python benchmark.py --sizes 10,50,100 --output bench.json
+    python benchmark.py --tsplib berlin52.tsp --solomon rc201.1.txt --best-known best.json
+    python benchmark.py --sizes 10,50,100 --compare bench.json   # trả về mã lỗi 1 nếu có hồi quy
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import app
+
+DEFAULT_SIZES = (10, 50, 100, 200, 500, 1000, 2000)
+DEFAULT_SEED = 42
+GRID_SIZE = 10000.0          # tọa độ sinh ngẫu nhiên nằm trong hình vuông GRID_SIZE x GRID_SIZE (mét)
+TRAVEL_SPEED = 8.0           # m/s, để đổi khoảng cách thành thời gian di chuyển cho bài toán có khung giờ
+TW_WIDTH_SEC = 3600          # độ rộng khung giờ của các bài TSPTW sinh ngẫu nhiên
+START_TIME_SEC = 8 * 3600
+MIN_COMPARE_TIME_SEC = 0.01  # bỏ qua so sánh thời gian với các lần chạy quá ngắn (nhiễu đo)
+
+# --- Bài toán ---
+
+def euclidean_matrix(points):
+    points = np.asarray(points, dtype=float)
+    return np.sqrt(((points[:, None, :] - points[None, :, :]) ** 2).sum(axis=2))
+
+def make_instance(name, kind, dist, duration=None, time_windows=None, start_time_sec=None, best_known=None):
+    """Một bài toán benchmark: kind là 'tsp' hoặc 'tsptw'; nút 0 là kho."""
+    return {'name': name, 'kind': kind, 'size': len(dist), 'dist': np.asarray(dist, dtype=float), 'duration': duration,
+            'time_windows': time_windows, 'start_time_sec': start_time_sec, 'best_known': best_known}
+
+def random_points(size, rng):
+    return rng.random((size, 2)) * GRID_SIZE
+
+def clustered_points(size, rng, num_clusters=None):
+    """Các điểm tụ quanh vài tâm cụm (phân phối chuẩn), kho ở giữa bản đồ."""
+    num_clusters = num_clusters or max(2, int(math.sqrt(size) / 2))
+    centers = rng.random((num_clusters, 2)) * GRID_SIZE
+    points = centers[rng.integers(0, num_clusters, size)] + rng.normal(0, GRID_SIZE / 40, (size, 2))
+    points[0] = GRID_SIZE / 2
+    return np.clip(points, 0, GRID_SIZE)
+
+def add_time_windows(name, dist, rng, width=TW_WIDTH_SEC):
+    """Biến một bài TSP thành TSPTW chắc chắn có lời giải: đi một lộ trình ngẫu nhiên ẩn rồi đặt khung giờ
+    rộng width giây bao quanh thời điểm đến từng điểm."""
+    duration = dist / TRAVEL_SPEED
+    hidden = [0] + (rng.permutation(len(dist) - 1) + 1).tolist()
+    time_windows, current = [None] * (len(dist) - 1), START_TIME_SEC
+    for from_node, to_node in zip(hidden, hidden[1:]):
+        current += duration[from_node, to_node]
+        earliest = max(START_TIME_SEC, current - rng.random() * width)
+        time_windows[to_node - 1] = {'earliest': int(earliest), 'latest': int(math.ceil(earliest + width))}
+        current = max(current, earliest)
+    return make_instance(name, 'tsptw', dist, duration, time_windows, START_TIME_SEC)
+
+def generate_instances(sizes, seed, with_time_windows=True):
+    """Sinh các bài ngẫu nhiên đều và phân cụm (và bản có khung giờ) cho mỗi kích thước, cố định theo seed."""
+    instances = []
+    for size in sizes:
+        for kind, make_points in (('random', random_points), ('clustered', clustered_points)):
+            rng = np.random.default_rng([seed, size, len(kind)])
+            dist = euclidean_matrix(make_points(size, rng))
+            instances.append(make_instance(f'{kind}-{size}', 'tsp', dist))
+            if with_time_windows: instances.append(add_time_windows(f'{kind}-tw-{size}', dist, rng))
+    return instances
+
+# --- Đọc file bài toán ---
+
+def tsplib_distance(weight_type, a, b):
+    """Khoảng cách giữa hai điểm theo quy ước của TSPLIB."""
+    dx, dy = a[0] - b[0], a[1] - b[1]
+    if weight_type == 'EUC_2D': return float(int(math.sqrt(dx * dx + dy * dy) + 0.5))
+    if weight_type == 'CEIL_2D': return float(math.ceil(math.sqrt(dx * dx + dy * dy)))
+    if weight_type == 'ATT':
+        r = math.sqrt((dx * dx + dy * dy) / 10.0)
+        return float(int(r) + (1 if int(r + 0.5) > int(r) else 0))
+    if weight_type == 'GEO':
+        def radians(value):
+            degrees = int(value)
+            return math.pi * (degrees + 5.0 * (value - degrees) / 3.0) / 180.0
+        lat_a, lon_a, lat_b, lon_b = radians(a[0]), radians(a[1]), radians(b[0]), radians(b[1])
+        q1, q2, q3 = math.cos(lon_a - lon_b), math.cos(lat_a - lat_b), math.cos(lat_a + lat_b)
+        return float(int(6378.388 * math.acos(0.5 * ((1.0 + q1) * q2 - (1.0 - q1) * q3)) + 1.0))
+    raise ValueError(f"EDGE_WEIGHT_TYPE chưa hỗ trợ: {weight_type}")
+
+def explicit_matrix(weight_format, weights, size):
+    """Dựng ma trận đầy đủ từ EDGE_WEIGHT_SECTION (FULL_MATRIX, UPPER/LOWER_ROW, UPPER/LOWER_DIAG_ROW)."""
+    matrix, values = np.zeros((size, size)), iter(weights)
+    if weight_format == 'FULL_MATRIX': return np.array(weights[:size * size], dtype=float).reshape(size, size)
+    cells = {'UPPER_ROW': [(i, j) for i in range(size) for j in range(i + 1, size)],
+             'LOWER_ROW': [(i, j) for i in range(size) for j in range(i)],
+             'UPPER_DIAG_ROW': [(i, j) for i in range(size) for j in range(i, size)],
+             'LOWER_DIAG_ROW': [(i, j) for i in range(size) for j in range(i + 1)]}.get(weight_format)
+    if cells is None: raise ValueError(f"EDGE_WEIGHT_FORMAT chưa hỗ trợ: {weight_format}")
+    for i, j in cells: matrix[i, j] = matrix[j, i] = next(values)
+    return matrix
+
+def load_tsplib(path, best_known=None):
+    """Đọc bài TSP/ATSP theo định dạng TSPLIB; nút đầu tiên được dùng làm kho."""
+    header, coords, weights, section = {}, [], [], None
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line == 'EOF': continue
+            if line.endswith('_SECTION'):
+                section = line
+                continue
+            key, sep, value = line.partition(':')
+            if sep and re.fullmatch(r'[A-Z_]+', key.strip()):
+                header[key.strip()], section = value.strip(), None
+            elif section == 'NODE_COORD_SECTION':
+                coords.append(tuple(map(float, line.split()[1:3])))
+            elif section == 'EDGE_WEIGHT_SECTION':
+                weights.extend(map(float, line.split()))
+    size = int(header['DIMENSION'])
+    weight_type = header.get('EDGE_WEIGHT_TYPE', 'EUC_2D')
+    if weight_type == 'EXPLICIT':
+        dist = explicit_matrix(header.get('EDGE_WEIGHT_FORMAT', 'FULL_MATRIX'), weights, size)
+    else:
+        dist = np.array([[tsplib_distance(weight_type, a, b) for b in coords] for a in coords])
+    name = header.get('NAME') or os.path.splitext(os.path.basename(path))[0]
+    return make_instance(name, 'tsp', dist, best_known=best_known)
+
+def load_solomon(path, best_known=None):
+    """Đọc bài có khung giờ dạng Solomon (VRPTW) hoặc TSPTW của Dumas/Gendreau: mỗi dòng dữ liệu gồm
+    mã điểm, x, y, nhu cầu, giờ mở, giờ đóng, thời gian phục vụ (dòng mã 999 kết thúc danh sách).
+    Nhu cầu bị bỏ qua; thời gian phục vụ được cộng vào thời gian đi ra khỏi điểm."""
+    rows = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) != 7: continue
+            try:
+                values = [float(field) for field in fields]
+            except ValueError:
+                continue
+            if values[0] == 999: break
+            rows.append(values)
+    if len(rows) < 2: raise ValueError(f"Không đọc được bài toán có khung giờ từ {path}")
+    dist = euclidean_matrix([(row[1], row[2]) for row in rows])
+    duration = dist + np.array([row[6] for row in rows])[:, None]
+    np.fill_diagonal(duration, 0)
+    time_windows = [{'earliest': row[4], 'latest': row[5]} for row in rows[1:]]
+    name = os.path.splitext(os.path.basename(path))[0]
+    return make_instance(name, 'tsptw', dist, duration, time_windows, rows[0][4], best_known=best_known)
+
+# --- Chạy thuật toán ---
+
+def solve_nearest_neighbor(instance):
+    return app.run_nearest_neighbor(instance['dist'])
+
+def solve_2_opt(instance):
+    return app.apply_2_opt(app.run_nearest_neighbor(instance['dist']), instance['dist'])
+
+def solve_3_opt(instance):
+    return app.run_3_opt_solver(instance['dist'])
+
+def solve_sa(instance):
+    return app.run_sa_solver(instance['dist'])
+
+def solve_tsptw(instance):
+    return app.run_sa_solver_for_tsptw(instance['dist'], instance['duration'], instance['time_windows'], instance['start_time_sec'])[0]
+
+ALGORITHMS = {
+    'nn': ('tsp', solve_nearest_neighbor), '2opt': ('tsp', solve_2_opt), '3opt': ('tsp', solve_3_opt), 'sa': ('tsp', solve_sa),
+    'tsptw': ('tsptw', solve_tsptw),
+}
+
+def route_cost(instance, path):
+    """Chi phí của lời giải (quãng đường cho TSP, tổng thời gian cho TSPTW); None nếu lời giải không hợp lệ."""
+    size = instance['size']
+    if path is None or path[0] != 0 or path[-1] != 0 or sorted(path[:-1]) != list(range(size)): return None
+    if instance['kind'] == 'tsptw':
+        cost, _ = app.calculate_tsptw_cost(path, instance['duration'], instance['time_windows'], instance['start_time_sec'])
+    else:
+        cost = app.calculate_total_distance(path, instance['dist'])
+    return cost if math.isfinite(cost) else None
+
+def run_once(solve, instance, seed, trace_memory=False):
+    """Chạy một lần; trả về (lộ trình hoặc None nếu lỗi, thời gian giây, bộ nhớ đỉnh KiB hoặc None)."""
+    random.seed(seed)
+    if trace_memory:
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        path = solve(instance)
+    except ValueError:
+        path = None
+    elapsed = time.perf_counter() - start
+    peak_kb = None
+    if trace_memory:
+        peak_kb = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+    return path, elapsed, peak_kb
+
+def run_benchmark(instances, algorithms, seed, repeat=1, measure_memory=True, log=print):
+    """Chạy mọi thuật toán phù hợp trên mọi bài toán; trả về danh sách kết quả (chưa có gap)."""
+    results = []
+    for instance in instances:
+        for name in algorithms:
+            kind, solve = ALGORITHMS[name]
+            if kind != instance['kind']: continue
+            times, costs = [], []
+            for run in range(repeat):
+                path, elapsed, _ = run_once(solve, instance, seed + run)
+                times.append(elapsed)
+                costs.append(route_cost(instance, path))
+            peak_kb = run_once(solve, instance, seed, trace_memory=True)[2] if measure_memory else None
+            feasible = [cost for cost in costs if cost is not None]
+            result = {'instance': instance['name'], 'kind': kind, 'size': instance['size'], 'algorithm': name, 'runs': repeat,
+                      'feasible_runs': len(feasible), 'wall_time_sec': statistics.median(times), 'times_sec': times,
+                      'peak_memory_kb': peak_kb, 'cost': min(feasible) if feasible else None, 'best_known': instance['best_known']}
+            results.append(result)
+            log(f"{instance['name']:<24} {name:<6} {result['wall_time_sec']:9.3f}s  cost={result['cost']}  feasible={len(feasible)}/{repeat}")
+    return results
+
+def add_gaps(results):
+    """Gap (%) so với lời giải tốt nhất đã biết, nếu không có thì so với lời giải tốt nhất tìm được trên cùng bài."""
+    best_found = {}
+    for result in results:
+        if result['cost'] is not None:
+            best_found[result['instance']] = min(best_found.get(result['instance'], math.inf), result['cost'])
+    for result in results:
+        reference = result['best_known'] or best_found.get(result['instance'])
+        result['reference_cost'] = reference
+        result['gap_pct'] = (result['cost'] - reference) / reference * 100 if result['cost'] is not None and reference else None
+    return results
+
+def summarize(results):
+    """Tổng hợp theo thuật toán: tỷ lệ hợp lệ, gap trung bình, tổng thời gian."""
+    summary = {}
+    for name in dict.fromkeys(result['algorithm'] for result in results):
+        rows = [result for result in results if result['algorithm'] == name]
+        gaps = [result['gap_pct'] for result in rows if result['gap_pct'] is not None]
+        summary[name] = {'instances': len(rows), 'feasibility_rate': sum(r['feasible_runs'] for r in rows) / sum(r['runs'] for r in rows),
+                         'mean_gap_pct': statistics.mean(gaps) if gaps else None, 'total_time_sec': sum(r['wall_time_sec'] for r in rows)}
+    return summary
+
+def environment_info(seed):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=app.BASE_DIR, capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {'commit': commit, 'seed': seed, 'python': platform.python_version(), 'numpy': np.__version__,
+            'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z')}
+
+# --- So sánh hai lần chạy ---
+
+def compare(baseline, current, max_slowdown, max_gap_increase):
+    """So sánh kết quả với baseline theo (bài toán, thuật toán); trả về danh sách mô tả các hồi quy."""
+    previous = {(r['instance'], r['algorithm']): r for r in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        old = previous.get((result['instance'], result['algorithm']))
+        if old is None: continue
+        label = f"{result['instance']} / {result['algorithm']}"
+        if old['wall_time_sec'] >= MIN_COMPARE_TIME_SEC and result['wall_time_sec'] > old['wall_time_sec'] * max_slowdown:
+            regressions.append(f"{label}: chậm hơn {result['wall_time_sec'] / old['wall_time_sec']:.2f}x ({old['wall_time_sec']:.3f}s -> {result['wall_time_sec']:.3f}s)")
+        if result['feasible_runs'] / result['runs'] < old['feasible_runs'] / old['runs']:
+            regressions.append(f"{label}: tỷ lệ hợp lệ giảm ({old['feasible_runs']}/{old['runs']} -> {result['feasible_runs']}/{result['runs']})")
+        if old['cost'] is not None and result['cost'] is not None and result['cost'] > old['cost'] * (1 + max_gap_increase / 100):
+            regressions.append(f"{label}: chi phí tăng {(result['cost'] / old['cost'] - 1) * 100:.2f}% ({old['cost']:.1f} -> {result['cost']:.1f})")
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark ngoại tuyến cho các thuật toán TSP/TSPTW.")
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)), help="các kích thước bài sinh ngẫu nhiên, cách nhau bởi dấu phẩy (rỗng để bỏ qua)")
+    parser.add_argument('--algorithms', default=','.join(ALGORITHMS), help=f"các thuật toán cần chạy ({', '.join(ALGORITHMS)})")
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--repeat', type=int, default=1, help="số lần chạy mỗi cặp (bài, thuật toán); thời gian lấy trung vị")
+    parser.add_argument('--tsplib', nargs='*', default=[], help="các file TSPLIB (.tsp/.atsp)")
+    parser.add_argument('--solomon', nargs='*', default=[], help="các file có khung giờ dạng Solomon/Dumas")
+    parser.add_argument('--best-known', help="file JSON {tên bài: chi phí tốt nhất đã biết}")
+    parser.add_argument('--no-memory', action='store_true', help="không đo bộ nhớ đỉnh (bỏ lần chạy có tracemalloc)")
+    parser.add_argument('--output', help="ghi kết quả JSON ra file (mặc định in ra stdout)")
+    parser.add_argument('--compare', help="file JSON của một lần chạy trước để so sánh")
+    parser.add_argument('--max-slowdown', type=float, default=1.25, help="hệ số chậm đi tối đa trước khi coi là hồi quy")
+    parser.add_argument('--max-gap-increase', type=float, default=1.0, help="mức tăng chi phí tối đa (%%) trước khi coi là hồi quy")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    algorithms = [name.strip() for name in args.algorithms.split(',') if name.strip()]
+    unknown = [name for name in algorithms if name not in ALGORITHMS]
+    if unknown: sys.exit(f"Thuật toán không tồn tại: {', '.join(unknown)}")
+    best_known = {}
+    if args.best_known:
+        with open(args.best_known) as f:
+            best_known = json.load(f)
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    instances = generate_instances(sizes, args.seed, with_time_windows='tsptw' in algorithms)
+    for path in args.tsplib:
+        instance = load_tsplib(path)
+        instance['best_known'] = best_known.get(instance['name'])
+        instances.append(instance)
+    for path in args.solomon:
+        instance = load_solomon(path)
+        instance['best_known'] = best_known.get(instance['name'])
+        instances.append(instance)
+
+    log = lambda message: print(message, file=sys.stderr)
+    results = add_gaps(run_benchmark(instances, algorithms, args.seed, repeat=args.repeat, measure_memory=not args.no_memory, log=log))
+    report = {'meta': environment_info(args.seed), 'results': results, 'summary': summarize(results)}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.max_slowdown, args.max_gap_increase)
+        for line in regressions: log(f"HỒI QUY: {line}")
+        if regressions: sys.exit(1)
+        log("Không phát hiện hồi quy so với baseline.")
+
+if __name__ == '__main__':
+    main()
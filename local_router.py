@@ -0,0 +1,317 @@
+"""Bộ định tuyến cục bộ: đồ thị đường bộ trích từ OpenStreetMap + contraction hierarchy (CH).
+
+Đồ thị được đọc từ file OSM XML, CH được xây một lần rồi lưu thành một file nhị phân để các lần khởi
+động sau chỉ cần mmap. Ma trận nhiều-nhiều được tính bằng thuật toán bucket: mỗi điểm đích tìm kiếm
+ngược "đi lên" trong CH và để lại nhãn trong bucket của các đỉnh đi qua; mỗi điểm nguồn tìm kiếm xuôi
+đi lên và ghép với các bucket gặp được.
+
+    python local_router.py build data/sample_map.osm
+    python local_router.py table data/sample_map.osm 10.7760,106.7000 10.7800,106.6950
+"""
+import heapq
+import json
+import math
+import os
+import re
+import sys
+from xml.etree import ElementTree
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371000.0
+# Tốc độ mặc định (km/h) khi way không có thẻ maxspeed; chỉ các loại highway trong bảng này được coi là đường xe chạy.
+HIGHWAY_SPEEDS_KMH = {
+    'motorway': 80, 'motorway_link': 50, 'trunk': 60, 'trunk_link': 40, 'primary': 45, 'primary_link': 35,
+    'secondary': 40, 'secondary_link': 30, 'tertiary': 35, 'tertiary_link': 25, 'unclassified': 30,
+    'residential': 25, 'living_street': 10, 'service': 15, 'road': 25,
+}
+ACCESS_SPEED_KMH = 15  # tốc độ đi từ tọa độ thật tới đỉnh gần nhất của đồ thị
+WITNESS_SETTLE_LIMIT = 500  # số đỉnh tối đa mà một lượt tìm đường chứng kiến (witness search) được duyệt
+CH_FILE_MAGIC = b'MAPAICH1'
+CH_FILE_ALIGN = 64
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Khoảng cách đường tròn lớn (mét), nhận số hoặc mảng NumPy."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+# --- Đọc đồ thị OSM ---
+
+def parse_maxspeed(value):
+    """'50', '50 km/h', '30 mph' -> km/h; giá trị không đọc được (vd. 'VN:urban') -> None."""
+    match = re.match(r'\s*(\d+(?:\.\d+)?)\s*(mph)?', value or '')
+    if not match: return None
+    return float(match.group(1)) * (1.609 if match.group(2) else 1.0)
+
+def load_osm(path):
+    """Đọc file OSM XML, giữ các way xe chạy được; mỗi đoạn giữa hai nút liên tiếp của way là một cạnh.
+
+    Trả về (tọa độ các đỉnh [lat, lon], đỉnh đầu, đỉnh cuối, quãng đường m, thời gian s) dạng mảng NumPy.
+    """
+    coords, ways = {}, []
+    for _, element in ElementTree.iterparse(path):
+        if element.tag == 'node':
+            coords[element.get('id')] = (float(element.get('lat')), float(element.get('lon')))
+        elif element.tag == 'way':
+            tags = {tag.get('k'): tag.get('v') for tag in element.iter('tag')}
+            highway = tags.get('highway')
+            if highway in HIGHWAY_SPEEDS_KMH:
+                implied_oneway = highway == 'motorway' or tags.get('junction') == 'roundabout'
+                oneway = tags.get('oneway', 'yes' if implied_oneway else 'no')
+                speed = parse_maxspeed(tags.get('maxspeed')) or HIGHWAY_SPEEDS_KMH[highway]
+                ways.append(([nd.get('ref') for nd in element.iter('nd')], oneway, speed))
+        if element.tag in ('node', 'way', 'relation'): element.clear()
+    index, tails, heads, speeds = {}, [], [], []
+    for refs, oneway, speed in ways:
+        ids = [index.setdefault(ref, len(index)) for ref in refs if ref in coords]
+        for a, b in zip(ids, ids[1:]):
+            if a == b: continue
+            if oneway != '-1': tails.append(a); heads.append(b); speeds.append(speed)
+            if oneway not in ('yes', 'true', '1'): tails.append(b); heads.append(a); speeds.append(speed)
+    points = np.array([coords[ref] for ref in index], dtype=float).reshape(-1, 2)
+    tails, heads = np.array(tails, dtype=np.int64), np.array(heads, dtype=np.int64)
+    distances = haversine_m(points[tails, 0], points[tails, 1], points[heads, 0], points[heads, 1])
+    return points, tails, heads, distances, distances / (np.array(speeds, dtype=float) / 3.6)
+
+# --- Xây contraction hierarchy ---
+
+def contract_graph(num_nodes, tails, heads, distances, durations):
+    """Rút gọn lần lượt từng đỉnh theo thứ tự edge-difference (cập nhật lười), thêm shortcut khi cần.
+
+    Trả về hai danh sách cạnh (đỉnh, đỉnh hạng cao hơn, thời gian, quãng đường): cạnh đi lên theo chiều
+    xuôi và cạnh đi lên khi tìm kiếm ngược (tức cạnh thật đi từ đỉnh hạng cao hơn xuống).
+    """
+    out_edges, in_edges = [{} for _ in range(num_nodes)], [{} for _ in range(num_nodes)]
+    for u, v, dur, dist in zip(tails.tolist(), heads.tolist(), durations.tolist(), distances.tolist()):
+        if u != v and (v not in out_edges[u] or dur < out_edges[u][v][0]):
+            out_edges[u][v] = in_edges[v][u] = (dur, dist)
+
+    def witness_search(source, excluded, limit):
+        """Dijkstra giới hạn từ source, bỏ qua đỉnh excluded; trả về khoảng cách tạm thời (cận trên)."""
+        best, heap, settled = {source: 0.0}, [(0.0, source)], 0
+        while heap and settled < WITNESS_SETTLE_LIMIT:
+            dur, v = heapq.heappop(heap)
+            if dur > best[v]: continue
+            if dur > limit: break
+            settled += 1
+            for w, (edge_dur, _) in out_edges[v].items():
+                if w != excluded and dur + edge_dur < best.get(w, math.inf):
+                    best[w] = dur + edge_dur
+                    heapq.heappush(heap, (dur + edge_dur, w))
+        return best
+
+    def shortcuts(v):
+        """Các shortcut (u, w, thời gian, quãng đường) cần thêm khi rút gọn v."""
+        result = []
+        for u, (dur_uv, dist_uv) in in_edges[v].items():
+            targets = [(w, dur, dist) for w, (dur, dist) in out_edges[v].items() if w != u]
+            if not targets: continue
+            witness = witness_search(u, v, dur_uv + max(dur for _, dur, _ in targets))
+            result.extend((u, w, dur_uv + dur, dist_uv + dist) for w, dur, dist in targets if witness.get(w, math.inf) > dur_uv + dur)
+        return result
+
+    contracted_neighbors = [0] * num_nodes
+    def priority(v):
+        added = shortcuts(v)
+        return len(added) - len(in_edges[v]) - len(out_edges[v]) + contracted_neighbors[v], added
+
+    queue = [(priority(v)[0], v) for v in range(num_nodes)]
+    heapq.heapify(queue)
+    upward, downward = [], []
+    while queue:
+        _, v = heapq.heappop(queue)
+        value, added = priority(v)
+        if queue and value > queue[0][0]:
+            heapq.heappush(queue, (value, v))
+            continue
+        for w, (dur, dist) in out_edges[v].items():
+            upward.append((v, w, dur, dist))
+            del in_edges[w][v]
+            contracted_neighbors[w] += 1
+        for u, (dur, dist) in in_edges[v].items():
+            downward.append((v, u, dur, dist))
+            del out_edges[u][v]
+            contracted_neighbors[u] += 1
+        out_edges[v], in_edges[v] = {}, {}
+        for u, w, dur, dist in added:
+            if w not in out_edges[u] or dur < out_edges[u][w][0]:
+                out_edges[u][w] = in_edges[w][u] = (dur, dist)
+    return upward, downward
+
+def to_csr(num_nodes, edges, prefix):
+    """Danh sách cạnh -> mảng CSR gọn: {prefix}_indptr, {prefix}_head, {prefix}_duration, {prefix}_distance."""
+    edges = sorted(edges)
+    tails = np.array([edge[0] for edge in edges], dtype=np.int64)
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(tails, minlength=num_nodes), out=indptr[1:])
+    return {f'{prefix}_indptr': indptr, f'{prefix}_head': np.array([edge[1] for edge in edges], dtype=np.int32),
+            f'{prefix}_duration': np.array([edge[2] for edge in edges], dtype=float),
+            f'{prefix}_distance': np.array([edge[3] for edge in edges], dtype=float)}
+
+def build_hierarchy(graph_path, ch_path):
+    """Đọc đồ thị OSM, xây CH và ghi ra ch_path."""
+    points, tails, heads, distances, durations = load_osm(graph_path)
+    upward, downward = contract_graph(len(points), tails, heads, distances, durations)
+    arrays = {'node_lat': points[:, 0].copy(), 'node_lon': points[:, 1].copy()}
+    arrays.update(to_csr(len(points), upward, 'fwd'))
+    arrays.update(to_csr(len(points), downward, 'bwd'))
+    save_arrays(ch_path, arrays)
+
+def ensure_hierarchy(graph_path, ch_path=None):
+    """Đường dẫn file CH của graph_path (mặc định cùng tên, đuôi .ch); xây lại nếu chưa có hoặc cũ hơn file đồ thị."""
+    ch_path = ch_path or os.path.splitext(graph_path)[0] + '.ch'
+    if not os.path.exists(ch_path) or os.path.getmtime(ch_path) < os.path.getmtime(graph_path):
+        build_hierarchy(graph_path, ch_path)
+    return ch_path
+
+# --- File mmap ---
+
+def align(offset):
+    return -(-offset // CH_FILE_ALIGN) * CH_FILE_ALIGN
+
+def save_arrays(path, arrays):
+    """Ghi các mảng vào một file: magic, độ dài + JSON mô tả (kiểu, kích thước, vị trí), rồi dữ liệu đã căn lề để mmap."""
+    header, offset = {}, 0
+    for name, array in arrays.items():
+        offset = align(offset)
+        header[name] = [array.dtype.str, list(array.shape), offset]
+        offset += array.nbytes
+    header_bytes = json.dumps(header).encode()
+    data_start = align(len(CH_FILE_MAGIC) + 8 + len(header_bytes))
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(CH_FILE_MAGIC + len(header_bytes).to_bytes(8, 'little') + header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + header[name][2])
+            f.write(np.ascontiguousarray(array).tobytes())
+    os.replace(temp_path, path)  # thay file cũ một cách nguyên tử, các tiến trình đang mmap file cũ không bị ảnh hưởng
+
+def load_arrays(path):
+    """Mở file do save_arrays ghi; các mảng là np.memmap chỉ đọc (dữ liệu được nạp dần theo trang khi truy cập)."""
+    with open(path, 'rb') as f:
+        if f.read(len(CH_FILE_MAGIC)) != CH_FILE_MAGIC: raise ValueError(f"{path} không phải file CH hợp lệ")
+        header_bytes = f.read(int.from_bytes(f.read(8), 'little'))
+    data_start = align(len(CH_FILE_MAGIC) + 8 + len(header_bytes))
+    arrays = {}
+    for name, (dtype, shape, offset) in json.loads(header_bytes).items():
+        if math.prod(shape) == 0: arrays[name] = np.empty(shape, dtype=dtype)  # np.memmap không nhận mảng rỗng
+        else: arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=data_start + offset, shape=tuple(shape))
+    return arrays
+
+# --- Truy vấn ---
+
+class LocalRouter:
+    """Truy vấn ma trận trên một file CH đã mmap; chỉ đọc nên dùng chung được giữa các luồng."""
+    def __init__(self, ch_path):
+        self.path = ch_path
+        # np.asarray bỏ lớp np.memmap (chậm khi cắt mảng nhiều lần) nhưng vẫn đọc thẳng từ vùng nhớ đã mmap.
+        for name, array in load_arrays(ch_path).items(): setattr(self, name, np.asarray(array))
+        # Chỉ số CSR được đọc ở mỗi bước tìm kiếm nên giữ dạng list Python; các mảng cạnh vẫn nằm trong mmap.
+        self._indptr = {False: self.fwd_indptr.tolist(), True: self.bwd_indptr.tolist()}
+        self._edges = {False: (self.fwd_head, self.fwd_duration, self.fwd_distance), True: (self.bwd_head, self.bwd_duration, self.bwd_distance)}
+        self._xy = None
+
+    @property
+    def num_nodes(self):
+        return len(self.node_lat)
+
+    def snap(self, lats, lons):
+        """Đỉnh gần nhất của đồ thị cho từng tọa độ và khoảng cách (m) tới đỉnh đó."""
+        if self._xy is None:
+            # Phép chiếu equirectangular đủ chính xác để chọn đỉnh gần nhất trong phạm vi một thành phố.
+            scale = math.cos(math.radians(float(np.mean(self.node_lat)))) if self.num_nodes else 1.0
+            self._xy = np.column_stack([np.asarray(self.node_lon) * scale, np.asarray(self.node_lat)]), scale
+        xy, scale = self._xy
+        nodes = np.array([int(np.argmin(((xy - (lon * scale, lat)) ** 2).sum(axis=1))) for lat, lon in zip(lats, lons)], dtype=np.int64)
+        return nodes, haversine_m(np.asarray(lats), np.asarray(lons), self.node_lat[nodes], self.node_lon[nodes])
+
+    def upward_search(self, node, backward=False):
+        """Dijkstra chỉ theo cạnh đi lên (ngược chiều nếu backward); trả về (các đỉnh, thời gian, quãng đường)."""
+        indptr, (heads, durations, distances) = self._indptr[backward], self._edges[backward]
+        best, heap, settled = {node: 0.0}, [(0.0, 0.0, node)], {}
+        while heap:
+            dur, dist, v = heapq.heappop(heap)
+            if v in settled: continue
+            settled[v] = (dur, dist)
+            start, end = indptr[v], indptr[v + 1]
+            if start == end: continue
+            for w, edge_dur, edge_dist in zip(heads[start:end].tolist(), durations[start:end].tolist(), distances[start:end].tolist()):
+                if w not in settled and dur + edge_dur < best.get(w, math.inf):
+                    best[w] = dur + edge_dur
+                    heapq.heappush(heap, (dur + edge_dur, dist + edge_dist, w))
+        labels = np.array(list(settled.values()), dtype=float).reshape(-1, 2)
+        return np.fromiter(settled, dtype=np.int64, count=len(settled)), labels[:, 0], labels[:, 1]
+
+    def search_spaces(self, nodes, backward, executor=None, chunks=1):
+        """Tìm kiếm đi lên từ mọi đỉnh trong nodes, chia thành các phần chạy trên executor (luồng hoặc tiến trình) nếu có."""
+        if executor is None or chunks <= 1 or len(nodes) < 2: return [self.upward_search(node, backward) for node in nodes]
+        size = -(-len(nodes) // chunks)
+        parts = [nodes[i:i + size] for i in range(0, len(nodes), size)]
+        return [space for part in executor.map(upward_search_spaces, [self.path] * len(parts), parts, [backward] * len(parts)) for space in part]
+
+    def table(self, sources, targets, executor=None, chunks=1):
+        """Ma trận (quãng đường m, thời gian s) từ các tọa độ sources tới targets ({'lat', 'lon'}); inf nếu không có đường."""
+        points = [(float(c['lat']), float(c['lon'])) for c in list(sources) + list(targets)]
+        snapped, offsets = self.snap([p[0] for p in points], [p[1] for p in points])
+        access = offsets / (ACCESS_SPEED_KMH / 3.6)
+        source_nodes, source_inverse = np.unique(snapped[:len(sources)], return_inverse=True)
+        target_nodes, target_inverse = np.unique(snapped[len(sources):], return_inverse=True)
+        backward = self.search_spaces(target_nodes.tolist(), True, executor, chunks)
+        forward = self.search_spaces(source_nodes.tolist(), False, executor, chunks)
+
+        # Bucket: mọi nhãn của các lượt tìm kiếm ngược, sắp theo đỉnh (dạng CSR theo số hiệu đỉnh).
+        bucket_node = np.concatenate([space[0] for space in backward])
+        bucket_target = np.repeat(np.arange(len(backward)), [len(space[0]) for space in backward])
+        order = np.argsort(bucket_node, kind='stable')
+        bucket_target, bucket_node = bucket_target[order], bucket_node[order]
+        bucket_dur = np.concatenate([space[1] for space in backward])[order]
+        bucket_dist = np.concatenate([space[2] for space in backward])[order]
+        bucket_indptr = np.zeros(self.num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(bucket_node, minlength=self.num_nodes), out=bucket_indptr[1:])
+
+        durations = np.full((len(source_nodes), len(target_nodes)), np.inf)
+        distances = np.full_like(durations, np.inf)
+        for row, (nodes, node_dur, node_dist) in enumerate(forward):
+            starts, counts = bucket_indptr[nodes], bucket_indptr[nodes + 1] - bucket_indptr[nodes]
+            if not counts.any(): continue
+            owner = np.repeat(np.arange(len(nodes)), counts)
+            entries = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            candidate, target = node_dur[owner] + bucket_dur[entries], bucket_target[entries]
+            np.minimum.at(durations[row], target, candidate)
+            # Quãng đường lấy theo đường nhanh nhất (trùng thời gian thì lấy bất kỳ).
+            hit = candidate <= durations[row][target]
+            distances[row, target[hit]] = node_dist[owner[hit]] + bucket_dist[entries[hit]]
+
+        source_access, target_access = access[:len(sources)], access[len(sources):]
+        source_offsets, target_offsets = offsets[:len(sources)], offsets[len(sources):]
+        result_dist = distances[np.ix_(source_inverse, target_inverse)] + source_offsets[:, None] + target_offsets[None, :]
+        result_dur = durations[np.ix_(source_inverse, target_inverse)] + source_access[:, None] + target_access[None, :]
+        points = np.array(points).reshape(-1, 2)
+        same_point = (points[:len(sources), None, :] == points[None, len(sources):, :]).all(axis=2)
+        result_dist[same_point], result_dur[same_point] = 0.0, 0.0
+        return result_dist, result_dur
+
+_routers = {}
+
+def upward_search_spaces(ch_path, nodes, backward):
+    """Chạy trong worker (luồng hoặc tiến trình): mở file CH một lần bằng mmap rồi tìm kiếm đi lên từ từng đỉnh."""
+    router = _routers.get(ch_path)
+    if router is None: router = _routers.setdefault(ch_path, LocalRouter(ch_path))
+    return [router.upward_search(node, backward) for node in nodes]
+
+def main(argv):
+    if len(argv) >= 2 and argv[0] == 'build':
+        ch_path = argv[2] if len(argv) > 2 else os.path.splitext(argv[1])[0] + '.ch'
+        build_hierarchy(argv[1], ch_path)
+        router = LocalRouter(ch_path)
+        print(f"Đã ghi {ch_path}: {router.num_nodes} đỉnh, {len(router.fwd_head)} + {len(router.bwd_head)} cạnh đi lên")
+    elif len(argv) >= 3 and argv[0] == 'table':
+        coords = [dict(zip(('lat', 'lon'), point.split(','))) for point in argv[2:]]
+        distances, durations = LocalRouter(ensure_hierarchy(argv[1])).table(coords, coords)
+        print(json.dumps({'distances': distances.round(1).tolist(), 'durations': durations.round(1).tolist()}))
+    else:
+        sys.exit(__doc__)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,222 @@
+"""Đo lường cho pipeline lập lộ trình: bộ đếm và histogram (xuất theo định dạng văn bản của Prometheus),
+trace có cấu trúc cho từng request/công việc và profiler lấy mẫu (tùy chọn) cho các lần giải chậm.
+
+Mỗi tiến trình có một registry riêng; tiến trình worker gửi phần số liệu mới (drain) về tiến trình chính
+để gộp (merge), nhờ vậy /metrics phản ánh cả các công việc chạy nền.
+"""
+import bisect
+import contextvars
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+class MetricsRegistry:
+    """Bộ đếm và histogram có nhãn, dùng chung giữa các luồng."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}  # tên -> (loại, mô tả, buckets)
+        self._counters = {}  # (tên, nhãn) -> giá trị
+        self._histograms = {}  # (tên, nhãn) -> [số lần theo từng bucket (không cộng dồn, ô cuối là +Inf), tổng, số lần]
+
+    def counter(self, name, help_text):
+        self._meta[name] = ('counter', help_text, None)
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self._meta[name] = ('histogram', help_text, tuple(buckets))
+
+    def inc(self, name, value=1, **labels):
+        if not value: return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        trace = current_trace.get()
+        if trace is not None: trace.count(name, value, labels)
+
+    def observe(self, name, value, **labels):
+        buckets = self._meta[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            data = self._histograms.get(key)
+            if data is None: data = self._histograms[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+            data[0][bisect.bisect_left(buckets, value)] += 1
+            data[1] += value
+            data[2] += 1
+
+    def drain(self):
+        """Lấy ra và xóa toàn bộ số liệu đã ghi (dạng dữ liệu thuần để gửi qua tiến trình)."""
+        with self._lock:
+            delta = {'counters': [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                     'histograms': [[name, list(labels), data] for (name, labels), data in self._histograms.items()]}
+            self._counters, self._histograms = {}, {}
+        return delta
+
+    def merge(self, delta):
+        """Gộp số liệu do drain() của một tiến trình khác trả về (bộ đếm cũng được cộng vào trace hiện tại)."""
+        for name, labels, value in delta['counters']:
+            self.inc(name, value, **dict(labels))
+        with self._lock:
+            for name, labels, (counts, total, count) in delta['histograms']:
+                key = (name, tuple(tuple(label) for label in labels))
+                data = self._histograms.get(key)
+                if data is None: data = self._histograms[key] = [[0] * len(counts), 0.0, 0]
+                data[0] = [a + b for a, b in zip(data[0], counts)]
+                data[1] += total
+                data[2] += count
+
+    def render(self):
+        """Toàn bộ số liệu theo định dạng văn bản của Prometheus (text exposition format 0.0.4)."""
+        with self._lock:
+            counters, histograms = dict(self._counters), {key: (list(data[0]), data[1], data[2]) for key, data in self._histograms.items()}
+        lines = []
+        for name, (kind, help_text, buckets) in sorted(self._meta.items()):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            if kind == 'counter':
+                lines += [f"{name}{format_labels(labels)} {format_value(value)}" for (metric, labels), value in sorted(counters.items()) if metric == name]
+                continue
+            for (metric, labels), (counts, total, count) in sorted(histograms.items()):
+                if metric != name: continue
+                cumulative = 0
+                for bound, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                    cumulative += bucket_count
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', format_value(bound)),))} {cumulative}")
+                lines += [f"{name}_sum{format_labels(labels)} {format_value(total)}", f"{name}_count{format_labels(labels)} {count}"]
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    if not labels: return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels) + '}'
+
+def format_value(value):
+    return value if isinstance(value, str) else repr(float(value)) if isinstance(value, float) else str(value)
+
+registry = MetricsRegistry()
+
+# --- Trace theo request ---
+
+class Trace:
+    """Trace của một request hoặc công việc: các giai đoạn (span) và bộ đếm phát sinh trong lúc xử lý."""
+    def __init__(self, name, trace_id=None, **attrs):
+        self.trace_id = trace_id or uuid.uuid4().hex[:16]
+        self.name, self.attrs = name, attrs
+        self.started_at, self._start = time.time(), time.perf_counter()
+        self.spans, self.counters = [], Counter()
+
+    def add_span(self, stage, start, duration, **attrs):
+        self.spans.append(dict(attrs, stage=stage, start_ms=round((start - self._start) * 1000, 3), duration_ms=round(duration * 1000, 3)))
+
+    def count(self, name, value, labels=None):
+        self.counters[name + format_labels(tuple(sorted((labels or {}).items())))] += value
+
+    def elapsed(self):
+        return time.perf_counter() - self._start
+
+    def to_dict(self, **extra):
+        return dict(self.attrs, **extra, trace_id=self.trace_id, name=self.name, timestamp=self.started_at,
+                    duration_ms=round(self.elapsed() * 1000, 3), spans=self.spans, counters=dict(self.counters))
+
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+@contextmanager
+def tracing(trace):
+    """Đặt trace làm trace hiện tại của luồng (context) trong khối with."""
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        current_trace.reset(token)
+
+@contextmanager
+def timed(stage, metric='mapai_stage_seconds', **labels):
+    """Đo thời gian một giai đoạn: ghi vào histogram metric (nhãn stage + labels) và thêm span vào trace hiện tại."""
+    start, error = time.perf_counter(), None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        registry.observe(metric, elapsed, stage=stage, **labels)
+        trace = current_trace.get()
+        if trace is not None: trace.add_span(stage, start, elapsed, **labels, **({'error': error} if error else {}))
+
+trace_log_lock = threading.Lock()
+
+def log_trace(record, path):
+    """Ghi một trace thành một dòng JSON vào path ('-' là stderr, rỗng là tắt)."""
+    if not path: return
+    line = json.dumps(record, ensure_ascii=False, default=str) + '\n'
+    with trace_log_lock:
+        if path == '-':
+            sys.stderr.write(line)
+            sys.stderr.flush()
+        else:
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(line)
+
+# --- Profiler lấy mẫu ---
+
+class SamplingProfiler:
+    """Lấy mẫu stack của một luồng theo chu kỳ (sys._current_frames) và gộp theo dạng "folded stacks"
+    (mỗi dòng "hàm_gốc;...;hàm_lá số_mẫu"), đọc được bằng flamegraph.pl, speedscope hoặc inferno."""
+    def __init__(self, thread_id, interval_sec):
+        self.thread_id, self.interval_sec = thread_id, interval_sec
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval_sec):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack: self.samples[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.samples
+
+    def folded(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+@contextmanager
+def profile_if_slow(label, threshold_sec, directory, interval_sec):
+    """Lấy mẫu luồng hiện tại trong khối with; nếu chạy lâu hơn threshold_sec thì ghi file .folded vào directory.
+
+    threshold_sec là None nghĩa là profiler đang tắt (không tốn chi phí gì).
+    """
+    if threshold_sec is None:
+        yield
+        return
+    profiler, start = SamplingProfiler(threading.get_ident(), interval_sec).start(), time.perf_counter()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        elapsed = time.perf_counter() - start
+        if elapsed >= threshold_sec and profiler.samples:
+            trace = current_trace.get()
+            os.makedirs(directory, exist_ok=True)
+            safe_label = re.sub(r'[^\w.-]+', '_', label)
+            path = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{safe_label}-{trace.trace_id if trace else uuid.uuid4().hex[:8]}.folded")
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(profiler.folded())
+            registry.inc('mapai_profiles_saved_total')
+            if trace is not None: trace.attrs['profile'] = path
@@ -0,0 +1,36 @@
+import json
+import os
+import sys
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def nominatim_server():
+    """Server Nominatim giả: trả về tọa độ cố định theo địa chỉ; yield (url /search, số request cho mỗi địa chỉ)."""
+    requests_seen = Counter()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = parse_qs(urlsplit(self.path).query)['q'][0]
+            requests_seen[query] += 1
+            offset = sum(map(ord, query)) % 1000 / 10000
+            body = json.dumps([{'display_name': query, 'lat': str(10.7 + offset), 'lon': str(106.6 + offset)}]).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}/search', requests_seen
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,149 @@
+"""Kiểm tra benchmark.py: đọc file TSPLIB/Solomon, sinh bài có khung giờ, và so sánh với baseline (--compare)."""
+import json
+
+import numpy as np
+import pytest
+
+import benchmark
+
+EUC_2D = """NAME : tiny5
+COMMENT : 5 điểm
+TYPE : TSP
+DIMENSION : 5
+EDGE_WEIGHT_TYPE : EUC_2D
+NODE_COORD_SECTION
+1 0 0
+2 3 4
+3 6 0
+4 0 1.4
+5 2.5 2.5
+EOF
+"""
+
+SOLOMON = """RC201-TEST
+
+VEHICLE
+NUMBER     CAPACITY
+  1          1000
+
+CUSTOMER
+CUST NO.  XCOORD.   YCOORD.    DEMAND   READY TIME  DUE DATE   SERVICE TIME
+
+    1      40         50          0          0       960          0
+    2      25         85         20        145       175         10
+    3      22         75         30         50        80         10
+    4      22         85         10        109       139         10
+  999       0          0          0          0         0          0
+    5      99         99          0          0         0          0
+"""
+
+def write(tmp_path, name, text):
+    path = tmp_path / name
+    path.write_text(text)
+    return str(path)
+
+def explicit_tsplib(weight_format, weights):
+    return f"NAME: explicit4\nTYPE: TSP\nDIMENSION: 4\nEDGE_WEIGHT_TYPE: EXPLICIT\nEDGE_WEIGHT_FORMAT: {weight_format}\nEDGE_WEIGHT_SECTION\n{weights}\nEOF\n"
+
+EXPLICIT_MATRIX = np.array([[0, 1, 2, 3], [1, 0, 4, 5], [2, 4, 0, 6], [3, 5, 6, 0]], dtype=float)
+
+def test_load_tsplib_euc_2d_rounds_to_nearest_integer(tmp_path):
+    instance = benchmark.load_tsplib(write(tmp_path, 'tiny.tsp', EUC_2D), best_known=14)
+    assert instance['name'] == 'tiny5' and instance['kind'] == 'tsp' and instance['size'] == 5 and instance['best_known'] == 14
+    dist = instance['dist']
+    assert dist[0, 1] == 5 and dist[0, 2] == 6 and dist[0, 3] == 1  # 1.4 làm tròn thành 1
+    assert dist[0, 4] == 4  # sqrt(12.5) = 3.54 -> 4
+    assert np.array_equal(dist, dist.T) and not dist.diagonal().any()
+
+@pytest.mark.parametrize('weight_format, weights', [
+    ('FULL_MATRIX', '0 1 2 3\n1 0 4 5\n2 4 0 6\n3 5 6 0'),
+    ('UPPER_ROW', '1 2 3\n4 5\n6'),
+    ('LOWER_ROW', '1\n2 4\n3 5 6'),
+    ('UPPER_DIAG_ROW', '0 1 2 3 0 4 5 0 6 0'),
+    ('LOWER_DIAG_ROW', '0 1 0 2 4 0 3 5 6 0'),
+])
+def test_load_tsplib_explicit_formats(tmp_path, weight_format, weights):
+    instance = benchmark.load_tsplib(write(tmp_path, 'explicit.tsp', explicit_tsplib(weight_format, weights)))
+    assert np.array_equal(instance['dist'], EXPLICIT_MATRIX)
+
+def test_load_tsplib_unsupported_type(tmp_path):
+    with pytest.raises(ValueError):
+        benchmark.load_tsplib(write(tmp_path, 'bad.tsp', EUC_2D.replace('EUC_2D', 'XRAY1')))
+    with pytest.raises(ValueError):
+        benchmark.load_tsplib(write(tmp_path, 'bad.tsp', explicit_tsplib('UPPER_COL', '1 2 3 4 5 6')))
+
+def test_tsplib_att_and_geo_distances():
+    assert benchmark.tsplib_distance('ATT', (0, 0), (30, 40)) == 16  # sqrt(250) = 15.8 -> làm tròn lên
+    assert benchmark.tsplib_distance('GEO', (16.47, 96.10), (16.47, 96.10)) == 1
+    assert benchmark.tsplib_distance('CEIL_2D', (0, 0), (1, 1)) == 2
+
+def test_load_solomon(tmp_path):
+    instance = benchmark.load_solomon(write(tmp_path, 'rc201.txt', SOLOMON), best_known=100)
+    assert instance['name'] == 'rc201' and instance['kind'] == 'tsptw' and instance['size'] == 4
+    assert instance['start_time_sec'] == 0 and instance['best_known'] == 100
+    # Điểm sau dòng 999 bị bỏ qua; khung giờ chỉ cho các điểm giao (không có kho).
+    assert instance['time_windows'] == [{'earliest': 145, 'latest': 175}, {'earliest': 50, 'latest': 80}, {'earliest': 109, 'latest': 139}]
+    dist, duration = instance['dist'], instance['duration']
+    assert dist[0, 1] == pytest.approx(np.hypot(15, 35))
+    # Thời gian phục vụ được cộng vào chặng đi ra khỏi điểm.
+    assert duration[1, 2] == pytest.approx(dist[1, 2] + 10) and duration[0, 1] == pytest.approx(dist[0, 1])
+    assert not duration.diagonal().any()
+    assert benchmark.route_cost(instance, [0, 2, 3, 1, 0]) is not None
+    assert benchmark.route_cost(instance, [0, 1, 2, 3, 0]) is None  # đến điểm 2 trễ giờ
+
+def test_load_solomon_rejects_unreadable_file(tmp_path):
+    with pytest.raises(ValueError):
+        benchmark.load_solomon(write(tmp_path, 'empty.txt', 'không có dữ liệu\n'))
+
+def test_generated_time_windows_are_feasible():
+    for instance in benchmark.generate_instances([30], seed=1):
+        if instance['kind'] != 'tsptw': continue
+        windows = instance['time_windows']
+        assert len(windows) == 29 and all(w['latest'] - w['earliest'] >= benchmark.TW_WIDTH_SEC for w in windows)
+        assert benchmark.route_cost(instance, benchmark.solve_tsptw(instance)) is not None
+
+def test_route_cost_rejects_invalid_paths():
+    instance = benchmark.make_instance('square', 'tsp', benchmark.euclidean_matrix([(0, 0), (0, 1), (1, 1), (1, 0)]))
+    assert benchmark.route_cost(instance, [0, 1, 2, 3, 0]) == pytest.approx(4)
+    for path in (None, [1, 0, 2, 3, 1], [0, 1, 2, 0], [0, 1, 1, 3, 0]):
+        assert benchmark.route_cost(instance, path) is None
+
+def result(instance, algorithm, wall_time_sec, cost, feasible_runs=1, runs=1):
+    return {'instance': instance, 'algorithm': algorithm, 'wall_time_sec': wall_time_sec, 'cost': cost, 'feasible_runs': feasible_runs, 'runs': runs}
+
+def test_compare_reports_regressions():
+    baseline = {'results': [result('a', 'sa', 1.0, 100.0), result('b', 'sa', 0.001, 100.0), result('c', 'tsptw', 1.0, 50.0, 3, 3), result('d', 'nn', 1.0, 100.0)]}
+    current = {'results': [result('a', 'sa', 1.3, 100.5),      # chậm hơn 1,3 lần, chi phí tăng 0,5%
+                           result('b', 'sa', 0.005, 100.0),    # quá ngắn để so thời gian
+                           result('c', 'tsptw', 1.0, 50.0, 2, 3),
+                           result('d', 'nn', 0.9, 102.0),
+                           result('e', 'nn', 9.0, 1.0)]}       # không có trong baseline
+    regressions = benchmark.compare(baseline, current, max_slowdown=1.25, max_gap_increase=1.0)
+    assert len(regressions) == 3
+    assert regressions[0].startswith('a / sa: chậm hơn 1.30x')
+    assert regressions[1].startswith('c / tsptw: tỷ lệ hợp lệ giảm (3/3 -> 2/3)')
+    assert regressions[2].startswith('d / nn: chi phí tăng 2.00%')
+    assert benchmark.compare(baseline, baseline, 1.25, 1.0) == []
+
+def test_main_compare_exit_code(tmp_path, capsys):
+    baseline_path, current_path = str(tmp_path / 'base.json'), str(tmp_path / 'current.json')
+    args = ['--sizes', '12', '--algorithms', 'nn,2opt', '--no-memory']
+    benchmark.main(args + ['--output', baseline_path])
+    report = json.loads((tmp_path / 'base.json').read_text())
+    assert {r['algorithm'] for r in report['results']} == {'nn', '2opt'} and report['meta']['seed'] == benchmark.DEFAULT_SEED
+    assert all(r['gap_pct'] is not None and r['feasible_runs'] == 1 for r in report['results'])
+
+    benchmark.main(args + ['--output', current_path, '--compare', baseline_path])
+    assert 'Không phát hiện hồi quy' in capsys.readouterr().err
+
+    # Baseline giả có chi phí thấp hơn nhiều: lần chạy hiện tại phải bị coi là hồi quy (mã lỗi 1).
+    for r in report['results']: r['cost'] /= 2
+    (tmp_path / 'base.json').write_text(json.dumps(report))
+    with pytest.raises(SystemExit) as exit_info:
+        benchmark.main(args + ['--output', current_path, '--compare', baseline_path])
+    assert exit_info.value.code == 1
+    assert 'HỒI QUY' in capsys.readouterr().err
+
+def test_unknown_algorithm_exits():
+    with pytest.raises(SystemExit):
+        benchmark.main(['--sizes', '10', '--algorithms', 'nn,magic'])
@@ -0,0 +1,60 @@
+"""Kiểm tra bộ nhớ đệm geocoding với một server Nominatim giả chạy cục bộ (http.server)."""
+import time
+
+import pytest
+
+import app
+
+@pytest.fixture
+def nominatim(nominatim_server, monkeypatch, tmp_path):
+    """Trỏ geocoding tới server Nominatim giả (xem conftest) với cache SQLite tạm; trả về số request cho mỗi địa chỉ."""
+    url, requests_seen = nominatim_server
+    monkeypatch.setattr(app, 'NOMINATIM_URL', url)
+    monkeypatch.setattr(app, 'GEOCODE_CACHE_PATH', str(tmp_path / 'geocode_cache.sqlite3'))
+    monkeypatch.setattr(app, 'geocode_cache', app.GeocodeCache(app.GEOCODE_CACHE_PATH, 3600, 100))
+    monkeypatch.setattr(app, 'geocode_rate_limiter', app.RateLimiter(1000))
+    monkeypatch.setattr(app, 'geocode_stats', {'lookups': 0, 'hits': 0, 'misses': 0, 'total_latency_ms': 0.0})
+    return requests_seen
+
+def reset_stats(monkeypatch):
+    monkeypatch.setattr(app, 'geocode_stats', {'lookups': 0, 'hits': 0, 'misses': 0, 'total_latency_ms': 0.0})
+
+def test_one_request_per_normalized_address_then_all_hits(nominatim, monkeypatch):
+    addresses = ['Chợ Bến Thành', '  chợ   bến thành ', 'CHỢ BẾN THÀNH,', 'Dinh Độc Lập', 'Sân bay Tân Sơn Nhất', 'dinh độc lập']
+    first = app.geocode_addresses(addresses)
+    assert all(coord is not None for coord in first)
+    assert len(nominatim) == 3 and all(count == 1 for count in nominatim.values())
+    stats = app.get_geocode_stats()
+    assert stats['lookups'] == 6 and stats['misses'] == 6 and stats['hits'] == 0
+    assert stats['avg_latency_ms'] > 0
+
+    reset_stats(monkeypatch)
+    second = app.geocode_addresses(addresses)
+    assert second == first
+    assert sum(nominatim.values()) == 3
+    stats = app.get_geocode_stats()
+    assert stats['hits'] == 6 and stats['misses'] == 0 and stats['hit_ratio'] == 1.0
+    print(f"hit ratio {stats['hit_ratio']:.2f}, độ trễ trung bình {stats['avg_latency_ms']:.2f} ms")
+
+def test_expired_entries_are_fetched_again(nominatim, monkeypatch):
+    monkeypatch.setattr(app, 'geocode_cache', app.GeocodeCache(app.GEOCODE_CACHE_PATH, 0.2, 100))
+    app.geocode_addresses(['Chợ Bến Thành'])
+    app.geocode_addresses(['Chợ Bến Thành'])
+    assert sum(nominatim.values()) == 1
+    time.sleep(0.3)
+    app.geocode_addresses(['Chợ Bến Thành'])
+    assert sum(nominatim.values()) == 2
+
+def test_least_recently_used_entry_is_evicted(nominatim, monkeypatch):
+    monkeypatch.setattr(app, 'geocode_cache', app.GeocodeCache(app.GEOCODE_CACHE_PATH, 3600, 2))
+    for address in ('A', 'B'):
+        app.geocode_addresses([address])
+        time.sleep(0.01)
+    app.geocode_addresses(['A'])  # A được dùng lại nên B là bản ghi ít dùng nhất
+    time.sleep(0.01)
+    app.geocode_addresses(['C'])
+    assert set(app.geocode_cache.get_many(['a', 'b', 'c'])) == {'a', 'c'}
+    app.geocode_addresses(['A', 'C'])
+    assert nominatim['A'] == 1 and nominatim['C'] == 1
+    app.geocode_addresses(['B'])
+    assert nominatim['B'] == 2
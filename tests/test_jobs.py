@@ -0,0 +1,87 @@
+"""Kiểm tra /jobs: kiểm tra dữ liệu trước khi đưa vào hàng đợi, tiến độ qua Server-Sent Events và hủy công việc.
+
+Worker là tiến trình spawn (đọc cấu hình từ biến môi trường), dùng server Nominatim giả và backend haversine.
+"""
+import time
+
+import pytest
+
+import app
+
+POINTS = [{'address': f'Điểm giao {k}'} for k in range(1, 10)]
+
+@pytest.fixture
+def client():
+    app.app.config['TESTING'] = True
+    return app.app.test_client()
+
+@pytest.fixture
+def jobs(nominatim_server, monkeypatch, tmp_path):
+    monkeypatch.setenv('NOMINATIM_URL', nominatim_server[0])
+    monkeypatch.setenv('GEOCODE_CACHE_PATH', str(tmp_path / 'geocode_cache.sqlite3'))
+    monkeypatch.setenv('GEOCODE_RATE_LIMIT', '1000')
+    monkeypatch.setenv('ROUTING_BACKEND', 'haversine')
+    monkeypatch.setenv('TRACE_LOG', '')
+    manager = app.JobManager(workers=1, max_pending=2)
+    monkeypatch.setattr(app, 'job_manager', manager)
+    yield manager
+    manager._pool.shutdown(wait=False, cancel_futures=True)
+    manager._mp_manager.shutdown()
+
+def wait_for_status(client, job_id, statuses, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        snapshot = client.get(f'/jobs/{job_id}').get_json()
+        if snapshot['status'] in statuses: return snapshot
+        time.sleep(0.1)
+    raise AssertionError(f'công việc {job_id} vẫn ở trạng thái {snapshot["status"]}')
+
+@pytest.mark.parametrize('plan', [
+    {'warehouse_address': 'Kho', 'points': []},
+    {'points': POINTS},
+    {'warehouse_address': 'Kho', 'points': [{'adress': 'Điểm giao 1'}]},
+    {'warehouse_address': 'Kho', 'points': ['Điểm giao 1']},
+    {'warehouse_address': 'Kho', 'points': POINTS, 'mode': 'fastest'},
+    {'warehouse_address': 'Kho', 'points': POINTS, 'start_time': '8h'},
+    {'warehouse_address': 'Kho', 'points': [{'address': 'Điểm giao 1', 'earliest': '25:00'}], 'mode': 'schedule'},
+    {'warehouse_address': 'Kho', 'points': POINTS, 'mode': 'vrp', 'num_vehicles': 2},
+    {'warehouse_address': 'Kho', 'points': [{'address': 'Điểm giao 1', 'demand': -1}], 'mode': 'vrp', 'num_vehicles': 2, 'vehicle_capacity': 10},
+    {'warehouse_address': 'Kho', 'points': POINTS, 'mode': 'portfolio', 'time_budget': 0},
+    ['Kho'],
+])
+def test_invalid_plan_is_rejected_before_enqueue(client, monkeypatch, plan):
+    monkeypatch.setattr(app, 'get_job_manager', lambda: pytest.fail('dữ liệu sai không được đưa vào hàng đợi'))
+    response = client.post('/jobs', json=plan)
+    assert response.status_code == 400 and response.get_json()['error']
+
+def test_valid_plan_is_normalized():
+    plan = app.parse_plan_json({'warehouse_address': 'Kho', 'points': [{'address': 'A', 'demand': '2', 'extra': 1}], 'mode': 'vrp',
+                                'num_vehicles': '2', 'vehicle_capacity': 5, 'use_time_windows': True})
+    assert plan == {'mode': 'vrp', 'warehouse_address': 'Kho', 'start_time': '08:00', 'num_vehicles': 2, 'vehicle_capacity': 5.0, 'use_time_windows': True,
+                    'points': [{'address': 'A', 'earliest': '00:00', 'latest': '23:59', 'demand': 2.0}]}
+
+def test_job_streams_progress_and_finishes(client, jobs):
+    response = client.post('/jobs', json={'warehouse_address': 'Kho hàng', 'points': POINTS})
+    assert response.status_code == 202
+    job = response.get_json()
+    stream = client.get(job['events_url']).get_data(as_text=True)
+    assert 'event: progress' in stream and '"stage": "geocode"' in stream
+    assert stream.rstrip().endswith('"status": "done", "error": null}')
+    snapshot = client.get(job['status_url']).get_json()
+    assert snapshot['status'] == 'done' and snapshot['result']['plan_id']
+    assert client.get(f"/jobs/{job['job_id']}/view").status_code == 200
+
+def test_cancel_running_and_queued_jobs(client, jobs):
+    plan = {'warehouse_address': 'Kho hàng', 'points': POINTS, 'mode': 'portfolio', 'time_budget': 60}
+    running = client.post('/jobs', json=plan).get_json()['job_id']
+    queued = client.post('/jobs', json=plan).get_json()['job_id']
+    # Hàng đợi đã đầy (max_pending=2).
+    assert client.post('/jobs', json=plan).status_code == 503
+    wait_for_status(client, running, ('running',))
+    assert client.delete(f'/jobs/{queued}').status_code == 200
+    assert client.delete(f'/jobs/{running}').status_code == 200
+    started = time.time()
+    assert wait_for_status(client, running, app.JOB_TERMINAL_STATUSES)['status'] == 'cancelled'
+    assert time.time() - started < 30
+    assert wait_for_status(client, queued, app.JOB_TERMINAL_STATUSES)['status'] == 'cancelled'
+    assert client.delete('/jobs/khong-ton-tai').status_code == 404
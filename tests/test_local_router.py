@@ -0,0 +1,107 @@
+"""Kiểm tra bộ định tuyến cục bộ trên data/sample_map.osm: ma trận CH nhiều-nhiều so với Dijkstra thường, và bước snap tọa độ."""
+import heapq
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+import local_router
+
+SAMPLE_MAP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'sample_map.osm')
+
+@pytest.fixture(scope='module')
+def graph():
+    return local_router.load_osm(SAMPLE_MAP)
+
+@pytest.fixture(scope='module')
+def router(tmp_path_factory):
+    # Dựng CH vào thư mục tạm để không đụng tới data/sample_map.ch.
+    ch_path = str(tmp_path_factory.mktemp('ch') / 'sample_map.ch')
+    local_router.build_hierarchy(SAMPLE_MAP, ch_path)
+    return local_router.LocalRouter(ch_path)
+
+def dijkstra(graph, source):
+    """Dijkstra thường theo thời gian trên đồ thị gốc; trả về (thời gian, quãng đường của đường nhanh nhất) tới mọi đỉnh."""
+    points, tails, heads, distances, durations = graph
+    adjacency = [[] for _ in range(len(points))]
+    for u, v, dur, dist in zip(tails.tolist(), heads.tolist(), durations.tolist(), distances.tolist()):
+        adjacency[u].append((v, dur, dist))
+    best_dur, best_dist = np.full(len(points), np.inf), np.full(len(points), np.inf)
+    best_dur[source], best_dist[source] = 0.0, 0.0
+    heap, settled = [(0.0, 0.0, source)], set()
+    while heap:
+        dur, dist, v = heapq.heappop(heap)
+        if v in settled: continue
+        settled.add(v)
+        for w, edge_dur, edge_dist in adjacency[v]:
+            if dur + edge_dur < best_dur[w]:
+                best_dur[w], best_dist[w] = dur + edge_dur, dist + edge_dist
+                heapq.heappush(heap, (dur + edge_dur, dist + edge_dist, w))
+    return best_dur, best_dist
+
+def node_coords(graph, nodes):
+    points = graph[0]
+    return [{'lat': points[node, 0], 'lon': points[node, 1]} for node in nodes]
+
+def test_hierarchy_keeps_graph_nodes(graph, router):
+    assert router.num_nodes == len(graph[0])
+    assert np.array_equal(router.node_lat, graph[0][:, 0]) and np.array_equal(router.node_lon, graph[0][:, 1])
+
+def test_ch_matrix_matches_dijkstra(graph, router):
+    rng = np.random.default_rng(1)
+    sources, targets = rng.choice(len(graph[0]), 25, replace=False), rng.choice(len(graph[0]), 30, replace=False)
+    distances, durations = router.table(node_coords(graph, sources), node_coords(graph, targets))
+    assert durations.shape == distances.shape == (25, 30)
+    for row, source in enumerate(sources):
+        expected_dur, expected_dist = dijkstra(graph, source)
+        reachable = np.isfinite(expected_dur[targets])
+        assert np.array_equal(np.isfinite(durations[row]), reachable)
+        assert np.allclose(durations[row, reachable], expected_dur[targets][reachable], rtol=1e-9, atol=1e-6)
+        assert np.allclose(distances[row, reachable], expected_dist[targets][reachable], rtol=1e-9, atol=1e-6)
+    assert np.isfinite(durations).mean() > 0.5  # mẫu phải đủ liên thông thì phép so sánh mới có ý nghĩa
+
+def test_full_matrix_matches_dijkstra_and_executor(graph, router):
+    nodes = np.arange(len(graph[0]))
+    coords = node_coords(graph, nodes)
+    _, durations = router.table(coords, coords)
+    expected = np.array([dijkstra(graph, node)[0] for node in nodes])
+    assert np.array_equal(np.isinf(durations), np.isinf(expected))
+    finite = np.isfinite(expected)
+    assert np.allclose(durations[finite], expected[finite], rtol=1e-9, atol=1e-6)
+    with ThreadPoolExecutor(2) as executor:
+        parallel = router.table(coords, coords, executor=executor, chunks=3)
+    assert np.array_equal(parallel[1], durations)
+
+def test_snap_to_nearest_node(graph, router):
+    points = graph[0]
+    nodes, offsets = router.snap(points[:, 0], points[:, 1])
+    # Các đỉnh trùng tọa độ (nếu có) snap về cùng một đỉnh, nên so tọa độ thay vì số hiệu.
+    assert np.array_equal(points[nodes], points) and np.allclose(offsets, 0)
+    rng = np.random.default_rng(2)
+    lats = rng.uniform(points[:, 0].min(), points[:, 0].max(), 50)
+    lons = rng.uniform(points[:, 1].min(), points[:, 1].max(), 50)
+    nodes, offsets = router.snap(lats, lons)
+    for lat, lon, node, offset in zip(lats, lons, nodes, offsets):
+        exact = local_router.haversine_m(lat, lon, points[:, 0], points[:, 1])
+        # Phép chiếu equirectangular có thể chọn một đỉnh khác khi hai đỉnh gần như cách đều.
+        assert offset == pytest.approx(exact[node]) and offset <= exact.min() + 0.5
+
+def test_off_graph_points_add_access_leg(graph, router):
+    points = graph[0]
+    a, b = 3, 120
+    moved = {'lat': points[a, 0] + 0.0005, 'lon': points[a, 1]}
+    (node,), (offset,) = router.snap([moved['lat']], [moved['lon']])
+    distances, durations = router.table([moved], node_coords(graph, [b]))
+    expected_dur, expected_dist = dijkstra(graph, node)
+    assert offset > 10 and np.isfinite(expected_dur[b])
+    assert durations[0, 0] == pytest.approx(expected_dur[b] + offset / (local_router.ACCESS_SPEED_KMH / 3.6))
+    assert distances[0, 0] == pytest.approx(expected_dist[b] + offset)
+    # Cùng một tọa độ thì khoảng cách bằng 0 (không tính đoạn đi ra/vào đồ thị).
+    distances, durations = router.table([moved], [moved])
+    assert distances[0, 0] == durations[0, 0] == 0
+
+def test_parse_maxspeed():
+    assert local_router.parse_maxspeed('50') == 50
+    assert local_router.parse_maxspeed('30 mph') == pytest.approx(48.27)
+    assert local_router.parse_maxspeed('VN:urban') is None and local_router.parse_maxspeed(None) is None
@@ -0,0 +1,97 @@
+"""Kiểm tra cache ma trận (MatrixCache/get_route_info) với một server OSRM giả chạy cục bộ (http.server)."""
+import json
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import pytest
+
+import app
+
+def planar_distance(a, b):
+    return math.hypot(a[0] - b[0], a[1] - b[1]) * 1.1e5
+
+@pytest.fixture
+def osrm(monkeypatch):
+    """Server OSRM giả: /table trả về khoảng cách phẳng giữa các tọa độ và ghi lại từng request (tọa độ, sources, destinations)."""
+    requests_seen, lock = [], threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            points = [tuple(map(float, point.split(','))) for point in url.path.rsplit('/', 1)[-1].split(';')]
+            query = parse_qs(url.query)
+            sources = [int(k) for k in query['sources'][0].split(';')]
+            destinations = [int(k) for k in query['destinations'][0].split(';')]
+            with lock:
+                requests_seen.append({'points': points, 'sources': [points[k] for k in sources], 'destinations': [points[k] for k in destinations]})
+            distances = [[planar_distance(points[s], points[d]) for d in destinations] for s in sources]
+            body = json.dumps({'code': 'Ok', 'distances': distances, 'durations': [[value / 8 for value in row] for row in distances]}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(app, 'OSRM_URL', f'http://127.0.0.1:{server.server_port}')
+    monkeypatch.setattr(app, 'routing_backend', app.OsrmBackend())
+    monkeypatch.setattr(app, 'matrix_cache', app.MatrixCache(1000))
+    yield requests_seen
+    server.shutdown()
+    server.server_close()
+
+def random_coords(n, seed):
+    rng = np.random.default_rng(seed)
+    return [{'lat': round(10.7 + lat, 6), 'lon': round(106.6 + lon, 6)} for lat, lon in rng.random((n, 2)) * 0.1]
+
+def expected_matrix(coords):
+    points = [(float(c['lon']), float(c['lat'])) for c in coords]
+    return np.array([[planar_distance(a, b) for b in points] for a in points])
+
+def test_new_point_fetches_only_its_row_and_column(osrm):
+    coords = random_coords(11, seed=1)
+    distances, durations = app.get_route_info(coords[:10])
+    assert np.allclose(distances, expected_matrix(coords[:10])) and np.allclose(durations, distances / 8)
+    osrm.clear()
+    distances, _ = app.get_route_info(coords)
+    assert np.allclose(distances, expected_matrix(coords), rtol=1e-6)
+    new_point = (coords[10]['lon'], coords[10]['lat'])
+    # Hàng của điểm mới (11 ô) và cột của nó từ 10 điểm cũ: 21 ô, mỗi ô đều dính tới điểm mới.
+    assert sum(len(r['sources']) * len(r['destinations']) for r in osrm) == 21
+    assert all(r['sources'] == [new_point] or r['destinations'] == [new_point] for r in osrm)
+    osrm.clear()
+    app.get_route_info(list(reversed(coords)))
+    assert osrm == []
+
+def test_large_request_is_split_into_tiles(osrm):
+    coords = random_coords(250, seed=2)
+    distances, _ = app.get_route_info(coords)
+    assert len(osrm) > 1 and all(len(r['points']) <= app.OSRM_TABLE_MAX_SIZE for r in osrm)
+    assert sum(len(r['sources']) * len(r['destinations']) for r in osrm) == 250 * 250
+    assert np.allclose(distances, expected_matrix(coords))
+
+def test_duplicate_coordinates(osrm):
+    coords = random_coords(5, seed=3)
+    with_duplicates = coords + [dict(coords[1]), dict(coords[3]), dict(coords[1])]
+    distances, durations = app.get_route_info(with_duplicates)
+    assert distances.shape == durations.shape == (8, 8)
+    assert np.allclose(distances, expected_matrix(with_duplicates))
+    assert distances[1, 5] == distances[5, 7] == 0
+    # Mỗi tọa độ chỉ được hỏi một lần.
+    assert sum(len(r['sources']) * len(r['destinations']) for r in osrm) == 25
+    assert all(len(set(r['points'])) == len(r['points']) for r in osrm)
+
+def test_cache_capacity_is_capped():
+    cache = app.MatrixCache(20)
+    cache.lookup([(k, 0) for k in range(15)])
+    cache.lookup([(k, 0) for k in range(20)])
+    assert len(cache.distances) == 20 and cache.distances.dtype == np.float32
+    generation = cache.generation
+    cache.lookup([(k, 1) for k in range(5)])  # vượt max_points: cache được làm mới
+    assert cache.generation == generation + 1 and len(cache.index) == 5
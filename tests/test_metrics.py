@@ -0,0 +1,131 @@
+"""Kiểm tra metrics.py: định dạng văn bản Prometheus, drain/merge giữa các tiến trình, trace và profiler cho lần giải chậm."""
+import json
+import math
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+import metrics
+
+# Một dòng mẫu của text exposition format: tên{nhãn="giá trị",...} số
+SAMPLE_LINE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{([a-zA-Z_][a-zA-Z0-9_]*="(\\.|[^"\\])*",?)*\})? (-?[0-9.e+-]+|\+Inf|NaN)$')
+
+def make_registry():
+    registry = metrics.MetricsRegistry()
+    registry.counter('test_requests_total', 'Số request.')
+    registry.histogram('test_latency_seconds', 'Độ trễ.', buckets=(0.1, 1))
+    return registry
+
+def record_in_child(values):
+    """Chạy trong tiến trình con: ghi số liệu vào registry của tiến trình đó rồi trả về phần drain."""
+    registry = make_registry()
+    for value in values:
+        registry.inc('test_requests_total', endpoint='/solve')
+        registry.observe('test_latency_seconds', value, stage='solve')
+    return registry.drain()
+
+def test_render_prometheus_text_format():
+    registry = make_registry()
+    registry.inc('test_requests_total', endpoint='/solve')
+    registry.inc('test_requests_total', 2, endpoint='say "xin chào"\\\n')
+    for value in (0.05, 0.1, 0.5, 3):
+        registry.observe('test_latency_seconds', value, stage='solve')
+    text = registry.render()
+    assert text.endswith('\n')
+    lines = text.splitlines()
+    assert lines[:2] == ['# HELP test_latency_seconds Độ trễ.', '# TYPE test_latency_seconds histogram']
+    assert '# TYPE test_requests_total counter' in lines
+    for line in lines:
+        assert line.startswith('# ') or SAMPLE_LINE.match(line), line
+    # Bucket cộng dồn, giá trị đúng bằng cận trên thuộc bucket đó (le là "nhỏ hơn hoặc bằng").
+    assert 'test_latency_seconds_bucket{stage="solve",le="0.1"} 2' in lines
+    assert 'test_latency_seconds_bucket{stage="solve",le="1"} 3' in lines
+    assert 'test_latency_seconds_bucket{stage="solve",le="+Inf"} 4' in lines
+    assert 'test_latency_seconds_count{stage="solve"} 4' in lines
+    assert 'test_latency_seconds_sum{stage="solve"} 3.65' in lines
+    assert 'test_requests_total{endpoint="/solve"} 1' in lines
+    assert 'test_requests_total{endpoint="say \\"xin chào\\"\\\\\\n"} 2' in lines
+
+def test_empty_metric_still_has_help_and_type():
+    assert make_registry().render().splitlines() == [
+        '# HELP test_latency_seconds Độ trễ.', '# TYPE test_latency_seconds histogram',
+        '# HELP test_requests_total Số request.', '# TYPE test_requests_total counter']
+
+def test_drain_clears_and_merge_restores():
+    source, target = make_registry(), make_registry()
+    source.inc('test_requests_total', 3, endpoint='/solve')
+    source.observe('test_latency_seconds', 0.5, stage='solve')
+    expected = source.render()
+    delta = source.drain()
+    assert source.drain() == {'counters': [], 'histograms': []}
+    target.merge(json.loads(json.dumps(delta)))  # dữ liệu thuần: đi qua được pipe/JSON
+    assert target.render() == expected
+
+def test_merge_from_worker_processes():
+    per_worker = [[0.05, 2.0], [0.5], [0.01, 0.02, 5.0]]
+    with ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context('spawn')) as pool:
+        deltas = list(pool.map(record_in_child, per_worker))
+    registry = make_registry()
+    for delta in deltas:
+        registry.merge(delta)
+    lines = registry.render().splitlines()
+    assert 'test_requests_total{endpoint="/solve"} 6' in lines
+    assert 'test_latency_seconds_bucket{stage="solve",le="0.1"} 3' in lines
+    assert 'test_latency_seconds_bucket{stage="solve",le="+Inf"} 6' in lines
+    total = float(next(line for line in lines if line.startswith('test_latency_seconds_sum')).split()[-1])
+    assert math.isclose(total, sum(map(sum, per_worker)))
+
+def test_merged_counters_are_added_to_current_trace():
+    registry, trace = make_registry(), metrics.Trace('job')
+    delta = record_in_child([0.1, 0.2])
+    with metrics.tracing(trace):
+        registry.merge(delta)
+    assert trace.counters == {'test_requests_total{endpoint="/solve"}': 2}
+
+def test_timed_adds_span_and_observes(monkeypatch):
+    registry = metrics.MetricsRegistry()
+    registry.histogram('mapai_stage_seconds', 'Thời gian.')
+    monkeypatch.setattr(metrics, 'registry', registry)
+    trace = metrics.Trace('http')
+    with metrics.tracing(trace), pytest.raises(ValueError):
+        with metrics.timed('matrix', backend='haversine'):
+            raise ValueError()
+    assert trace.spans[0]['stage'] == 'matrix' and trace.spans[0]['error'] == 'ValueError'
+    assert 'mapai_stage_seconds_count{backend="haversine",stage="matrix"} 1' in registry.render().splitlines()
+
+def test_log_trace_is_off_when_path_is_empty(tmp_path, capsys):
+    metrics.log_trace({'trace_id': 'a'}, '')
+    assert capsys.readouterr().err == ''
+    path = tmp_path / 'traces.jsonl'
+    metrics.log_trace({'trace_id': 'a', 'name': 'Lộ trình'}, str(path))
+    metrics.log_trace({'trace_id': 'b'}, str(path))
+    assert [json.loads(line)['trace_id'] for line in path.read_text(encoding='utf-8').splitlines()] == ['a', 'b']
+
+def busy_wait(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end: pass
+
+def test_profile_if_slow_writes_folded_stacks(tmp_path, monkeypatch):
+    registry = metrics.MetricsRegistry()
+    monkeypatch.setattr(metrics, 'registry', registry)
+    trace = metrics.Trace('job')
+    with metrics.tracing(trace), metrics.profile_if_slow('solve/vrp', 0.05, str(tmp_path), 0.005):
+        busy_wait(0.2)
+    files = os.listdir(tmp_path)
+    assert len(files) == 1 and files[0].endswith(f'-solve_vrp-{trace.trace_id}.folded')
+    assert trace.attrs['profile'] == os.path.join(str(tmp_path), files[0])
+    lines = (tmp_path / files[0]).read_text(encoding='utf-8').splitlines()
+    assert lines and all(re.match(r'^\S.* \d+$', line) for line in lines)
+    assert any('busy_wait (test_metrics.py:' in line for line in lines)
+    assert registry.drain()['counters'] == [['mapai_profiles_saved_total', [], 1]]
+
+def test_profile_if_slow_skips_fast_or_disabled_runs(tmp_path):
+    with metrics.profile_if_slow('solve', 10, str(tmp_path / 'fast'), 0.005):
+        busy_wait(0.02)
+    with metrics.profile_if_slow('solve', None, str(tmp_path / 'off'), 0.005):
+        busy_wait(0.02)
+    assert os.listdir(tmp_path) == []
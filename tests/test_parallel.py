@@ -0,0 +1,72 @@
+"""Kiểm tra các đường chạy song song (solver pool, portfolio) so với đường tuần tự, và việc không chạy song song trong worker của pool công việc."""
+import time
+
+import numpy as np
+import pytest
+
+import app
+
+def random_instance(n, seed):
+    rng = np.random.default_rng(seed)
+    points = rng.random((n, 2)) * 10000
+    return np.sqrt(((points[:, None, :] - points[None, :, :]) ** 2).sum(axis=2))
+
+def assert_valid_tour(route, n):
+    assert route[0] == route[-1] == 0 and sorted(route[:-1]) == list(range(n))
+
+@pytest.fixture
+def solver_pool(monkeypatch):
+    """Bật đường song song (2 tiến trình, mọi kích thước bài) với một solver pool riêng cho test."""
+    monkeypatch.setattr(app, 'SOLVER_WORKERS', 2)
+    monkeypatch.setattr(app, 'PARALLEL_SOLVE_MIN_LOCATIONS', 1)
+    monkeypatch.setattr(app, 'solver_pool', None)
+    yield
+    if app.solver_pool is not None: app.solver_pool.shutdown(cancel_futures=True)
+
+def test_parallel_distance_algorithms_match_serial(solver_pool, monkeypatch):
+    dist = random_instance(80, seed=1)
+    parallel = app.run_distance_algorithms(dist)
+    monkeypatch.setattr(app, 'IN_JOB_WORKER', True)
+    serial = app.run_distance_algorithms(dist)
+    assert app.solver_pool is not None and set(parallel) == set(serial) == set(app.DISTANCE_ALGORITHMS)
+    # Hai thuật toán tất định phải cho cùng lộ trình; SA dùng số ngẫu nhiên nên chỉ kiểm tra tính hợp lệ.
+    for name in ('NN + 2-Opt', 'NN + 3-Opt'):
+        assert parallel[name][0] == serial[name][0]
+    for route, _ in list(parallel.values()) + list(serial.values()):
+        assert_valid_tour(route, 80)
+
+def test_portfolio_in_job_worker_runs_in_process(solver_pool, monkeypatch):
+    monkeypatch.setattr(app, 'IN_JOB_WORKER', True)
+    monkeypatch.setattr(app.multiprocessing, 'get_context', lambda *args: pytest.fail('worker của pool công việc không được tạo thêm tiến trình'))
+    assert app.portfolio_workers(80) == 1
+    dist = random_instance(80, seed=2)
+    reports = []
+    route = app.run_portfolio_solver(dist, 1.0, progress=lambda stage, **info: reports.append(info))
+    assert_valid_tour(route, 80)
+    core = app.SolverCore(dist)
+    assert core.cost(route) <= core.cost(app.run_2_opt_solver(core)) + 1e-6
+    assert reports and all(info['algorithm'] == 'Portfolio' for info in reports)
+    assert min(info['best_cost'] for info in reports) == pytest.approx(core.cost(route))
+
+def test_serial_portfolio_can_be_cancelled(monkeypatch):
+    monkeypatch.setattr(app, 'IN_JOB_WORKER', True)
+    started = time.time()
+
+    def progress(stage, **info):
+        if time.time() - started > 0.5: raise app.JobCancelled()
+
+    with pytest.raises(app.JobCancelled):
+        app.run_portfolio_solver(random_instance(200, seed=3), 30, progress=progress)
+    assert time.time() - started < 5
+
+def test_parallel_portfolio_matches_serial_quality(solver_pool):
+    dist = random_instance(60, seed=4)
+    core = app.SolverCore(dist)
+    baseline = core.cost(app.run_2_opt_solver(core))
+    parallel = app.run_portfolio_solver(dist, 2.0, workers=2)
+    serial = app.run_portfolio_solver(dist, 2.0, workers=1)
+    for route in (parallel, serial):
+        assert_valid_tour(route, 60)
+        assert core.cost(route) <= baseline + 1e-6
+    # Cả hai đường đều tìm kiếm cùng các biến thể nên chất lượng phải tương đương (cùng cỡ trong vài phần trăm).
+    assert abs(core.cost(parallel) - core.cost(serial)) <= 0.05 * baseline
@@ -0,0 +1,86 @@
+"""Kiểm tra lớp phủ sự cố (overlay) của RoutePlan và endpoint /reroute (kế hoạch được đặt sẵn vào plan_store)."""
+
+import numpy as np
+import pytest
+
+import app
+
+def random_plan(n, seed, time_windows=False):
+    rng = np.random.default_rng(seed)
+    points = rng.random((n, 2)) * 10000
+    dist = np.sqrt(((points[:, None, :] - points[None, :, :]) ** 2).sum(axis=2))
+    route = app.apply_2_opt(app.run_nearest_neighbor(dist), dist)
+    addresses = [{'display_name': f'Điểm {k}'} for k in range(n)]
+    if not time_windows: return app.RoutePlan(addresses, dist, dist / 8, route)
+    # Khung giờ rộng (cả ngày) nên lộ trình ban đầu luôn hợp lệ.
+    windows = [{'earliest': 8 * 3600, 'latest': 32 * 3600} for _ in range(n - 1)]
+    return app.RoutePlan(addresses, dist, dist / 8, route, windows, 8 * 3600)
+
+@pytest.fixture
+def client():
+    app.app.config['TESTING'] = True
+    return app.app.test_client()
+
+def post_reroute(client, plan, **segment):
+    plan_id = app.plan_store.add(plan)
+    return client.post('/reroute', json={'plan_id': plan_id, 'avoid_segment': segment})
+
+@pytest.mark.parametrize('time_windows', [False, True])
+def test_zero_delay_keeps_route_and_cost(time_windows):
+    plan = random_plan(30, seed=1, time_windows=time_windows)
+    route, summary = plan.route[:], plan.summary()
+    plan.add_incident(route[3], route[4], delay_sec=0)
+    assert plan.overlay[(route[3], route[4])] == (False, 0)
+    # Chỉ vị trí tài xế thay đổi (coi như đang ở đầu chặng có sự cố).
+    assert plan.route == route and dict(plan.summary(), position=0) == summary
+
+def test_delay_is_added_to_travel_time():
+    plan = random_plan(30, seed=2, time_windows=True)
+    a, b = plan.route[3], plan.route[4]
+    plan.add_incident(a, b, delay_sec=120)
+    plan.add_incident(a, b, delay_sec=60)
+    assert plan.overlay[(a, b)] == (False, 180)
+    assert plan.travel_time(a, b) == pytest.approx(plan.durations[a, b] + 180)
+    assert plan.evaluator.duration[a, b] == pytest.approx(plan.durations[a, b] + 180)
+
+def test_reroute_blocks_segment(client):
+    plan = random_plan(30, seed=3)
+    a, b = plan.route[5], plan.route[6]
+    response = client.post('/reroute', json={'plan_id': app.plan_store.add(plan), 'avoid_segment': {'from_index': a, 'to_index': b}})
+    assert response.status_code == 200
+    names = [point['display_name'] for point in response.get_json()['path']]
+    assert (f'Điểm {a}', f'Điểm {b}') not in zip(names, names[1:])
+    assert plan.overlay == {(a, b): (True, 0)}
+
+@pytest.mark.parametrize('segment', [{'from_index': '1', 'to_index': 2}, {'from_index': 1, 'to_index': True},
+                                     {'from_index': 1, 'to_index': 99}, {'from_index': 1.0, 'to_index': 2},
+                                     {'from_index': 1, 'to_index': 2, 'delay_sec': -5}, {'from_index': 1, 'to_index': 2, 'delay_sec': True}])
+def test_reroute_rejects_invalid_segment(client, segment):
+    plan = random_plan(30, seed=4, time_windows=True)
+    route = plan.route[:]
+    response = post_reroute(client, plan, **segment)
+    assert response.status_code == 400
+    assert plan.route == route and plan.overlay == {}
+
+def test_reroute_rejects_delay_in_distance_mode(client):
+    plan = random_plan(30, seed=5)
+    response = post_reroute(client, plan, from_index=plan.route[2], to_index=plan.route[3], delay_sec=300)
+    assert response.status_code == 400 and plan.overlay == {}
+
+def test_reroute_rejects_invalid_position(client):
+    plan = random_plan(30, seed=6)
+    response = client.post('/reroute', json={'plan_id': app.plan_store.add(plan), 'current_position': '3',
+                                             'avoid_segment': {'from_index': plan.route[5], 'to_index': plan.route[6]}})
+    assert response.status_code == 400
+
+def test_reroute_unknown_plan_asks_for_addresses(client):
+    response = client.post('/reroute', json={'plan_id': 'khong-ton-tai', 'avoid_segment': {'from_index': 1, 'to_index': 2}})
+    assert response.status_code == 404
+
+def test_reroute_delay_in_schedule_mode(client):
+    plan = random_plan(30, seed=7, time_windows=True)
+    a, b = plan.route[5], plan.route[6]
+    response = post_reroute(client, plan, from_index=a, to_index=b, delay_sec=600)
+    assert response.status_code == 200
+    assert plan.overlay == {(a, b): (False, 600)}
+    assert sorted(plan.route[1:-1]) == list(range(1, 30))
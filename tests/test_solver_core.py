@@ -0,0 +1,134 @@
+"""Kiểm tra SolverCore: kết quả trùng phiên bản gốc trên bài nhỏ, tối ưu cục bộ, SA và đoạn lộ trình đã cố định (tham số first)."""
+import random
+
+import numpy as np
+import pytest
+
+import app
+
+def random_instance(n, seed):
+    rng = np.random.default_rng(seed)
+    points = rng.random((n, 2)) * 10000
+    return np.sqrt(((points[:, None, :] - points[None, :, :]) ** 2).sum(axis=2))
+
+def random_route(n, seed):
+    rng = random.Random(seed)
+    return [0] + rng.sample(range(1, n), n - 1) + [0]
+
+def asymmetric_instance(n, seed):
+    """Ma trận bất đối xứng kiểu đường một chiều: khoảng cách Euclid nhân hệ số ngẫu nhiên cho từng chiều."""
+    rng = np.random.default_rng(seed)
+    return random_instance(n, seed) * rng.uniform(1.0, 1.6, (n, n))
+
+# Phiên bản gốc (trước SolverCore) của Nearest Neighbor và 2-Opt, dùng để so sánh kết quả trên bài nhỏ.
+def baseline_nearest_neighbor(dist_matrix):
+    num_locations = len(dist_matrix)
+    current_node, unvisited, path_indices = 0, list(range(1, num_locations)), [0]
+    while unvisited:
+        reachable_nodes = {node: dist_matrix[current_node][node] for node in unvisited if dist_matrix[current_node][node] != float('inf')}
+        current_node = min(reachable_nodes, key=reachable_nodes.get)
+        path_indices.append(current_node)
+        unvisited.remove(current_node)
+    return path_indices + [0]
+
+def baseline_2_opt(path_indices, dist_matrix):
+    best_path, improved = path_indices[:], True
+    while improved:
+        improved = False
+        for i in range(1, len(best_path) - 2):
+            for j in range(i + 1, len(best_path)):
+                if j == i + 1: continue
+                current_dist = dist_matrix[best_path[i-1]][best_path[i]] + dist_matrix[best_path[j-1]][best_path[j]]
+                new_dist = dist_matrix[best_path[i-1]][best_path[j-1]] + dist_matrix[best_path[i]][best_path[j]]
+                if new_dist < current_dist:
+                    best_path[i:j] = best_path[j-1:i-1:-1]
+                    improved = True
+    return best_path
+
+def improving_2opt_moves(dist, route):
+    """Mọi bước 2-Opt (đảo đoạn route[i..j]) làm giảm tổng chi phí, tính lại toàn bộ lộ trình (vét cạn)."""
+    cost = lambda path: sum(dist[a][b] for a, b in zip(path, path[1:]))
+    base = cost(route)
+    return [(i, j) for i in range(1, len(route) - 2) for j in range(i + 1, len(route) - 1)
+            if cost(route[:i] + route[i:j + 1][::-1] + route[j + 1:]) < base - 1e-6]
+
+@pytest.mark.parametrize('seed', range(40))
+def test_small_inputs_match_baseline(seed):
+    n = 5 + seed % 30
+    dist = random_instance(n, seed)
+    matrix = dist.tolist()
+    nearest = app.run_nearest_neighbor(dist)
+    assert nearest == baseline_nearest_neighbor(matrix)
+    assert app.run_2_opt_solver(dist) == baseline_2_opt(nearest, matrix)
+    route = random_route(n, seed)
+    assert app.apply_2_opt(route, dist) == baseline_2_opt(route, matrix)
+
+@pytest.mark.parametrize('make_instance', [random_instance, asymmetric_instance])
+def test_2opt_reaches_local_optimum(make_instance):
+    """Cả quét toàn bộ (bài nhỏ) lẫn danh sách ứng viên + don't-look bits đều dừng ở tối ưu cục bộ 2-Opt thật sự."""
+    for seed in range(40):
+        n = 6 + seed % 11
+        dist = make_instance(n, seed)
+        core = app.SolverCore(dist)  # n <= 17: danh sách ứng viên chứa mọi điểm
+        for route in (core.scan_2opt(random_route(n, seed)), core.local_search(random_route(n, seed), moves=('2opt',))):
+            assert improving_2opt_moves(dist, route) == []
+
+def test_sa_improves_on_nearest_neighbor():
+    dist = random_instance(500, seed=5)
+    core = app.SolverCore(dist)
+    random.seed(5)
+    route = app.run_sa_solver(core)
+    assert sorted(route[:-1]) == list(range(500)) and route[0] == route[-1] == 0
+    assert core.cost(route) < 0.95 * core.cost(app.run_nearest_neighbor(core))
+
+@pytest.mark.parametrize('moves', [('oropt',), ('2opt',), ('2opt', 'oropt'), ('2opt', '3opt')])
+@pytest.mark.parametrize('first', [1, 30, 150])
+def test_local_search_keeps_fixed_prefix(moves, first):
+    dist = random_instance(200, seed=first)
+    core = app.SolverCore(dist)
+    for seed in range(5):
+        route = random_route(200, seed)
+        before = route[:]
+        core.local_search(route, moves=moves, first=first)
+        assert route[:first] == before[:first]
+        assert sorted(route[:-1]) == list(range(200)) and route[-1] == 0
+        assert core.cost(route) <= core.cost(before) + 1e-6
+
+def test_or_opt_reaches_local_optimum():
+    """Sau khi dừng, không còn bước or-opt cải thiện nào (kiểm tra vét cạn trên bài nhỏ)."""
+    dist = random_instance(40, seed=1)
+    core = app.SolverCore(dist, num_neighbors=39)
+    route = random_route(40, seed=1)
+    core.local_search(route, moves=('oropt',))
+    cost, n = core.cost(route), len(route) - 1
+    for i in range(1, n):
+        for length in (1, 2, 3):
+            if i + length > n: continue
+            segment, rest = route[i:i + length], route[:i] + route[i + length:]
+            for q in range(len(rest) - 1):
+                candidate = rest[:q + 1] + segment + rest[q + 1:]
+                assert core.cost(candidate) >= cost - 1e-6
+
+def test_reroute_keeps_driven_part():
+    dist = random_instance(120, seed=7)
+    start = app.apply_2_opt(app.run_nearest_neighbor(dist), dist)
+    rng = random.Random(3)
+    for _ in range(50):
+        plan = app.RoutePlan([{'display_name': str(k)} for k in range(120)], dist, dist / 8, start)
+        k = rng.randrange(41, 119)
+        plan.add_incident(plan.route[k], plan.route[k + 1], current_position=40)
+        assert plan.route[:41] == start[:41]
+
+def test_failed_incident_leaves_plan_unchanged():
+    """Chặn cạnh duy nhất còn lại (tài xế đã ở điểm áp chót) thì sửa thất bại và kế hoạch không bị hỏng."""
+    dist = random_instance(20, seed=2)
+    start = app.apply_2_opt(app.run_nearest_neighbor(dist), dist)
+    plan = app.RoutePlan([{'display_name': str(k)} for k in range(20)], dist, dist / 8, start)
+    summary = plan.summary()
+    with pytest.raises(ValueError):
+        plan.add_incident(start[-2], 0, current_position=len(start) - 2)
+    assert plan.overlay == {} and plan.route == start and plan.position == 0
+    assert plan.summary() == summary
+    assert plan.core.dist[start[-2], 0] == dist[start[-2], 0]
+    plan.add_incident(start[5], start[6])
+    assert (start[5], start[6]) not in zip(plan.route, plan.route[1:])
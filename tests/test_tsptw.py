@@ -0,0 +1,63 @@
+"""Kiểm tra TimeWindowEvaluator (cập nhật tiền tố/hậu tố theo từng bước) và SA của TSPTW."""
+import random
+
+import numpy as np
+import pytest
+
+import app
+import benchmark
+
+def random_tsptw(n, seed):
+    """Bài TSPTW luôn có lời giải (benchmark.add_time_windows); trả về (ma trận thời gian, khung giờ, giờ xuất phát)."""
+    rng = np.random.default_rng(seed)
+    instance = benchmark.add_time_windows('random', benchmark.euclidean_matrix(benchmark.random_points(n, rng)), rng)
+    return instance['duration'], instance['time_windows'], instance['start_time_sec']
+
+def test_apply_matches_full_reload():
+    durations, windows, start = random_tsptw(60, seed=1)
+    evaluator, fresh = app.TimeWindowEvaluator(durations, windows, start), app.TimeWindowEvaluator(durations, windows, start)
+    rng = random.Random(1)
+    route = [0] + rng.sample(range(1, 60), 59) + [0]
+    evaluator.load(route)
+    kinds = ('swap', 'relocate', 'relocate_back', '2opt')
+    for _ in range(300):
+        i = rng.randint(1, 58)
+        j = rng.randint(i + 1, min(59, i + app.TW_SA_MAX_SPAN))
+        left, nodes, right = evaluator.move_nodes(rng.choice(kinds), i, j)
+        result = evaluator.evaluate(left, nodes, right)
+        fresh.load(route[:])
+        # Sau một chuỗi apply, evaluate phải cho cùng kết quả với một evaluator vừa nạp lại toàn bộ lộ trình.
+        assert np.allclose(result, fresh.evaluate(left, nodes, right))
+        if rng.random() < 0.5:
+            evaluator.apply(left, nodes, right)
+            assert np.allclose(result, app.TimeWindowEvaluator(durations, windows, start).load(route[:]))
+
+def test_sa_returns_feasible_route():
+    durations, windows, start = random_tsptw(120, seed=2)
+    random.seed(2)
+    path, _, cost, schedule = app.run_sa_solver_for_tsptw(durations, durations, windows, start)
+    assert path[0] == path[-1] == 0 and sorted(path[1:-1]) == list(range(1, 120))
+    assert cost < float('inf') and len(schedule) == 120
+    assert app.calculate_tsptw_cost(path, durations.tolist(), windows, start)[0] == cost
+
+def test_initial_temperature_hits_target_acceptance():
+    rng = np.random.default_rng(3)
+    deltas = rng.exponential(500.0, 200).tolist() + [0.0] * 20
+    temp = app.initial_temperature(deltas, 0.2)
+    acceptance = (20 + np.exp(-np.array(deltas[:200]) / temp).sum()) / len(deltas)
+    assert acceptance == pytest.approx(0.2, rel=1e-6)
+    # Tỷ lệ chấp nhận tăng theo T, nên mục tiêu cao hơn cho nhiệt độ cao hơn.
+    assert app.initial_temperature(deltas, 0.5) > temp
+    # Đã có đủ bước không làm xấu đi để đạt mục tiêu, hoặc không có bước làm xấu đi nào: trả về nhiệt độ nhỏ/mặc định.
+    assert app.initial_temperature(deltas, 0.05) < min(deltas[:200])
+    assert app.initial_temperature([0.0, 0.0], 0.2) == 1.0 and app.initial_temperature([], 0.2) == 1.0
+
+def test_sa_scales_with_instance_units():
+    """Nhiệt độ ban đầu theo bài toán: đổi đơn vị thời gian (giây -> mili giây) cho cùng chất lượng lời giải."""
+    durations, windows, start = random_tsptw(60, seed=4)
+    random.seed(4)
+    cost_sec = app.run_sa_solver_for_tsptw(durations, durations, windows, start)[2]
+    scaled = [{'earliest': w['earliest'] * 1000, 'latest': w['latest'] * 1000} for w in windows]
+    random.seed(4)
+    cost_ms = app.run_sa_solver_for_tsptw(durations, durations * 1000, scaled, start * 1000)[2]
+    assert cost_ms / 1000 == pytest.approx(cost_sec)
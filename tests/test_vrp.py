@@ -0,0 +1,83 @@
+"""Kiểm tra chế độ nhiều xe (run_vrp_solver, improve_between_routes): mỗi điểm được phục vụ đúng một lần, không
+vượt tải trọng, đúng khung giờ và không dùng quá số xe."""
+import random
+
+import numpy as np
+import pytest
+
+import app
+
+def random_vrp(n, seed):
+    """Bài CVRP ngẫu nhiên quanh kho: (tọa độ (lat, lon), ma trận quãng đường m, ma trận thời gian s, nhu cầu)."""
+    rng = np.random.default_rng(seed)
+    coords = [(10.77, 106.70)] + [(10.77 + lat, 106.70 + lon) for lat, lon in (rng.random((n - 1, 2)) - 0.5) * 0.1]
+    lats, lons = (np.array([c[k] for c in coords]) for k in (0, 1))
+    dist = app.haversine_m(lats[:, None], lons[:, None], lats[None, :], lons[None, :]) * app.ROAD_FACTOR
+    demands = [0] + rng.integers(1, 6, n - 1).tolist()
+    return coords, dist, dist / 8.0, demands
+
+def random_windows(durations, seed, start=8 * 3600):
+    """Khung giờ rộng 2 giờ, luôn đến kịp khi đi thẳng từ kho."""
+    rng = np.random.default_rng(seed)
+    windows = []
+    for node in range(1, len(durations)):
+        earliest = start + int(rng.integers(0, 4 * 3600))
+        windows.append({'earliest': earliest, 'latest': max(earliest, start + int(durations[0, node])) + 2 * 3600})
+    return windows, start
+
+def assert_valid_routes(routes, n, demands, capacity, num_vehicles):
+    assert 1 <= len(routes) <= num_vehicles
+    assert all(route[0] == route[-1] == 0 and len(route) > 2 for route in routes)
+    visits = sorted(node for route in routes for node in route[1:-1])
+    assert visits == list(range(1, n))  # mỗi điểm đúng một lần
+    assert all(app.route_load(route, demands) <= capacity for route in routes)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_cvrp_covers_every_stop_within_capacity(seed):
+    n, capacity = 60, 25
+    coords, dist, _, demands = random_vrp(n, seed)
+    num_vehicles = -(-sum(demands) // capacity) + 2
+    routes, schedules, construction = app.run_vrp_solver(dist, demands, capacity, num_vehicles, coords)
+    assert construction in ('Clarke-Wright', 'Sweep') and schedules == [None] * len(routes)
+    assert_valid_routes(routes, n, demands, capacity, num_vehicles)
+
+@pytest.mark.parametrize('seed', range(3))
+def test_vrptw_schedules_are_feasible(seed):
+    n, capacity = 40, 30
+    coords, dist, durations, demands = random_vrp(n, seed)
+    windows, start = random_windows(durations, seed)
+    random.seed(seed)
+    routes, schedules, _ = app.run_vrp_solver(dist, demands, capacity, n, coords, durations, windows, start)
+    assert_valid_routes(routes, n, demands, capacity, n)
+    for route, schedule in zip(routes, schedules):
+        sub_windows = [windows[node - 1] for node in route[1:-1]]
+        local = list(range(len(route) - 1)) + [0]
+        duration, expected = app.calculate_tsptw_cost(local, durations[np.ix_(route[:-1], route[:-1])], sub_windows, start)
+        assert duration < float('inf') and schedule == expected
+
+def test_improve_between_routes_keeps_constraints_and_never_worsens():
+    n, capacity = 80, 20
+    coords, dist, _, demands = random_vrp(n, seed=7)
+    core = app.SolverCore(dist)
+    routes = app.sweep_routes(coords, core.dist, demands, capacity)
+    before = sum(core.cost(route) for route in routes)
+    improved = app.improve_between_routes([route[:] for route in routes], core, demands, capacity)
+    assert_valid_routes(improved, n, demands, capacity, len(routes))
+    assert sum(core.cost(route) for route in improved) <= before + 1e-6
+
+def test_improve_between_routes_respects_time_windows():
+    n, capacity = 40, 30
+    coords, dist, durations, demands = random_vrp(n, seed=8)
+    windows, start = random_windows(durations, seed=8)
+    core, evaluator = app.SolverCore(dist), app.TimeWindowEvaluator(durations, windows, start)
+    routes = app.improve_between_routes(app.savings_routes(core.dist, demands, capacity, evaluator), core, demands, capacity, evaluator)
+    assert_valid_routes(routes, n, demands, capacity, n)
+    for route in routes:
+        assert app.calculate_tsptw_cost(route, durations, windows, start)[0] < float('inf')
+
+def test_infeasible_instances_are_rejected():
+    coords, dist, _, demands = random_vrp(20, seed=9)
+    with pytest.raises(ValueError, match='tải trọng'):
+        app.run_vrp_solver(dist, demands, max(demands) - 1, 20, coords)
+    with pytest.raises(ValueError, match='Cần ít nhất'):
+        app.run_vrp_solver(dist, demands, max(demands), 1, coords)